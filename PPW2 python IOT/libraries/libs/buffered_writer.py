@@ -0,0 +1,45 @@
+from time import ticks_ms,ticks_diff
+class BufferedWriter:
+ DEFAULT_BUFFER_SIZE=4096 
+ DEFAULT_MAX_AGE=10 
+ def __init__(self,file,mode="wb",buffer_size=DEFAULT_BUFFER_SIZE,max_age=DEFAULT_MAX_AGE):
+  self.file=open(file,mode)if isinstance(file,str)else file
+  self.buffer=bytearray(buffer_size)
+  self.view=memoryview(self.buffer)
+  self.length=0
+  self.max_age_ms=max_age*1000
+  self.first_ticks=0 
+  self.flush_requested=False
+  self.flush_count=0
+  self.bytes_written=0
+ def write(self,line):
+  data=line.encode()if isinstance(line,str)else line
+  size=len(data)
+  if self.length+size>len(self.buffer):
+   self.flush()
+  if size>len(self.buffer):
+   self.file.write(data)
+   self.file.flush()
+   self.flush_count+=1
+   self.bytes_written+=size
+   return
+  if not self.length:
+   self.first_ticks=ticks_ms()
+  self.view[self.length:self.length+size]=data
+  self.length+=size
+ def request_flush(self):
+  self.flush_requested=True
+ def poll(self):
+  if self.flush_requested or(self.length and ticks_diff(ticks_ms(),self.first_ticks)>=self.max_age_ms):
+   self.flush()
+ def flush(self):
+  self.flush_requested=False
+  if self.length:
+   self.file.write(self.view[:self.length])
+   self.file.flush()
+   self.flush_count+=1
+   self.bytes_written+=self.length
+   self.length=0
+ def close(self):
+  self.flush()
+  self.file.close()
@@ -3,10 +3,34 @@ import network
 import esp
 import socket
 import struct
-from time import sleep,ticks_ms,localtime
+from time import sleep,sleep_ms,ticks_ms,ticks_add,ticks_diff,localtime
 from machine import Pin,RTC
 from libs.mqtt_simple_ex import MQTTClientEx
 from libs.proto_rig import ProtoRig as Rig
+from libs.timestamps import Timestamps
+from libs.wifi_manager import WiFiManager
+try:
+ import uheapq as heapq
+except ImportError:
+ import heapq
+try:
+ import uasyncio as asyncio
+except ImportError:
+ asyncio=None
+def _async_run(coroutine):
+ if hasattr(asyncio,"run"):
+  return asyncio.run(coroutine)
+ return asyncio.get_event_loop().run_until_complete(coroutine)
+def _async_create_task(coroutine):
+ if hasattr(asyncio,"create_task"):
+  return asyncio.create_task(coroutine)
+ asyncio.get_event_loop().create_task(coroutine)
+ return coroutine
+def _async_cancel(task):
+ if hasattr(task,"cancel"):
+  task.cancel()
+ else:
+  asyncio.cancel(task)
 class RunStates:
  NOT_STARTED=1
  STARTING=2
@@ -14,8 +38,27 @@ class RunStates:
  LOOPING=4
  DEINITIALISING=5
  SHUTTING_DOWN=6
+class PeriodicTask:
+ def __init__(self,period,callback,priority=0,catch_up=False,name=None):
+  self.period=period
+  self.callback=callback
+  self.priority=priority
+  self.catch_up=catch_up
+  self.name=name
+  self.deadline=0
+  self.cancelled=False
+  self.runs=0
+  self.overruns=0
+  self.skipped=0
+  self.max_lateness=0
+  self.total_time=0
+  self.max_time=0
+ def cancel(self):
+  self.cancelled=True
+ def average_time(self):
+  return self.total_time/self.runs if self.runs else 0
 class IoTApp:
- _DEFAULT_LOOP_SLEEP_TIME=0.1
+ _WIFI_POLL_PERIOD=250
  _NTP_ERROR_CODE=-1
  _NTP_QUERY=bytearray(48)
  _NTP_QUERY[0]=0x1b
@@ -29,7 +72,7 @@ class IoTApp:
  _BST_END_MN=10
  _BST_END_HR=1
  _BST_INCREMENT=3600 
- def __init__(self,name,has_oled_board=True,i2c_freq=Rig.DEFAULT_I2C_FREQUENCY,finish_button="C",start_verbose=True,apply_bst=True,debug_on=True):
+ def __init__(self,name,has_oled_board=True,i2c_freq=Rig.DEFAULT_I2C_FREQUENCY,finish_button="C",start_verbose=True,apply_bst=True,debug_on=True,loop_period=0):
   if not debug_on:
    esp.osdebug(None) 
   self.start_verbose=start_verbose
@@ -71,32 +114,30 @@ class IoTApp:
   self.passkey=""
   self.auto_connect=False
   self.wait_time=0
+  self.wifi_manager=None
   self.rtc=RTC()
+  self.timestamps=Timestamps(self.rtc)
   self.mqtt_id="{0}_{1}".format("".join(self.name.split()),self.rig.id)
   self.mqtt_client=None
   self.exit_code=0
   self.run_state=RunStates.NOT_STARTED
+  self.loop_period=loop_period
+  self.periodic_tasks=[]
+  self.task_queue=[]
+  self.task_sequence=0
+  self.clock_ticks=ticks_ms()
+  self.clock_ms=0
  def connect_to_wifi(self,wifi_settings=None,connect_now=False):
   if wifi_settings:
    self.ssid,self.passkey,self.auto_connect,self.wait_time=wifi_settings
   if self.auto_connect or connect_now:
    if not self.wifi:
     self.wifi=network.WLAN(network.STA_IF)
-   if not self.wifi.active():
-    self.wifi.active(True)
-   if self.wifi.isconnected(): 
-    self.wifi.disconnect()
-   if not self.wait_time>0: 
-    self.wifi.connect(self.ssid,self.passkey)
-    while not self.wifi.isconnected():
-     sleep(0.1)
-   else:
-    wait_end=ticks_ms()+self.wait_time 
-    self.wifi.connect(self.ssid,self.passkey)
-    while not self.wifi.isconnected()and(ticks_ms()<wait_end):
-     sleep(0.1)
-    if not self.wifi.isconnected():
-     self.wifi.active(False) 
+   if not self.wifi_manager:
+    self.wifi_manager=WiFiManager(self.wifi)
+    self.wifi_manager.add_listener(self.wifi_state_handler)
+    self.every(self._WIFI_POLL_PERIOD,self.wifi_manager.poll,name="wifi")
+   self.wifi_manager.connect(self.ssid,self.passkey,self.wait_time)
  def run(self):
   try:
    self.run_state=RunStates.STARTING
@@ -104,8 +145,7 @@ class IoTApp:
    self.run_state=RunStates.INITIALISING
    self.init()
    self.run_state=RunStates.LOOPING
-   while not self.finished:
-    self.loop()
+   self.run_loop()
    self.run_state=RunStates.DEINITIALISING
    self.deinit()
    self.run_state=RunStates.SHUTTING_DOWN
@@ -116,6 +156,69 @@ class IoTApp:
    if self.run_state<RunStates.SHUTTING_DOWN:
     self.rig.deinit()
     print("\nTerminated with code: {0} <ERROR>".format(self.exit_code))
+ def run_loop(self):
+  self.schedule_loop()
+  while not self.finished:
+   if self.loop_period>0:
+    wait=self.time_to_next_task()
+    if wait:
+     sleep_ms(wait)
+   else:
+    self.loop()
+   self.run_due_tasks()
+ def schedule_loop(self):
+  if self.loop_period>0:
+   self._add_task(PeriodicTask(self.loop_period,self.loop,name="loop"),self._clock())
+ def every(self,period,callback,priority=0,catch_up=False,name=None):
+  task=PeriodicTask(period,callback,priority,catch_up,name or "task-{0}".format(len(self.periodic_tasks)+1))
+  self._add_task(task,self._clock()+period)
+  return task
+ def _add_task(self,task,deadline):
+  self.periodic_tasks.append(task)
+  self._queue_task(task,deadline)
+ def _queue_task(self,task,deadline):
+  task.deadline=deadline
+  self.task_sequence+=1
+  heapq.heappush(self.task_queue,(deadline,-task.priority,self.task_sequence,task))
+ def _clock(self):
+  now=ticks_ms()
+  self.clock_ms+=ticks_diff(now,self.clock_ticks)
+  self.clock_ticks=now
+  return self.clock_ms
+ def time_to_next_task(self):
+  while self.task_queue and self.task_queue[0][3].cancelled:
+   heapq.heappop(self.task_queue)
+  if not self.task_queue:
+   return None
+  return max(self.task_queue[0][0]-self._clock(),0)
+ def run_due_tasks(self):
+  now=self._clock()
+  due=[]
+  while self.task_queue and self.task_queue[0][0]<=now:
+   entry=heapq.heappop(self.task_queue)
+   if not entry[3].cancelled:
+    due.append(entry)
+  due.sort(key=lambda entry:(entry[1],entry[0]))
+  for deadline,priority,sequence,task in due:
+   if self.finished:
+    self._queue_task(task,deadline)
+    continue
+   start=self._clock()
+   task.max_lateness=max(task.max_lateness,start-deadline)
+   task.callback()
+   end=self._clock()
+   task.runs+=1
+   task.total_time+=end-start
+   task.max_time=max(task.max_time,end-start)
+   deadline+=task.period
+   if deadline<=end:
+    task.overruns+=1
+    if not task.catch_up:
+     missed=(end-deadline)//task.period+1
+     task.skipped+=missed
+     deadline+=missed*task.period
+   if not task.cancelled:
+    self._queue_task(task,deadline)
  def startup(self):
   if self.rig.has_oled_board():
    if self.start_verbose:
@@ -189,7 +292,11 @@ class IoTApp:
   pass
  def btnC_handler(self,pin):
   pass
+ def wifi_state_handler(self,old_state,new_state):
+  pass
  def is_wifi_connected(self):
+  if self.wifi_manager:
+   return self.wifi_manager.is_connected()
   if self.wifi:
    return self.wifi.isconnected()
   return False
@@ -197,7 +304,9 @@ class IoTApp:
   if self.wifi:
    self.wifi.active(True)
  def wifi_deactivate(self):
-  if self.wifi:
+  if self.wifi_manager:
+   self.wifi_manager.stop()
+  elif self.wifi:
    if self.wifi.isconnected():
     self.wifi.disconnect()
     self.wifi.active(False)
@@ -246,9 +355,11 @@ class IoTApp:
       tm=localtime(t+self._BST_INCREMENT)
     tm=tm[0:3]+(0,)+tm[3:6]+(0,)
     self.rtc.datetime(tm)
+    self.timestamps.invalidate()
     return True
    return False
   self.rtc.datetime(datetime) 
+  self.timestamps.invalidate()
   return True
  def set_rtc_by_ntp(self,ntp_ip,ntp_port,ntp_timeout=_NTP_DEFAULT_TIMEOUT):
   return self._set_rtc(ntp_ip,ntp_port,ntp_timeout)
@@ -257,13 +368,15 @@ class IoTApp:
  def reset_rtc(self):
   return self._set_rtc()
  def register_to_mqtt(self,server,port=0,last_will=None,sub_callback=None,user=None,password=None,keepalive=0,ssl=False,ssl_params={}):
-  self.mqtt_client=MQTTClientEx(client_id=self.mqtt_id,server=server,port=port,user=user,password=password,keepalive=keepalive,ssl=ssl,ssl_params=ssl_params)
+  self.mqtt_client=None
+  mqtt_client=MQTTClientEx(client_id=self.mqtt_id,server=server,port=port,user=user,password=password,keepalive=keepalive,ssl=ssl,ssl_params=ssl_params)
   if last_will:
    topic,msg=last_will
-   self.mqtt_client.set_last_will(topic,msg)
+   mqtt_client.set_last_will(topic,msg)
   if sub_callback:
-   self.mqtt_client.set_callback(sub_callback)
-  self.mqtt_client.connect()
+   mqtt_client.set_callback(sub_callback)
+  mqtt_client.connect()
+  self.mqtt_client=mqtt_client
  def init(self):
   pass
  def loop(self):
@@ -273,10 +386,74 @@ class IoTApp:
  def shutdown(self):
   if self.mqtt_client:
    self.mqtt_client.disconnect()
-  if self.wifi:
+  if self.wifi_manager:
+   self.wifi_manager.stop()
+  elif self.wifi:
    if self.wifi.isconnected():
     self.wifi.disconnect()
    self.wifi.active(False)
   self.rig.deinit()
   esp.osdebug(0)
+  for task in self.periodic_tasks:
+   print("\nTask {0}: {1} runs, {2} overruns, {3} skipped, max late {4}ms, ave {5:.1f}ms, max {6}ms".format(task.name,task.runs,task.overruns,task.skipped,task.max_lateness,task.average_time(),task.max_time))
   print("\nTerminated with code: {0} <OK>".format(self.exit_code))
+class AsyncIoTApp(IoTApp):
+ _FINISH_CHECK_PERIOD=100
+ _MQTT_CHECK_PERIOD=100
+ def __init__(self,*args,**kwargs):
+  if not asyncio:
+   raise ImportError("AsyncIoTApp requires uasyncio")
+  super().__init__(*args,**kwargs)
+  self.task_error=None
+ def run_loop(self):
+  self.schedule_loop()
+  _async_run(self._run_tasks())
+  if self.task_error:
+   raise self.task_error
+ async def _run_tasks(self):
+  tasks=[_async_create_task(self._guard(coroutine))for coroutine in self.tasks()]
+  while not self.finished:
+   await asyncio.sleep_ms(self._FINISH_CHECK_PERIOD)
+  for task in tasks:
+   _async_cancel(task)
+  await asyncio.sleep_ms(0)
+ async def _guard(self,coroutine):
+  try:
+   await coroutine
+  except asyncio.CancelledError:
+   pass
+  except Exception as ex:
+   self.task_error=ex
+   self.finish()
+ def tasks(self):
+  tasks=[self.periodic_task(),self.mqtt_task(self._MQTT_CHECK_PERIOD)]
+  if self.loop_period<=0:
+   tasks.append(self.loop_task())
+  return tasks
+ async def loop_task(self):
+  while not self.finished:
+   self.loop()
+   await asyncio.sleep_ms(0)
+ async def periodic_task(self):
+  while not self.finished:
+   self.run_due_tasks()
+   wait=self.time_to_next_task()
+   await asyncio.sleep_ms(self._FINISH_CHECK_PERIOD if wait is None else min(wait,self._FINISH_CHECK_PERIOD))
+ async def repeat_task(self,period,callback):
+  deadline=ticks_ms()
+  while not self.finished:
+   callback()
+   deadline=ticks_add(deadline,period)
+   wait=ticks_diff(deadline,ticks_ms())
+   if wait<0:
+    deadline=ticks_add(deadline,(-wait//period+1)*period)
+    wait=ticks_diff(deadline,ticks_ms())
+   await asyncio.sleep_ms(max(wait,0))
+ async def mqtt_task(self,period=_MQTT_CHECK_PERIOD):
+  while not self.finished:
+   if self.mqtt_client and self.is_wifi_connected():
+    try:
+     self.mqtt_client.check_msg()
+    except OSError:
+     self.mqtt_client=None
+   await asyncio.sleep_ms(period)
@@ -0,0 +1,46 @@
+import ustruct as struct
+from time import time
+MAGIC=b"PPWB"
+VERSION=1
+HEADER_FORMAT="<4sBB16s"
+RECORD_FORMAT="<IhHBB"
+RECORD_SIZE=struct.calcsize(RECORD_FORMAT)
+READING=0
+ACCESS_STARTED=1
+ACCESS_STOPPED=2
+STAFF=3
+NO_STAFF="None"
+MAX_STAFF=255 
+class RecordLog:
+ def __init__(self,writer,rig_id=""):
+  self.writer=writer
+  self.rig_id=rig_id
+  self.record=bytearray(RECORD_SIZE)
+  self.start()
+ def start(self):
+  self.staff={NO_STAFF:0}
+  header=bytearray(struct.calcsize(HEADER_FORMAT))
+  struct.pack_into(HEADER_FORMAT,header,0,MAGIC,VERSION,RECORD_SIZE,self.rig_id.encode())
+  self.writer.write(header)
+ def _write(self,epoch,value_1,value_2,staff_index,kind):
+  struct.pack_into(RECORD_FORMAT,self.record,0,time()if epoch is None else epoch,value_1,value_2,staff_index,kind)
+  self.writer.write(self.record)
+ def staff_index(self,staff):
+  index=self.staff.get(staff)
+  if index is None:
+   if len(self.staff)>MAX_STAFF:
+    return 0
+   index=len(self.staff)
+   self.staff[staff]=index
+   name=staff.encode()
+   self._write(0,0,len(name),index,STAFF)
+   padded=bytearray(((len(name)+RECORD_SIZE-1)//RECORD_SIZE)*RECORD_SIZE)
+   padded[0:len(name)]=name
+   self.writer.write(padded)
+  return index
+ def access_started(self,staff=NO_STAFF,epoch=None):
+  self._write(epoch,0,0,self.staff_index(staff),ACCESS_STARTED)
+ def reading(self,temp,humidity,staff=NO_STAFF,epoch=None):
+  self._write(epoch,int(round(temp*100)),int(round(humidity*100)),self.staff_index(staff),READING)
+ def access_stopped(self,period_length,epoch=None):
+  self._write(epoch,0,min(period_length,0xffff),0,ACCESS_STOPPED)
@@ -0,0 +1,64 @@
+import os
+class RotatingLog:
+ DEFAULT_SEGMENT_SIZE=64*1024 
+ DEFAULT_SEGMENT_COUNT=8
+ def __init__(self,base_name,extension,segment_size=DEFAULT_SEGMENT_SIZE,segment_count=DEFAULT_SEGMENT_COUNT):
+  self.base_name=base_name
+  self.extension=extension
+  self.segment_size=segment_size
+  self.segment_count=max(segment_count,1)
+  self.index_name="{0}.idx".format(base_name)
+  self.file=None
+  self.size=0
+  self.sequences=self._read_index()
+  self.rotate()
+ def segment_name(self,sequence):
+  return "{0}.{1:05d}{2}".format(self.base_name,sequence,self.extension)
+ def _read_index(self):
+  try:
+   with open(self.index_name,"r")as file:
+    return [int(line)for line in file.read().split()]
+  except(OSError,ValueError):
+   pass
+  prefix=self.base_name+"."
+  sequences=[]
+  for name in os.listdir():
+   if name.startswith(prefix)and name.endswith(self.extension):
+    try:
+     sequences.append(int(name[len(prefix):len(name)-len(self.extension)]))
+    except ValueError:
+     pass
+  sequences.sort()
+  return sequences
+ def _write_index(self):
+  temp_name=self.index_name+".tmp"
+  with open(temp_name,"w")as file:
+   file.write("\n".join(str(sequence)for sequence in self.sequences))
+  try:
+   os.remove(self.index_name)
+  except OSError:
+   pass
+  os.rename(temp_name,self.index_name)
+ def rotation_due(self):
+  return self.size>=self.segment_size
+ def rotate(self):
+  if self.file:
+   self.file.close()
+  self.sequences.append(self.sequences[-1]+1 if self.sequences else 1)
+  while len(self.sequences)>self.segment_count:
+   try:
+    os.remove(self.segment_name(self.sequences.pop(0)))
+   except OSError:
+    pass
+  self._write_index()
+  self.file=open(self.segment_name(self.sequences[-1]),"ab")
+  self.size=0
+ def write(self,data):
+  self.file.write(data)
+  self.size+=len(data)
+ def flush(self):
+  self.file.flush()
+ def close(self):
+  if self.file:
+   self.file.close()
+   self.file=None
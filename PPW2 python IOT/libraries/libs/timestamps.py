@@ -0,0 +1,38 @@
+from time import ticks_ms,ticks_diff,ticks_add
+class Timestamps:
+ def __init__(self,rtc):
+  self.rtc=rtc
+  self.datetime=None 
+  self.next_ticks=0 
+  self._date=None
+  self._time=None
+  self._timestamp=None
+ def invalidate(self):
+  self.datetime=None
+ def refresh(self):
+  now=ticks_ms()
+  if self.datetime is None or ticks_diff(now,self.next_ticks)>=0:
+   self.datetime=self.rtc.datetime()
+   self.next_ticks=ticks_add(now,1001-self.datetime[7]//1000)
+   self._date=None
+   self._time=None
+   self._timestamp=None
+  return self.datetime
+ @property
+ def date(self):
+  datetime=self.refresh()
+  if self._date is None:
+   self._date="{0}/{1}/{2}".format(datetime[2],datetime[1],datetime[0])
+  return self._date
+ @property
+ def time(self):
+  datetime=self.refresh()
+  if self._time is None:
+   self._time="{0}:{1}:{2}".format(datetime[4],datetime[5],datetime[6])
+  return self._time
+ @property
+ def timestamp(self):
+  datetime=self.refresh()
+  if self._timestamp is None:
+   self._timestamp="{0}-{1}-{2}|{3}:{4}:{5}".format(datetime[0],datetime[1],datetime[2],datetime[4],datetime[5],datetime[6])
+  return self._timestamp
@@ -0,0 +1,69 @@
+from time import ticks_ms,ticks_diff
+class WiFiStates:
+ IDLE=1
+ CONNECTING=2
+ CONNECTED=3
+ BACKOFF=4
+class WiFiManager:
+ def __init__(self,wlan,connect_timeout=10000,backoff_min=1000,backoff_max=60000):
+  self.wlan=wlan
+  self.ssid=""
+  self.passkey=""
+  self.connect_timeout=connect_timeout
+  self.backoff_min=backoff_min
+  self.backoff_max=backoff_max
+  self.backoff=0
+  self.failures=0
+  self.state=WiFiStates.IDLE
+  self.state_ticks=ticks_ms()
+  self.listeners=[]
+ def add_listener(self,callback):
+  self.listeners.append(callback)
+ def is_connected(self):
+  return self.state==WiFiStates.CONNECTED and self.wlan.isconnected()
+ def connect(self,ssid=None,passkey=None,connect_timeout=None):
+  if ssid is not None:
+   self.ssid=ssid
+  if passkey is not None:
+   self.passkey=passkey
+  if connect_timeout is not None:
+   self.connect_timeout=connect_timeout
+  self.failures=0
+  self._attempt()
+ def stop(self):
+  if self.wlan.active():
+   if self.wlan.isconnected():
+    self.wlan.disconnect()
+   self.wlan.active(False)
+  self._set_state(WiFiStates.IDLE)
+ def poll(self):
+  if self.state==WiFiStates.CONNECTING:
+   if self.wlan.isconnected():
+    self.failures=0
+    self._set_state(WiFiStates.CONNECTED)
+   elif self.connect_timeout>0 and ticks_diff(ticks_ms(),self.state_ticks)>=self.connect_timeout:
+    self.wlan.disconnect()
+    self.backoff=min(self.backoff_min<<min(self.failures,16),self.backoff_max)
+    self.failures+=1
+    self._set_state(WiFiStates.BACKOFF)
+  elif self.state==WiFiStates.CONNECTED:
+   if not self.wlan.isconnected():
+    self._attempt()
+  elif self.state==WiFiStates.BACKOFF:
+   if ticks_diff(ticks_ms(),self.state_ticks)>=self.backoff:
+    self._attempt()
+  return self.state
+ def _attempt(self):
+  if not self.wlan.active():
+   self.wlan.active(True)
+  if self.wlan.isconnected():
+   self.wlan.disconnect()
+  self.wlan.connect(self.ssid,self.passkey)
+  self._set_state(WiFiStates.CONNECTING)
+ def _set_state(self,state):
+  old_state=self.state
+  self.state=state
+  self.state_ticks=ticks_ms()
+  if state!=old_state:
+   for callback in self.listeners:
+    callback(old_state,state)
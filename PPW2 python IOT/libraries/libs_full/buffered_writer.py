@@ -0,0 +1,95 @@
+"""
+Author: Arben Durmishllari
+Date: May 2019
+Copyright: University of Sunderland, (c) 2019
+File: buffered_writer.py
+Version: 1.0.0
+Notes: Buffered, batched line writer for logging to the ESP32's flash file system, formatted lines are
+       accumulated in a preallocated bytearray and only written to the file when the buffer fills, when the
+       oldest buffered line reaches a maximum age or when a flush is requested (e.g. at the end of an access
+       period), so one flash write covers many readings while no more than max_age seconds of data can be lost
+"""
+from time import ticks_ms, ticks_diff
+
+
+class BufferedWriter:
+    """
+    Line writer that batches writes to a file through a fixed size in-memory buffer
+    """
+    DEFAULT_BUFFER_SIZE = 4096  # Bytes, a multiple of the flash file system block size
+    DEFAULT_MAX_AGE = 10  # Seconds a buffered line may wait before the buffer is flushed
+
+    def __init__(self, file, mode="wb", buffer_size=DEFAULT_BUFFER_SIZE, max_age=DEFAULT_MAX_AGE):
+        # Either the name of a file to open with the given mode or an already open file like object (such as a
+        # RotatingLog) with write(), flush() and close() methods
+        self.file = open(file, mode) if isinstance(file, str) else file
+        
+        # The buffer is allocated once and reused, lines are copied into it through a memoryview so no
+        # intermediate objects are created per write
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.max_age_ms = max_age * 1000
+        self.first_ticks = 0  # ticks_ms() value when the oldest buffered line was written
+        
+        # Set by request_flush(), which only sets this flag so it is safe to call from a button handler
+        self.flush_requested = False
+        
+        # Counters of the number of file writes made and the bytes written
+        self.flush_count = 0
+        self.bytes_written = 0
+        
+    def write(self, line):
+        """
+        Buffer a line (str or bytes), the buffer is flushed first if the line does not fit, a line larger than
+        the whole buffer is written straight through to the file
+        """
+        data = line.encode() if isinstance(line, str) else line
+        size = len(data)
+        if self.length + size > len(self.buffer):
+            self.flush()
+            
+        if size > len(self.buffer):
+            self.file.write(data)
+            self.file.flush()
+            self.flush_count += 1
+            self.bytes_written += size
+            return
+            
+        if not self.length:
+            self.first_ticks = ticks_ms()
+        self.view[self.length:self.length + size] = data
+        self.length += size
+        
+    def request_flush(self):
+        """
+        Ask for the buffer to be flushed on the next call to poll()
+        """
+        self.flush_requested = True
+        
+    def poll(self):
+        """
+        Flush the buffer if a flush has been requested or the oldest buffered line has reached the maximum age,
+        should be called regularly (e.g. once each time around the app loop)
+        """
+        if self.flush_requested or (self.length and ticks_diff(ticks_ms(), self.first_ticks) >= self.max_age_ms):
+            self.flush()
+        
+    def flush(self):
+        """
+        Write any buffered lines to the file as a single write
+        """
+        self.flush_requested = False
+        if self.length:
+            self.file.write(self.view[:self.length])
+            self.file.flush()
+            self.flush_count += 1
+            self.bytes_written += self.length
+            self.length = 0
+            
+    def close(self):
+        """
+        Flush any buffered lines and close the file
+        """
+        self.flush()
+        self.file.close()
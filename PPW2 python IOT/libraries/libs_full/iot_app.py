@@ -13,10 +13,53 @@ import network
 import esp
 import socket
 import struct
-from time import sleep, ticks_ms, localtime
+from time import sleep, sleep_ms, ticks_ms, ticks_add, ticks_diff, localtime
 from machine import RTC
 from libs.mqtt_simple_ex import MQTTClientEx
 from libs.proto_rig import ProtoRig as Rig
+from libs.timestamps import Timestamps
+from libs.wifi_manager import WiFiManager
+
+try:
+    import uheapq as heapq
+except ImportError:
+    import heapq
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    asyncio = None  # Only needed by the AsyncIoTApp
+
+
+def _async_run(coroutine):
+    """
+    Run a coroutine to completion on uasyncio, the esp32 firmware ships uasyncio v2 which has no run() and
+    has the event loop run it instead
+    """
+    if hasattr(asyncio, "run"):
+        return asyncio.run(coroutine)
+        
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+    
+    
+def _async_create_task(coroutine):
+    """
+    Schedule a coroutine to run concurrently, returns the handle to pass to _async_cancel(), uasyncio v2 has no
+    Task objects so under it the handle is the coroutine itself
+    """
+    if hasattr(asyncio, "create_task"):
+        return asyncio.create_task(coroutine)
+        
+    asyncio.get_event_loop().create_task(coroutine)
+    
+    return coroutine
+    
+    
+def _async_cancel(task):
+    if hasattr(task, "cancel"):
+        task.cancel()
+    else:
+        asyncio.cancel(task)  # uasyncio v2 cancels the coroutine itself
 
 
 class RunStates:
@@ -28,9 +71,45 @@ class RunStates:
     SHUTTING_DOWN = 6
     
     
+class PeriodicTask:
+    """
+    A callback registered with IoTApp.every() to be called once every period milliseconds, together with its timing
+    statistics, deadlines are kept on a fixed grid of whole periods from the first so the task never drifts
+    """
+    def __init__(self, period, callback, priority=0, catch_up=False, name=None):
+        self.period = period
+        self.callback = callback
+        
+        # When several tasks are due at once the task with the highest priority is called first
+        self.priority = priority
+        
+        # After an overrun (the task's next deadline has passed by the time it has been called) a catch up
+        # task is called again straight away for each deadline it missed, otherwise the missed deadlines are
+        # skipped and the task is next called at its first deadline still to come
+        self.catch_up = catch_up
+        
+        self.name = name
+        self.deadline = 0
+        self.cancelled = False
+        
+        # Timing statistics, times are in milliseconds
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_lateness = 0  # Longest time between a deadline and the task being called
+        self.total_time = 0
+        self.max_time = 0
+        
+    def cancel(self):
+        self.cancelled = True
+        
+    def average_time(self):
+        return self.total_time / self.runs if self.runs else 0
+        
+        
 class IoTApp:
-    # Default value for sleep period (in seconds) set at 100ms
-    _DEFAULT_LOOP_SLEEP_TIME = 0.1
+    # Period in milliseconds at which the WIFI connection manager is advanced
+    _WIFI_POLL_PERIOD = 250
 
     # RTC related constants. BST dates are a directory of {year : (March day number, October day number)} and go
     # across years 2017 - 2030
@@ -51,7 +130,7 @@ class IoTApp:
     _BST_INCREMENT = 3600  # Add 60 * 60 seconds for 1 hour increment during BST
     
     def __init__(self, name, has_oled_board=True, i2c_freq=Rig.DEFAULT_I2C_FREQUENCY, finish_button="C",
-                 start_verbose=True, apply_bst=True, debug_on=True):
+                 start_verbose=True, apply_bst=True, debug_on=True, loop_period=0):
         # Controls debug messages from the ESP32 operating system, they are on by default 
         if not debug_on:
             esp.osdebug(None)  # Switches off debug messages
@@ -121,9 +200,16 @@ class IoTApp:
         self.auto_connect = False
         self.wait_time = 0
         
+        # WIFI connection manager, created by the first connection attempt and then advanced by a periodic task
+        self.wifi_manager = None
+        
         # Instantiate the real-time clock (RTC), this will initialise the date time to the base value
         # of 00:00:00:00 01-01-2000 (ms:seconds:minutes:hours day-month-year)
         self.rtc = RTC()
+        
+        # Shared, per second cache of the RTC's date and time and the timestamp strings used for logging,
+        # use this rather than reading and formatting the RTC for each reading
+        self.timestamps = Timestamps(self.rtc)
 
         # Allocate the MQTT client identifier based on the name of the app and the identifier of the
         # ESP32 MCU device, note all whitespace is removed from the app name
@@ -140,6 +226,21 @@ class IoTApp:
         # Current state of the run time life cycle of the app, this can be one of the values from the
         # RunStates enumeration class and changes as the app progresses
         self.run_state = RunStates.NOT_STARTED
+        
+        # Period in milliseconds at which the loop() method is called, loop() is then run as a periodic task
+        # (see every()) so the period does not drift with the time taken by loop() itself and the app sleeps
+        # until the next deadline, a period of 0 or less calls loop() back to back as soon as the previous call
+        # returns
+        self.loop_period = loop_period
+        
+        # Periodic tasks registered with every(), the queue is a heap of (deadline, -priority, sequence
+        # number, task) tuples ordered by deadline, deadlines are milliseconds on the app's own clock (see
+        # _clock()) rather than raw ticks_ms() values so that they keep their order when ticks_ms() wraps
+        self.periodic_tasks = []
+        self.task_queue = []
+        self.task_sequence = 0
+        self.clock_ticks = ticks_ms()
+        self.clock_ms = 0
 
     def connect_to_wifi(self, wifi_settings=None, connect_now=False):
         """
@@ -149,13 +250,16 @@ class IoTApp:
             ssid:           SSID of access point to connect to
             passkey:        Passkey of access point to connect to (assuming WPA2-PSK authentication)
             auto_connect:   True if connection should be made immediately
-            wait_time:      Number of milliseconds to wait whilst attempting to connect, once this wait
-                            time has passed the connection attempt is aborted, a wait time of 0 or less
-                            indicates an indefinite wait time (i.e. continue to attempt to connect until
-                            a connection is made), minimum wait time is 101ms as there is already a
-                            100ms wait each time around the connection check loop
+            wait_time:      Number of milliseconds to wait for each connection attempt, once this wait
+                            time has passed the attempt is abandoned and retried after a backoff that
+                            doubles with each failure, a wait time of 0 or less indicates an indefinite
+                            wait time (i.e. a single attempt that continues until a connection is made)
         If not WIFI settings are provided then use the existing settings, the connect_now parameter
         can be used to force a connection attempt irrespective of the value of auto_connect property
+        
+        The connection is not waited for, the attempt is advanced by a periodic task whilst the app
+        loops, wifi_state_handler() is called on each change of the connection state and the
+        is_wifi_connected() method reports whether the connection has been made
         """
         if wifi_settings:
             self.ssid, self.passkey, self.auto_connect, self.wait_time = wifi_settings
@@ -164,24 +268,12 @@ class IoTApp:
             if not self.wifi:
                 self.wifi = network.WLAN(network.STA_IF)
             
-            if not self.wifi.active():
-                self.wifi.active(True)
-
-            if self.wifi.isconnected():  # If already connected then disconnect first
-                self.wifi.disconnect()
+            if not self.wifi_manager:
+                self.wifi_manager = WiFiManager(self.wifi)
+                self.wifi_manager.add_listener(self.wifi_state_handler)
+                self.every(self._WIFI_POLL_PERIOD, self.wifi_manager.poll, name="wifi")
                 
-            if not self.wait_time > 0:  # Try to connect indefinitely
-                self.wifi.connect(self.ssid, self.passkey)
-                while not self.wifi.isconnected():
-                    sleep(0.1)
-            else:
-                wait_end = ticks_ms() + self.wait_time  # Try to connect within wait_time milliseconds
-                self.wifi.connect(self.ssid, self.passkey)
-                while not self.wifi.isconnected() and (ticks_ms() < wait_end):
-                    sleep(0.1)
-                    
-                if not self.wifi.isconnected():
-                    self.wifi.active(False)  # Still not connected after wait_time so deactivate WIFI
+            self.wifi_manager.connect(self.ssid, self.passkey, self.wait_time)
         
     def run(self):
         try:
@@ -193,8 +285,7 @@ class IoTApp:
             self.init()
             
             self.run_state = RunStates.LOOPING
-            while not self.finished:
-                self.loop()
+            self.run_loop()
             
             self.run_state = RunStates.DEINITIALISING
             self.deinit()
@@ -217,6 +308,106 @@ class IoTApp:
                 # Print details of app completion to the connected console 
                 print("\nTerminated with code: {0} <ERROR>".format(self.exit_code))
         
+    def run_loop(self):
+        """
+        Looping part of the run time life cycle, calls loop() and the due periodic tasks until the finished
+        property is True, sleeping until the next deadline whenever loop() is itself a periodic task
+        """
+        self.schedule_loop()
+        while not self.finished:
+            if self.loop_period > 0:
+                wait = self.time_to_next_task()
+                if wait:
+                    sleep_ms(wait)
+            else:
+                self.loop()
+            self.run_due_tasks()
+            
+    def schedule_loop(self):
+        """
+        Register loop() as a periodic task, due straight away, if the app has a loop period
+        """
+        if self.loop_period > 0:
+            self._add_task(PeriodicTask(self.loop_period, self.loop, name="loop"), self._clock())
+        
+    def every(self, period, callback, priority=0, catch_up=False, name=None):
+        """
+        Register a callback (taking no arguments) to be called once every period milliseconds whilst the app
+        loops, first one period from now, see PeriodicTask for the meaning of priority and catch_up, returns
+        the PeriodicTask, which can be cancelled with its cancel() method
+        """
+        task = PeriodicTask(period, callback, priority, catch_up,
+                            name or "task-{0}".format(len(self.periodic_tasks) + 1))
+        self._add_task(task, self._clock() + period)
+        
+        return task
+        
+    def _add_task(self, task, deadline):
+        self.periodic_tasks.append(task)
+        self._queue_task(task, deadline)
+        
+    def _queue_task(self, task, deadline):
+        task.deadline = deadline
+        self.task_sequence += 1
+        heapq.heappush(self.task_queue, (deadline, -task.priority, self.task_sequence, task))
+        
+    def _clock(self):
+        """
+        Returns the milliseconds since the app was constructed, this does not wrap like ticks_ms() as long as it
+        is called at least once every few days
+        """
+        now = ticks_ms()
+        self.clock_ms += ticks_diff(now, self.clock_ticks)
+        self.clock_ticks = now
+        
+        return self.clock_ms
+        
+    def time_to_next_task(self):
+        """
+        Returns the milliseconds until the next periodic task is due (0 if one is already due), None if there
+        are no periodic tasks
+        """
+        while self.task_queue and self.task_queue[0][3].cancelled:
+            heapq.heappop(self.task_queue)
+        if not self.task_queue:
+            return None
+            
+        return max(self.task_queue[0][0] - self._clock(), 0)
+        
+    def run_due_tasks(self):
+        """
+        Call every periodic task that is due, highest priority first, and queue each at its next deadline
+        """
+        now = self._clock()
+        due = []
+        while self.task_queue and self.task_queue[0][0] <= now:
+            entry = heapq.heappop(self.task_queue)
+            if not entry[3].cancelled:
+                due.append(entry)
+        due.sort(key=lambda entry: (entry[1], entry[0]))
+        
+        for deadline, priority, sequence, task in due:
+            if self.finished:
+                self._queue_task(task, deadline)
+                continue
+            start = self._clock()
+            task.max_lateness = max(task.max_lateness, start - deadline)
+            task.callback()
+            end = self._clock()
+            task.runs += 1
+            task.total_time += end - start
+            task.max_time = max(task.max_time, end - start)
+            
+            deadline += task.period
+            if deadline <= end:
+                task.overruns += 1
+                if not task.catch_up:
+                    missed = (end - deadline) // task.period + 1
+                    task.skipped += missed
+                    deadline += missed * task.period
+            if not task.cancelled:
+                self._queue_task(task, deadline)
+        
     def startup(self):
         if self.rig.has_oled_board():
             if self.start_verbose:
@@ -312,8 +503,17 @@ class IoTApp:
         
     def btnC_handler(self, pin):
         pass
+        
+    def wifi_state_handler(self, old_state, new_state):
+        """
+        Called on each change of the WIFI connection state (see WiFiStates in libs/wifi_manager.py), e.g.
+        to register to an MQTT broker once new_state is WiFiStates.CONNECTED
+        """
+        pass
 
     def is_wifi_connected(self):
+        if self.wifi_manager:
+            return self.wifi_manager.is_connected()
         if self.wifi:
             return self.wifi.isconnected()
             
@@ -324,7 +524,9 @@ class IoTApp:
             self.wifi.active(True)
         
     def wifi_deactivate(self):
-        if self.wifi:
+        if self.wifi_manager:
+            self.wifi_manager.stop()
+        elif self.wifi:
              if self.wifi.isconnected():
                 self.wifi.disconnect()
                 self.wifi.active(False)
@@ -394,11 +596,13 @@ class IoTApp:
                             
                 tm = tm[0:3] + (0,) + tm[3:6] + (0,)
                 self.rtc.datetime(tm)
+                self.timestamps.invalidate()
                 return True
             
             return False
             
         self.rtc.datetime(datetime)    
+        self.timestamps.invalidate()
         
         return True
         
@@ -422,16 +626,22 @@ class IoTApp:
     
     def register_to_mqtt(self, server, port=0, last_will=None, sub_callback=None, user=None, password=None,
                          keepalive=0, ssl=False, ssl_params={}):
-        self.mqtt_client = MQTTClientEx(client_id=self.mqtt_id, server=server, port=port, user=user,
-                                      password=password, keepalive=keepalive, ssl=ssl, ssl_params=ssl_params)
+        """
+        Connect to an MQTT broker, raises OSError if the broker cannot be reached, mqtt_client is only set once
+        the connection has been made so it is None after a failed attempt
+        """
+        self.mqtt_client = None
+        mqtt_client = MQTTClientEx(client_id=self.mqtt_id, server=server, port=port, user=user,
+                                   password=password, keepalive=keepalive, ssl=ssl, ssl_params=ssl_params)
         if last_will:
             topic, msg = last_will
-            self.mqtt_client.set_last_will(topic, msg)
+            mqtt_client.set_last_will(topic, msg)
             
         if sub_callback:
-            self.mqtt_client.set_callback(sub_callback)
+            mqtt_client.set_callback(sub_callback)
             
-        self.mqtt_client.connect()
+        mqtt_client.connect()
+        self.mqtt_client = mqtt_client
         
     def init(self):
         pass
@@ -448,7 +658,9 @@ class IoTApp:
             self.mqtt_client.disconnect()
             
         # Disconnect from WIFI if connected and deactivate the WIFI network
-        if self.wifi:
+        if self.wifi_manager:
+            self.wifi_manager.stop()
+        elif self.wifi:
             if self.wifi.isconnected():
                 self.wifi.disconnect()
             self.wifi.active(False)
@@ -460,5 +672,116 @@ class IoTApp:
         # is in case they have been switched off during construction
         esp.osdebug(0)
            
-        # Print details of app completion to the connected console 
+        # Print the timing statistics of any periodic tasks and details of app completion to the connected
+        # console 
+        for task in self.periodic_tasks:
+            print("\nTask {0}: {1} runs, {2} overruns, {3} skipped, max late {4}ms, ave {5:.1f}ms, max {6}ms".format(
+                task.name, task.runs, task.overruns, task.skipped, task.max_lateness, task.average_time(),
+                task.max_time))
         print("\nTerminated with code: {0} <OK>".format(self.exit_code))
+
+class AsyncIoTApp(IoTApp):
+    """
+    Variant of the IoTApp whose looping part of the run time life cycle is a set of coroutines run concurrently on
+    uasyncio rather than repeated calls of loop(), the startup(), init(), deinit() and shutdown() life cycle and the
+    RunStates are the same. Apps override the tasks() method to return their coroutines (e.g. one for sampling, one
+    for networking and one for the display), each should repeat until the finished property is True and await
+    between its steps (e.g. await asyncio.sleep_ms(100)) so that a slow step in one, such as a slow MQTT broker,
+    does not hold up the others. Both uasyncio v2 (as shipped with the esp32 firmware) and v3 are supported
+    """
+    # Period (in milliseconds) at which the finished property is checked whilst the tasks run
+    _FINISH_CHECK_PERIOD = 100
+    
+    # Period (in milliseconds) at which messages from the MQTT broker are checked for by the default tasks()
+    _MQTT_CHECK_PERIOD = 100
+    
+    def __init__(self, *args, **kwargs):
+        if not asyncio:
+            raise ImportError("AsyncIoTApp requires uasyncio")
+        super().__init__(*args, **kwargs)
+        
+        # Exception raised by one of the app's coroutines, this finishes the app and is raised again from run()
+        self.task_error = None
+        
+    def run_loop(self):
+        self.schedule_loop()
+        _async_run(self._run_tasks())
+        if self.task_error:
+            raise self.task_error
+        
+    async def _run_tasks(self):
+        tasks = [_async_create_task(self._guard(coroutine)) for coroutine in self.tasks()]
+        while not self.finished:
+            await asyncio.sleep_ms(self._FINISH_CHECK_PERIOD)
+            
+        # Cancel any coroutines that have not yet finished and give them the chance to do so
+        for task in tasks:
+            _async_cancel(task)
+        await asyncio.sleep_ms(0)
+        
+    async def _guard(self, coroutine):
+        try:
+            await coroutine
+        except asyncio.CancelledError:
+            pass
+        except Exception as ex:
+            self.task_error = ex
+            self.finish()
+            
+    def tasks(self):
+        """
+        Returns the list of coroutines to run concurrently until the app is finished, by default a coroutine that
+        calls the periodic tasks (including loop() if the app has a loop period), one that checks for messages
+        from the MQTT broker and, if the app has no loop period, one that calls loop() as often as possible
+        """
+        tasks = [self.periodic_task(), self.mqtt_task(self._MQTT_CHECK_PERIOD)]
+        if self.loop_period <= 0:
+            tasks.append(self.loop_task())
+            
+        return tasks
+        
+    async def loop_task(self):
+        while not self.finished:
+            self.loop()
+            await asyncio.sleep_ms(0)
+            
+    async def periodic_task(self):
+        """
+        Coroutine that calls the periodic tasks registered with every() as they fall due
+        """
+        while not self.finished:
+            self.run_due_tasks()
+            wait = self.time_to_next_task()
+            await asyncio.sleep_ms(self._FINISH_CHECK_PERIOD if wait is None else min(wait,
+                                                                                      self._FINISH_CHECK_PERIOD))
+            
+    async def repeat_task(self, period, callback):
+        """
+        Coroutine that calls a callback (taking no arguments) once every period milliseconds, on a fixed grid of
+        deadlines so it does not drift, deadlines already passed after an overrun are skipped, apps can include
+        this in the list returned by tasks() to give e.g. sampling or the display its own coroutine
+        """
+        deadline = ticks_ms()
+        while not self.finished:
+            callback()
+            deadline = ticks_add(deadline, period)
+            wait = ticks_diff(deadline, ticks_ms())
+            if wait < 0:
+                # Overrun, move on to the next deadline still to come
+                deadline = ticks_add(deadline, (-wait // period + 1) * period)
+                wait = ticks_diff(deadline, ticks_ms())
+            await asyncio.sleep_ms(max(wait, 0))
+            
+    async def mqtt_task(self, period=_MQTT_CHECK_PERIOD):
+        """
+        Coroutine that checks for messages from the MQTT broker (if registered and connected) every period
+        milliseconds, included in the default tasks(), if the connection to the broker drops mqtt_client is set to
+        None (rather than the error finishing the app) for the app to register to the broker again
+        """
+        while not self.finished:
+            if self.mqtt_client and self.is_wifi_connected():
+                try:
+                    self.mqtt_client.check_msg()
+                except OSError:
+                    self.mqtt_client = None
+            await asyncio.sleep_ms(period)
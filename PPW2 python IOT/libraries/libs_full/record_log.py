@@ -0,0 +1,106 @@
+"""
+Author: Arben Durmishllari
+Date: May 2019
+Copyright: University of Sunderland, (c) 2019
+File: record_log.py
+Version: 1.0.0
+Notes: Packed binary record log for access data, an alternative to the CSV text lines written by the rig, each
+       entry is a fixed size record packed with struct.pack_into into a single reusable buffer so logging a reading
+       allocates no strings, the log is decoded on the desktop by read_record_log() in DesktopApp.py
+       File layout (all little-endian):
+           header:  magic "PPWB", version, record size, rig id (16 bytes, NUL padded)
+           records: device epoch (seconds since 00:00:00 01-01-2000), value 1, value 2, staff index, kind
+       where the kind of each record gives the meaning of its values:
+           READING:         centi-degrees temperature (int16), centi-percent humidity (uint16)
+           ACCESS_STARTED:  unused, unused
+           ACCESS_STOPPED:  unused, period length in seconds (uint16)
+           STAFF:           unused, length of the staff id, the UTF-8 staff id follows in as many (NUL padded)
+                            records as it needs
+       Staff index 0 is always "None", other staff ids are given the next index the first time they are seen and
+       a STAFF record is written before they are first used
+"""
+import ustruct as struct
+from time import time
+
+MAGIC = b"PPWB"
+VERSION = 1
+HEADER_FORMAT = "<4sBB16s"
+RECORD_FORMAT = "<IhHBB"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Record kinds
+READING = 0
+ACCESS_STARTED = 1
+ACCESS_STOPPED = 2
+STAFF = 3
+
+NO_STAFF = "None"
+MAX_STAFF = 255  # Staff indexes are held in a single byte
+
+
+class RecordLog:
+    """
+    Writes access data as packed binary records to a BufferedWriter (or any object with a write() method that
+    copies the data it is given, such as a file opened in binary mode)
+    """
+    def __init__(self, writer, rig_id=""):
+        self.writer = writer
+        self.rig_id = rig_id
+        
+        # Every record is packed into this one buffer, the writer copies it on each write so it is safe to reuse
+        self.record = bytearray(RECORD_SIZE)
+        
+        self.start()
+        
+    def start(self):
+        """
+        Write the header and forget the staff ids written so far, called when the log is created and again at
+        the start of each new file (e.g. each segment of a RotatingLog) so that every file can be decoded alone
+        """
+        self.staff = {NO_STAFF: 0}
+        
+        header = bytearray(struct.calcsize(HEADER_FORMAT))
+        struct.pack_into(HEADER_FORMAT, header, 0, MAGIC, VERSION, RECORD_SIZE, self.rig_id.encode())
+        self.writer.write(header)
+        
+    def _write(self, epoch, value_1, value_2, staff_index, kind):
+        struct.pack_into(RECORD_FORMAT, self.record, 0, time() if epoch is None else epoch, value_1, value_2,
+                         staff_index, kind)
+        self.writer.write(self.record)
+        
+    def staff_index(self, staff):
+        """
+        Returns the index of a staff id, writing a STAFF record the first time a staff id is seen, staff ids after
+        the first MAX_STAFF are logged as "None"
+        """
+        index = self.staff.get(staff)
+        if index is None:
+            if len(self.staff) > MAX_STAFF:
+                return 0
+            index = len(self.staff)
+            self.staff[staff] = index
+            name = staff.encode()
+            self._write(0, 0, len(name), index, STAFF)
+            padded = bytearray(((len(name) + RECORD_SIZE - 1) // RECORD_SIZE) * RECORD_SIZE)
+            padded[0:len(name)] = name
+            self.writer.write(padded)
+            
+        return index
+        
+    def access_started(self, staff=NO_STAFF, epoch=None):
+        """
+        Log the start of an access period, epoch is the device time in seconds (the current time if None)
+        """
+        self._write(epoch, 0, 0, self.staff_index(staff), ACCESS_STARTED)
+        
+    def reading(self, temp, humidity, staff=NO_STAFF, epoch=None):
+        """
+        Log a temperature (degrees Celsius) and relative humidity (percentage) reading
+        """
+        self._write(epoch, int(round(temp * 100)), int(round(humidity * 100)), self.staff_index(staff), READING)
+        
+    def access_stopped(self, period_length, epoch=None):
+        """
+        Log the end of an access period and its length in seconds
+        """
+        self._write(epoch, 0, min(period_length, 0xffff), 0, ACCESS_STOPPED)
@@ -0,0 +1,114 @@
+"""
+Author: Arben Durmishllari
+Date: May 2019
+Copyright: University of Sunderland, (c) 2019
+File: rotating_log.py
+Version: 1.0.0
+Notes: Size capped rotating log for the ESP32's flash file system, a log is a set of at most segment_count
+       segment files (e.g. access_data.00012.csv) of around segment_size bytes each, listed oldest first by
+       sequence number in a small index file (e.g. access_data.idx), every session starts a new segment so the
+       segments of previous sessions survive a reboot, and once there are more than segment_count segments the
+       oldest is deleted, the current segment is kept open for appending and its size is counted as it is
+       written so appending never needs to list or stat a file
+"""
+import os
+
+
+class RotatingLog:
+    """
+    File like object (write(), flush() and close()) that appends to the newest segment of a rotating log
+    """
+    DEFAULT_SEGMENT_SIZE = 64 * 1024  # Bytes
+    DEFAULT_SEGMENT_COUNT = 8
+
+    def __init__(self, base_name, extension, segment_size=DEFAULT_SEGMENT_SIZE,
+                 segment_count=DEFAULT_SEGMENT_COUNT):
+        self.base_name = base_name
+        self.extension = extension
+        self.segment_size = segment_size
+        self.segment_count = max(segment_count, 1)
+        self.index_name = "{0}.idx".format(base_name)
+        self.file = None
+        self.size = 0
+        
+        # Sequence numbers of the segments, oldest first, the last one is the segment being written
+        self.sequences = self._read_index()
+        self.rotate()
+        
+    def segment_name(self, sequence):
+        return "{0}.{1:05d}{2}".format(self.base_name, sequence, self.extension)
+        
+    def _read_index(self):
+        """
+        Returns the sequence numbers listed in the index file, if the index file is missing or damaged then the
+        segment files themselves are listed instead
+        """
+        try:
+            with open(self.index_name, "r") as file:
+                return [int(line) for line in file.read().split()]
+        except (OSError, ValueError):
+            pass
+            
+        prefix = self.base_name + "."
+        sequences = []
+        for name in os.listdir():
+            if name.startswith(prefix) and name.endswith(self.extension):
+                try:
+                    sequences.append(int(name[len(prefix):len(name) - len(self.extension)]))
+                except ValueError:
+                    pass
+        sequences.sort()
+        
+        return sequences
+        
+    def _write_index(self):
+        """
+        Replace the index file, the new index is written to a temporary file first so a power cut leaves either
+        the old or the new index (or none, in which case the segments are listed on the next start)
+        """
+        temp_name = self.index_name + ".tmp"
+        with open(temp_name, "w") as file:
+            file.write("\n".join(str(sequence) for sequence in self.sequences))
+        try:
+            os.remove(self.index_name)
+        except OSError:
+            pass
+        os.rename(temp_name, self.index_name)
+        
+    def rotation_due(self):
+        """
+        Returns True once the current segment has reached its maximum size
+        """
+        return self.size >= self.segment_size
+        
+    def rotate(self):
+        """
+        Close the current segment (if any) and start a new one, deleting the oldest segments beyond the segment
+        count
+        """
+        if self.file:
+            self.file.close()
+            
+        self.sequences.append(self.sequences[-1] + 1 if self.sequences else 1)
+        while len(self.sequences) > self.segment_count:
+            try:
+                os.remove(self.segment_name(self.sequences.pop(0)))
+            except OSError:
+                pass
+        self._write_index()
+        
+        # Segments are opened in binary mode as they are written with the bytes batched up by a BufferedWriter
+        self.file = open(self.segment_name(self.sequences[-1]), "ab")
+        self.size = 0
+        
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        
+    def flush(self):
+        self.file.flush()
+        
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
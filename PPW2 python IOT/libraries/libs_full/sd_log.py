@@ -0,0 +1,239 @@
+"""
+Author: Arben Durmishllari
+Date: May 2019
+Copyright: University of Sunderland, (c) 2019
+File: sd_log.py
+Version: 1.0.0
+Notes: Append only log written straight to the blocks of an SD card with the SDCard driver (libs/sdcard.py), no
+       file system is used, data is batched into chunks of whole 512 byte blocks that are written with a single
+       multi-block (CMD25) write, two chunk buffers are preallocated so one is filled while the other is written
+       (by a background thread where _thread is available), which lets logging keep up with kilohertz sample rates
+       Card layout, starting at start_block (all little-endian):
+           blocks 0 and 1:  superblocks A and B, magic "PPWS", version, flags, generation, first data block, head
+                            block (the first block not yet written) and a CRC32 of these fields
+           blocks 2 onward: data blocks, each a header of payload length and flags followed by up to 508 bytes
+                            of log data, the payloads of the blocks in order form the log (the same bytes a
+                            BufferedWriter would have written to a file)
+       The superblocks are written alternately, each with the next generation number, and only after the data
+       blocks they cover, so after a power cut the valid superblock with the highest generation always points
+       to the end of completely written data, a partly filled block is never rewritten, the next write starts
+       at the following block, and the first block written by each session is flagged SESSION_START
+"""
+import ustruct as struct
+from binascii import crc32
+from time import ticks_ms, ticks_diff
+
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
+MAGIC = b"PPWS"
+VERSION = 1
+BLOCK_SIZE = 512
+SUPERBLOCK_FORMAT = "<4sHHIII"
+SUPERBLOCK_SIZE = struct.calcsize(SUPERBLOCK_FORMAT)
+BLOCK_HEADER_FORMAT = "<HH"
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_HEADER_FORMAT)
+PAYLOAD_SIZE = BLOCK_SIZE - BLOCK_HEADER_SIZE
+
+# Data block flags
+SESSION_START = 1
+
+
+class SDLog:
+    """
+    Log sink with the same write(), request_flush(), poll(), flush() and close() methods as BufferedWriter that
+    appends to an SD card's blocks rather than to a file
+    """
+    DEFAULT_CHUNK_BLOCKS = 8  # Blocks written by each multi-block write
+    DEFAULT_MAX_AGE = 10  # Seconds buffered data may wait before it is written
+
+    def __init__(self, sd, start_block=0, block_count=None, chunk_blocks=DEFAULT_CHUNK_BLOCKS,
+                 max_age=DEFAULT_MAX_AGE, threaded=True):
+        self.sd = sd
+        self.start_block = start_block
+        self.data_block = start_block + 2
+        self.end_block = start_block + block_count if block_count else sd.count()
+        self.max_age_ms = max_age * 1000
+        
+        # Double buffer of chunks, the active buffer is filled block by block while the other may be being
+        # written to the card
+        self.buffers = (bytearray(chunk_blocks * BLOCK_SIZE), bytearray(chunk_blocks * BLOCK_SIZE))
+        self.views = (memoryview(self.buffers[0]), memoryview(self.buffers[1]))
+        self.chunk_blocks = chunk_blocks
+        self.active = 0
+        self.block = 0  # Block of the active buffer being filled
+        self.used = 0  # Payload bytes used in that block
+        self.first_ticks = 0  # ticks_ms() value when the oldest buffered data was written
+        self.session_start = True
+        self.flush_requested = False
+        
+        self.superblock = bytearray(BLOCK_SIZE)
+        self.generation, self.head = self._mount()
+        
+        # Counters of the multi-block writes made, the blocks written and the blocks dropped once the card is full
+        self.write_count = 0
+        self.blocks_written = 0
+        self.blocks_dropped = 0
+        
+        # The writer thread waits on ready for a chunk to write, idle is held while a chunk is being written
+        self.pending = None
+        self.error = None  # Exception raised by the writer thread, raised again in the app by the next flush()
+        self.thread = threaded and _thread is not None
+        if self.thread:
+            self.ready = _thread.allocate_lock()
+            self.ready.acquire()
+            self.idle = _thread.allocate_lock()
+            self.stopping = False
+            _thread.start_new_thread(self._writer, ())
+            
+    def _mount(self):
+        """
+        Returns the (generation, head block) of the newest valid superblock, if neither superblock is valid the
+        card is given a new, empty log
+        """
+        best = None
+        for slot in (0, 1):
+            self.sd.readblocks(self.start_block + slot, self.superblock)
+            magic, version, flags, generation, data_block, head = struct.unpack_from(SUPERBLOCK_FORMAT,
+                                                                                    self.superblock, 0)
+            checksum = struct.unpack_from("<I", self.superblock, SUPERBLOCK_SIZE)[0]
+            if (magic == MAGIC and version == VERSION and data_block == self.data_block and
+                    checksum == crc32(self._superblock_fields()) and (best is None or generation > best[0])):
+                best = (generation, head)
+                
+        if best is None:
+            best = (0, self.data_block)
+            self._write_superblock(*best)
+            
+        return best
+        
+    def _superblock_fields(self):
+        return memoryview(self.superblock)[0:SUPERBLOCK_SIZE]
+        
+    def _write_superblock(self, generation, head):
+        struct.pack_into(SUPERBLOCK_FORMAT, self.superblock, 0, MAGIC, VERSION, 0, generation, self.data_block,
+                         head)
+        struct.pack_into("<I", self.superblock, SUPERBLOCK_SIZE, crc32(self._superblock_fields()))
+        self.sd.writeblocks(self.start_block + generation % 2, self.superblock)
+        
+    def _write_chunk(self, index, blocks):
+        """
+        Write the first blocks of a chunk buffer at the head of the log and then commit them with a superblock
+        """
+        if self.head + blocks > self.end_block:
+            self.blocks_dropped += blocks
+            return
+            
+        self.sd.writeblocks(self.head, self.views[index][0:blocks * BLOCK_SIZE])
+        self.head += blocks
+        self.generation += 1
+        self._write_superblock(self.generation, self.head)
+        self.write_count += 1
+        self.blocks_written += blocks
+        
+    def _writer(self):
+        while True:
+            self.ready.acquire()
+            if self.stopping:
+                break
+            index, blocks = self.pending
+            try:
+                self._write_chunk(index, blocks)
+            except Exception as ex:
+                self.error = ex
+                self.blocks_dropped += blocks
+            self.pending = None
+            self.idle.release()
+                
+    def _submit(self, blocks):
+        """
+        Hand the first blocks of the active buffer to be written and switch to filling the other buffer, waits
+        first if the other buffer is still being written
+        """
+        if self.thread:
+            self.idle.acquire()
+            self.pending = (self.active, blocks)
+            self.ready.release()
+        else:
+            self._write_chunk(self.active, blocks)
+        self.active = 1 - self.active
+        self.block = 0
+        self.used = 0
+        
+    def _wait(self):
+        """
+        Wait for any chunk being written to be completely written
+        """
+        if self.thread:
+            self.idle.acquire()
+            self.idle.release()
+            if self.error:
+                error, self.error = self.error, None
+                raise error
+            
+    def _close_block(self):
+        struct.pack_into(BLOCK_HEADER_FORMAT, self.buffers[self.active], self.block * BLOCK_SIZE, self.used,
+                         SESSION_START if self.session_start else 0)
+        self.session_start = False
+        self.block += 1
+        self.used = 0
+        
+    def write(self, data):
+        """
+        Append data (str or bytes) to the log, a chunk is written whenever the active buffer fills
+        """
+        data = data.encode() if isinstance(data, str) else data
+        if not self.block and not self.used:
+            self.first_ticks = ticks_ms()
+            
+        offset = 0
+        size = len(data)
+        while offset < size:
+            count = min(PAYLOAD_SIZE - self.used, size - offset)
+            start = self.block * BLOCK_SIZE + BLOCK_HEADER_SIZE + self.used
+            self.views[self.active][start:start + count] = data[offset:offset + count]
+            self.used += count
+            offset += count
+            if self.used == PAYLOAD_SIZE:
+                self._close_block()
+                if self.block == self.chunk_blocks:
+                    self._submit(self.block)
+                    
+    def request_flush(self):
+        """
+        Ask for the buffered data to be written on the next call to poll()
+        """
+        self.flush_requested = True
+        
+    def poll(self):
+        """
+        Write the buffered data if a flush has been requested or the oldest buffered data has reached the maximum
+        age, should be called regularly (e.g. once each time around the app loop)
+        """
+        if self.flush_requested or ((self.block or self.used) and
+                                    ticks_diff(ticks_ms(), self.first_ticks) >= self.max_age_ms):
+            self.flush()
+            
+    def flush(self):
+        """
+        Write the buffered data, including a partly filled last block, and wait until it is on the card
+        """
+        self.flush_requested = False
+        if self.used:
+            self._close_block()
+        if self.block:
+            self._submit(self.block)
+        self._wait()
+        
+    def close(self):
+        """
+        Write the buffered data and stop the writer thread
+        """
+        self.flush()
+        if self.thread:
+            self.idle.acquire()
+            self.stopping = True
+            self.ready.release()
+            self.thread = False
@@ -0,0 +1,81 @@
+"""
+Author: Arben Durmishllari
+Date: May 2019
+Copyright: University of Sunderland, (c) 2019
+File: timestamps.py
+Version: 1.0.0
+Notes: Cached RTC timestamps for logging, the RTC is read at most once a second (when ticks_ms() passes the
+       start of the next second, worked out from the RTC's sub-second count), and the date, time and log
+       timestamp strings are only formatted the first time they are asked for in each second, so every reading,
+       marker and display update within a second shares the same strings
+"""
+from time import ticks_ms, ticks_diff, ticks_add
+
+
+class Timestamps:
+    """
+    Per second cache of the RTC's date and time and the strings formatted from it
+    """
+    def __init__(self, rtc):
+        self.rtc = rtc
+        self.datetime = None  # (year, month, day, weekday, hour, minute, second, sub-second) from the RTC
+        self.next_ticks = 0  # ticks_ms() value at which the cached date and time is a second old
+        self._date = None
+        self._time = None
+        self._timestamp = None
+        
+    def invalidate(self):
+        """
+        Forget the cached date and time, e.g. after the RTC has been set
+        """
+        self.datetime = None
+        
+    def refresh(self):
+        """
+        Read the RTC if the cached date and time is out of date, returns the cached datetime tuple
+        """
+        now = ticks_ms()
+        if self.datetime is None or ticks_diff(now, self.next_ticks) >= 0:
+            self.datetime = self.rtc.datetime()
+            # The ESP32's RTC counts sub-seconds in microseconds, the cache is good until the next whole second
+            # (plus a millisecond so the RTC is not read again just before its second ticks over)
+            self.next_ticks = ticks_add(now, 1001 - self.datetime[7] // 1000)
+            self._date = None
+            self._time = None
+            self._timestamp = None
+            
+        return self.datetime
+        
+    @property
+    def date(self):
+        """
+        Date as written in ACCESS-STARTED and ACCESS-STOPPED lines (e.g. "17/5/2019")
+        """
+        datetime = self.refresh()
+        if self._date is None:
+            self._date = "{0}/{1}/{2}".format(datetime[2], datetime[1], datetime[0])
+            
+        return self._date
+        
+    @property
+    def time(self):
+        """
+        Time as written in ACCESS-STARTED and ACCESS-STOPPED lines (e.g. "15:34:12")
+        """
+        datetime = self.refresh()
+        if self._time is None:
+            self._time = "{0}:{1}:{2}".format(datetime[4], datetime[5], datetime[6])
+            
+        return self._time
+        
+    @property
+    def timestamp(self):
+        """
+        Timestamp as written in data reading lines (e.g. "2019-5-17|15:34:12")
+        """
+        datetime = self.refresh()
+        if self._timestamp is None:
+            self._timestamp = "{0}-{1}-{2}|{3}:{4}:{5}".format(datetime[0], datetime[1], datetime[2],
+                                                               datetime[4], datetime[5], datetime[6])
+            
+        return self._timestamp
@@ -0,0 +1,114 @@
+"""
+Author: Arben Durmishllari
+Date: May 2019
+Copyright: University of Sunderland, (c) 2019
+File: wifi_manager.py
+Version: 1.0.0
+Notes: Non-blocking WIFI connection manager, a connection attempt is started and then advanced by calling poll()
+       from the app's loop or a periodic task, so the app carries on (e.g. sampling sensors) whilst it connects,
+       failed attempts are retried after an exponentially growing backoff and a lost connection is re-established
+"""
+from time import ticks_ms, ticks_diff
+
+
+class WiFiStates:
+    IDLE = 1
+    CONNECTING = 2
+    CONNECTED = 3
+    BACKOFF = 4
+
+
+class WiFiManager:
+    """
+    State machine for the connection of a WLAN station interface to an access point
+    """
+    def __init__(self, wlan, connect_timeout=10000, backoff_min=1000, backoff_max=60000):
+        self.wlan = wlan
+        self.ssid = ""
+        self.passkey = ""
+
+        # Milliseconds an attempt may take before it is abandoned and retried, 0 or less never abandons an attempt
+        self.connect_timeout = connect_timeout
+
+        # Milliseconds waited after the first failed attempt, doubling after every further failure up to
+        # backoff_max, a successful connection starts again from backoff_min
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.backoff = 0
+        self.failures = 0
+
+        self.state = WiFiStates.IDLE
+        self.state_ticks = ticks_ms()  # ticks_ms() value when the current state was entered
+        self.listeners = []
+
+    def add_listener(self, callback):
+        """
+        Register a callback to be called as callback(old_state, new_state) on every change of state
+        """
+        self.listeners.append(callback)
+
+    def is_connected(self):
+        return self.state == WiFiStates.CONNECTED and self.wlan.isconnected()
+
+    def connect(self, ssid=None, passkey=None, connect_timeout=None):
+        """
+        Start connecting to the access point (reconnecting if already connected), optionally with new settings,
+        returns straight away, poll() then advances the connection
+        """
+        if ssid is not None:
+            self.ssid = ssid
+        if passkey is not None:
+            self.passkey = passkey
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        self.failures = 0
+        self._attempt()
+
+    def stop(self):
+        """
+        Disconnect and deactivate the interface, no further attempts are made until connect() is called again
+        """
+        if self.wlan.active():
+            if self.wlan.isconnected():
+                self.wlan.disconnect()
+            self.wlan.active(False)
+        self._set_state(WiFiStates.IDLE)
+
+    def poll(self):
+        """
+        Advance the state machine, returns the current state
+        """
+        if self.state == WiFiStates.CONNECTING:
+            if self.wlan.isconnected():
+                self.failures = 0
+                self._set_state(WiFiStates.CONNECTED)
+            elif self.connect_timeout > 0 and ticks_diff(ticks_ms(), self.state_ticks) >= self.connect_timeout:
+                # Abandon this attempt and wait before the next, twice as long as after the previous failure
+                self.wlan.disconnect()
+                self.backoff = min(self.backoff_min << min(self.failures, 16), self.backoff_max)
+                self.failures += 1
+                self._set_state(WiFiStates.BACKOFF)
+        elif self.state == WiFiStates.CONNECTED:
+            if not self.wlan.isconnected():
+                self._attempt()  # Connection lost so try to re-establish it straight away
+        elif self.state == WiFiStates.BACKOFF:
+            if ticks_diff(ticks_ms(), self.state_ticks) >= self.backoff:
+                self._attempt()
+
+        return self.state
+
+    def _attempt(self):
+        if not self.wlan.active():
+            self.wlan.active(True)
+        if self.wlan.isconnected():
+            self.wlan.disconnect()
+        self.wlan.connect(self.ssid, self.passkey)
+        self._set_state(WiFiStates.CONNECTING)
+
+    def _set_state(self, state):
+        old_state = self.state
+        self.state = state
+        self.state_ticks = ticks_ms()
+        if state != old_state:
+            for callback in self.listeners:
+                callback(old_state, state)
@@ -3,6 +3,143 @@
 # Author: Arben Durmishllari, University of Sunderland
 # Date: May 2019
 
+# Imports
+import bisect
+import struct
+from access_format import (RIG_ID_MARKER, timestamp_to_epoch, marker_to_epoch, epoch_to_timestamp, epoch_to_marker,
+                           open_data_file)
+from quantile_sketch import KLLSketch
+
+
+# Constants
+PERCENTILES = (0.5, 0.95, 0.99)  # Percentiles reported for access periods and rollup buckets
+
+# Packed binary record logs written by the rig (see libs/record_log.py), a header followed by fixed size records of
+# (device epoch, value 1, value 2, staff index, kind), the device counts seconds from 00:00:00 01-01-2000
+RECORD_LOG_MAGIC = b"PPWB"
+RECORD_LOG_VERSION = 1
+RECORD_LOG_HEADER = struct.Struct("<4sBB16s")
+RECORD_LOG_RECORD = struct.Struct("<IhHBB")
+RECORD_READING, RECORD_ACCESS_STARTED, RECORD_ACCESS_STOPPED, RECORD_STAFF = range(4)
+DEVICE_EPOCH_OFFSET = 946684800  # Seconds from 00:00:00 01-01-1970 to 00:00:00 01-01-2000
+
+
+# Functions
+def is_record_log(data_file):
+	"""
+	Check whether the given file is a packed binary record log written by the rig
+
+	:param data_file: path to the data file, as string
+
+	:return: True if the file starts with the record log magic bytes, False otherwise
+	"""
+	with open(data_file, "rb") as file:
+		return file.read(len(RECORD_LOG_MAGIC)) == RECORD_LOG_MAGIC
+
+
+def read_record_log(data_file):
+	"""
+	Decode a packed binary record log in bulk, the records are unpacked in one pass over the file contents, a trailing
+	partial record (e.g. from a power cut during a write) is ignored
+
+	:param data_file: path to the record log, as string
+
+	:return: (rig id or None, list of AccessPeriod class instances) tuple
+	"""
+	with open(data_file, "rb") as file:
+		data = file.read()
+
+	magic, version, record_size, rig_id = RECORD_LOG_HEADER.unpack_from(data, 0)
+	if magic != RECORD_LOG_MAGIC or version != RECORD_LOG_VERSION or record_size != RECORD_LOG_RECORD.size:
+		raise ValueError("Not a record log: {0}".format(data_file))
+	rig_id = rig_id.rstrip(b"\0").decode("utf-8") or None
+
+	end = RECORD_LOG_HEADER.size + (len(data) - RECORD_LOG_HEADER.size) // record_size * record_size
+	staff_ids = {0: "None"}
+	access_periods = []
+	access_period = None
+	skip = 0
+	for index, (epoch, value_1, value_2, staff, kind) in enumerate(RECORD_LOG_RECORD.iter_unpack(
+			memoryview(data)[RECORD_LOG_HEADER.size:end])):
+		if skip:
+			skip -= 1
+			continue
+		epoch += DEVICE_EPOCH_OFFSET
+		if kind == RECORD_READING:
+			if access_period is not None:
+				access_period.add_data_reading(DataReading(epoch_to_timestamp(epoch), value_1 / 100, value_2 / 100))
+		elif kind == RECORD_ACCESS_STARTED:
+			access_period = AccessPeriod(*epoch_to_marker(epoch), staff_ids.get(staff, "None"))
+		elif kind == RECORD_ACCESS_STOPPED:
+			if access_period is not None:
+				access_period.stop_date, access_period.stop_time = epoch_to_marker(epoch)
+				access_period.period_length = value_2
+				access_periods.append(access_period)
+			access_period = None
+		elif kind == RECORD_STAFF:
+			# The staff id follows in as many records as it needs
+			skip = -(-value_2 // record_size)
+			name_start = RECORD_LOG_HEADER.size + (index + 1) * record_size
+			staff_ids[staff] = data[name_start:name_start + value_2].decode("utf-8")
+
+	return rig_id, access_periods
+
+
+def dewpoint(temp_data, humidity_data):
+	"""
+	Approximate dewpoint temperature from temperature and relative humidity (reducing the temperature by 1 degree for
+	every 5% the humidity is below 100%), this is the dewpoint reported for access periods and used by alert rules
+
+	:param temp_data: temperature in degrees Celsius, as float
+	:param humidity_data: relative humidity as a percentage, as float
+
+	:return: dewpoint in degrees Celsius, as float
+	"""
+	return temp_data - ((100.0 - humidity_data) / 5.0)
+
+
+def merge_staff_summaries(summaries, partials):
+	"""
+	Merge partial per staff summaries (see AccessPeriods.query_staff_partials()) into another set of partials
+
+	:param summaries: dictionary of {staff id: partial summary dictionary} to merge into, updated in place
+	:param partials: dictionary of {staff id: partial summary dictionary} to be merged
+
+	:return: summaries
+	"""
+	for staff, partial in partials.items():
+		summary = summaries.get(staff)
+		if summary is None:
+			summaries[staff] = partial
+			continue
+		summary["periods"] += partial["periods"]
+		summary["seconds"] += partial["seconds"]
+		summary["readings"] += partial["readings"]
+		if partial["temp_max"] is not None and (summary["temp_max"] is None or partial["temp_max"] > summary["temp_max"]):
+			summary["temp_max"] = partial["temp_max"]
+		summary["humidity_total"] += partial["humidity_total"]
+		summary["temp_sketch"].merge(partial["temp_sketch"])
+		summary["humidity_sketch"].merge(partial["humidity_sketch"])
+
+	return summaries
+
+
+def finish_staff_summaries(summaries):
+	"""
+	Turn partial per staff summaries into the summaries returned by AccessPeriods.query_staff_summaries()
+
+	:param summaries: dictionary of {staff id: partial summary dictionary}, updated in place
+
+	:return: summaries
+	"""
+	for summary in summaries.values():
+		humidity_total = summary.pop("humidity_total")
+		summary["humidity_average"] = humidity_total / summary["readings"] if summary["readings"] else None
+		summary["temp_percentiles"] = summary.pop("temp_sketch").quantiles(PERCENTILES)
+		summary["humidity_percentiles"] = summary.pop("humidity_sketch").quantiles(PERCENTILES)
+
+	return summaries
+
 
 # Classes
 class DataReading:
@@ -16,6 +153,8 @@ class DataReading:
 			__timestamp: timestamp for this data reading, as string, property with read-only access
 			__temp_data: temperature data for this data reading, as float, property with read-only access
 			__humidity_data: humidity data for this data reading, as float, property with read-only access
+			__epoch: timestamp as seconds since the epoch, as int, calculated on first use, property with read-only
+			         access
 
 		:param timestamp: to associate with this data reading instance
 		:param temp_data: to associate with this data reading instance
@@ -24,11 +163,18 @@ class DataReading:
 		self.__timestamp = timestamp
 		self.__temp_data = temp_data
 		self.__humidity_data = humidity_data
+		self.__epoch = None
 
 	@property
 	def timestamp(self):
 		return self.__timestamp
 
+	@property
+	def epoch(self):
+		if self.__epoch is None:
+			self.__epoch = timestamp_to_epoch(self.__timestamp)
+		return self.__epoch
+
 	@property
 	def temp_data(self):
 		return self.__temp_data
@@ -62,11 +208,19 @@ class AccessPeriod:
 			__stop_time: stop time of this access period, as string, property with read-only access
 			__period_length: approximate number of seconds this access period lasted, as int, property with
 			                 read-only access
-			__data_readings: list of DataReadings class instances, property with no access
+			__data_readings: list of DataReadings class instances, property with read-only access
 			__temp_max: maximum temperature across all data readings in the data set, as float, property with
 						read-only access
 			__humidity_average: average humidity across all data readings in the data set, as float, property with
 			                    read-only access
+			__humidity_total: sum of the humidity data across all data readings, as float, property with no access
+			__temp_sketch: KLLSketch of the temperature data across all data readings, property with read-only access
+			__humidity_sketch: KLLSketch of the humidity data across all data readings, property with read-only
+			                   access
+			__start_epoch: start date and time as seconds since the epoch, calculated on first use, property with
+			               read-only access
+			__stop_epoch: stop date and time as seconds since the epoch, calculated on first use, property with
+			              read-only access
 
 		:param start_date: start date of this access period, as string
 		:param start_time: start time of this access period, as string
@@ -79,6 +233,11 @@ class AccessPeriod:
 		self.__data_readings = []  # Initially empty until data readings are added
 		self.__temp_max = None  # This will be calculated and assigned when data readings are added
 		self.__humidity_average = None  # This will be calculated and assigned when data readings are added
+		self.__humidity_total = 0.0  # Running total of humidity data used to update the humidity average
+		self.__temp_sketch = KLLSketch()  # Percentiles are answered from these sketches as data readings are added
+		self.__humidity_sketch = KLLSketch()
+		self.__start_epoch = None
+		self.__stop_epoch = None
 		self.__staff = staff
 
 	@property
@@ -100,6 +259,7 @@ class AccessPeriod:
 	@stop_date.setter
 	def stop_date(self, value):
 		self.__stop_date = value
+		self.__stop_epoch = None
 
 	@property
 	def stop_time(self):
@@ -108,6 +268,25 @@ class AccessPeriod:
 	@stop_time.setter
 	def stop_time(self, value):
 		self.__stop_time = value
+		self.__stop_epoch = None
+
+	@property
+	def start_epoch(self):
+		if self.__start_epoch is None:
+			self.__start_epoch = marker_to_epoch(self.start_date, self.start_time)
+		return self.__start_epoch
+
+	@property
+	def stop_epoch(self):
+		# An access period that has not been stopped ends at its last data reading (or its start if it has none)
+		if self.__stop_epoch is None:
+			if self.stop_date and self.stop_time:
+				self.__stop_epoch = marker_to_epoch(self.stop_date, self.stop_time)
+			elif self.__data_readings:
+				return max(self.start_epoch, self.__data_readings[-1].epoch)
+			else:
+				return self.start_epoch
+		return self.__stop_epoch
 
 	@property
 	def period_length(self):
@@ -125,17 +304,41 @@ class AccessPeriod:
 	def humidity_average(self):
 		return self.__humidity_average
 
+	@property
+	def data_readings(self):
+		return self.__data_readings
+
+	@property
+	def temp_sketch(self):
+		return self.__temp_sketch
+
+	@property
+	def humidity_sketch(self):
+		return self.__humidity_sketch
+
 	def add_data_reading(self, data_reading):
 		"""
 		This method is used to add a new data reading to this AccessPeriod class instance, you must use this method
-		as it also updates the maximum temperature and humidity average as a new data reading is added
+		as it also updates the maximum temperature and humidity average as a new data reading is added, the data
+		readings are kept in time order so a reading older than the last one is inserted in its place
 
 		:param data_reading: data reading to be added as instance of DataReading class
 
 		:return: nothing
 		"""
-		# Add data reading to the data readings property
-		self.__data_readings.append(data_reading)
+		# Add data reading to the data readings property, binary searching for the position of a late reading
+		data_readings = self.__data_readings
+		if data_readings and data_reading.epoch < data_readings[-1].epoch:
+			low, high = 0, len(data_readings)
+			while low < high:
+				middle = (low + high) // 2
+				if data_readings[middle].epoch <= data_reading.epoch:
+					low = middle + 1
+				else:
+					high = middle
+			data_readings.insert(low, data_reading)
+		else:
+			data_readings.append(data_reading)
 
 		# Check if the temperature associated with this data reading is greater than the currently recorded maximum
 		# temperature, note: if this is the first data reading added then the maximum temperature must be the
@@ -145,12 +348,14 @@ class AccessPeriod:
 		elif data_reading.temp_data > self.temp_max:
 			self.__temp_max = data_reading.temp_data
 
-		# Update the humidity average to take account of this newly added data reading, note: if this is the first
-		# data reading added then the average will be the humidity from this reading
-		if not self.humidity_average:
-			self.__humidity_average = data_reading.humidity_data
-		else:
-			self.calculate_humidity_average()
+		# Update the humidity average to take account of this newly added data reading using a running total, so adding
+		# a reading costs the same however many readings the access period already holds
+		self.__humidity_total += data_reading.humidity_data
+		self.__humidity_average = self.__humidity_total / len(self.__data_readings)
+
+		# Add this data reading to the temperature and humidity percentile sketches
+		self.__temp_sketch.add(data_reading.temp_data)
+		self.__humidity_sketch.add(data_reading.humidity_data)
 
 	def calculate_humidity_average(self):
 		"""
@@ -163,6 +368,7 @@ class AccessPeriod:
 		for data_reading in self.__data_readings:
 			total += data_reading.humidity_data
 
+		self.__humidity_total = total
 		self.__humidity_average = total / len(self.__data_readings)
 
 	def print_access_period(self):
@@ -190,8 +396,11 @@ class AccessPeriod:
 		# Fourth, print the humidity average recorded during this access period (to two decimal places)
 		print("Hmdy Ave: {0:.2f} %".format(self.humidity_average))
 
-		dewpoint = self.temp_max - ((100.0 - self.humidity_average) / 5.0)
-		print("DewPoint: %d degrees C" %dewpoint)
+		print("DewPoint: %d degrees C" %dewpoint(self.temp_max, self.humidity_average))
+
+		# Print the approximate temperature and humidity percentiles recorded during this access period
+		print("Temp p50/p95/p99: {0} / {1} / {2} degrees C".format(*self.temp_sketch.quantiles(PERCENTILES)))
+		print("Hmdy p50/p95/p99: {0} / {1} / {2} %".format(*self.humidity_sketch.quantiles(PERCENTILES)))
 
 		
 
@@ -202,24 +411,213 @@ class AccessPeriod:
 			print(data_reading)
 
 
+class RollupBucket:
+	"""
+	Class to hold the aggregate of all data readings whose timestamps fall within one fixed width time bucket (e.g. one
+	minute or one hour), buckets hold running totals and percentile sketches rather than the data readings themselves
+	so any number of readings (and any number of rigs) can be rolled up into a bucket, and buckets can be merged
+	"""
+	def __init__(self, start, width):
+		"""
+		Initialiser - instance variables:
+			__start: start of this bucket in seconds since the epoch, as int, property with read-only access
+			__width: width of this bucket in seconds, as int, property with read-only access
+			__count: number of data readings rolled up into this bucket, as int, property with read-only access
+			__temp_min: minimum temperature, as float, property with read-only access
+			__temp_max: maximum temperature, as float, property with read-only access
+			__temp_total: sum of all temperatures, as float, property with no access
+			__humidity_min: minimum humidity, as float, property with read-only access
+			__humidity_max: maximum humidity, as float, property with read-only access
+			__humidity_total: sum of all humidities, as float, property with no access
+			__temp_sketch: KLLSketch of all temperatures, property with read-only access
+			__humidity_sketch: KLLSketch of all humidities, property with read-only access
+
+		:param start: start of this bucket in seconds since the epoch, as int
+		:param width: width of this bucket in seconds, as int
+		"""
+		self.__start = start
+		self.__width = width
+		self.__count = 0
+		self.__temp_min = None
+		self.__temp_max = None
+		self.__temp_total = 0.0
+		self.__humidity_min = None
+		self.__humidity_max = None
+		self.__humidity_total = 0.0
+		self.__temp_sketch = KLLSketch()
+		self.__humidity_sketch = KLLSketch()
+
+	@property
+	def start(self):
+		return self.__start
+
+	@property
+	def width(self):
+		return self.__width
+
+	@property
+	def count(self):
+		return self.__count
+
+	@property
+	def temp_min(self):
+		return self.__temp_min
+
+	@property
+	def temp_max(self):
+		return self.__temp_max
+
+	@property
+	def temp_average(self):
+		return self.__temp_total / self.__count if self.__count else None
+
+	@property
+	def humidity_min(self):
+		return self.__humidity_min
+
+	@property
+	def humidity_max(self):
+		return self.__humidity_max
+
+	@property
+	def humidity_average(self):
+		return self.__humidity_total / self.__count if self.__count else None
+
+	@property
+	def temp_sketch(self):
+		return self.__temp_sketch
+
+	@property
+	def humidity_sketch(self):
+		return self.__humidity_sketch
+
+	def add(self, temp_data, humidity_data):
+		"""
+		Roll a single data reading up into this bucket
+
+		:param temp_data: temperature of the data reading, as float
+		:param humidity_data: humidity of the data reading, as float
+
+		:return: nothing
+		"""
+		if not self.__count:
+			self.__temp_min = self.__temp_max = temp_data
+			self.__humidity_min = self.__humidity_max = humidity_data
+		else:
+			self.__temp_min = min(self.__temp_min, temp_data)
+			self.__temp_max = max(self.__temp_max, temp_data)
+			self.__humidity_min = min(self.__humidity_min, humidity_data)
+			self.__humidity_max = max(self.__humidity_max, humidity_data)
+
+		self.__count += 1
+		self.__temp_total += temp_data
+		self.__humidity_total += humidity_data
+		self.__temp_sketch.add(temp_data)
+		self.__humidity_sketch.add(humidity_data)
+
+	def merge(self, other):
+		"""
+		Merge another bucket (e.g. the same bucket from another rig, or a finer bucket being rolled up into a coarser
+		one) into this bucket, the other bucket is left unchanged
+
+		:param other: RollupBucket instance to be merged
+
+		:return: this bucket (to allow chaining)
+		"""
+		if not other.count:
+			return self
+
+		if not self.__count:
+			self.__temp_min, self.__temp_max = other.temp_min, other.temp_max
+			self.__humidity_min, self.__humidity_max = other.humidity_min, other.humidity_max
+		else:
+			self.__temp_min = min(self.__temp_min, other.temp_min)
+			self.__temp_max = max(self.__temp_max, other.temp_max)
+			self.__humidity_min = min(self.__humidity_min, other.humidity_min)
+			self.__humidity_max = max(self.__humidity_max, other.humidity_max)
+
+		self.__count += other.count
+		self.__temp_total += other.__temp_total
+		self.__humidity_total += other.__humidity_total
+		self.__temp_sketch.merge(other.temp_sketch)
+		self.__humidity_sketch.merge(other.humidity_sketch)
+
+		return self
+
+	def totals(self):
+		"""
+		The running totals of this bucket, enough to rebuild it with from_totals() (the percentile sketches are not
+		included)
+
+		:return: (count, temp min, temp max, temp total, humidity min, humidity max, humidity total) tuple
+		"""
+		return (self.__count, self.__temp_min, self.__temp_max, self.__temp_total, self.__humidity_min,
+		        self.__humidity_max, self.__humidity_total)
+
+	@classmethod
+	def from_totals(cls, start, width, totals):
+		"""
+		Rebuild a bucket from the running totals returned by totals(), e.g. when read back from a stored rollup tier,
+		the rebuilt bucket's percentile sketches are empty
+
+		:param start: start of the bucket in seconds since the epoch, as int
+		:param width: width of the bucket in seconds, as int
+		:param totals: tuple returned by totals()
+
+		:return: RollupBucket instance
+		"""
+		bucket = cls(start, width)
+		(bucket.__count, bucket.__temp_min, bucket.__temp_max, bucket.__temp_total, bucket.__humidity_min,
+		 bucket.__humidity_max, bucket.__humidity_total) = totals
+
+		return bucket
+
+	def __str__(self):
+		"""
+		To string method
+
+		:return: string representation of this rollup bucket instance
+		"""
+		return "Bucket: {0} ({1}s) {2} readings, temp {3}-{4}c p95 {5}c, humidity ave {6:.2f}% p95 {7}%".format(
+			epoch_to_timestamp(self.start), self.width, self.count, self.temp_min, self.temp_max,
+			self.temp_sketch.quantile(0.95), self.humidity_average, self.humidity_sketch.quantile(0.95))
+
+
 class AccessPeriods:
 	"""
 	Class to contain a number of access periods as read from the supplied CSV data file when an instance of this
 	class is instantiated
 	"""
-	def __init__(self, data_file):
+	def __init__(self, data_file=None):
 		"""
 		Initialiser - instance variables:
 			__data_file: path to the CSV data file from which to read the access periods, as string, property with
 			             no access
-			__access_periods: List of AccessPeriod class instances created as the CSV data file is read, property with
-						      no access
-
-		:param data_file: path to the data_file, as string
+			__access_periods: List of AccessPeriod class instances created as the CSV data file is read, kept sorted
+			                  by start time, property with no access
+			__starts: list of the start epochs of the access periods list, in the same order, used to binary search
+			          the access periods by time, property with no access
+			__longest: length in seconds of the longest access period held, used to bound time window searches,
+			           property with no access
+			__ingest_listeners: list of callables called with each access period added by add_access_period(),
+			                    property with no access
+			__update_listeners: list of callables called with each data reading added by add_data_reading() to an
+			                    access period already held, property with no access
+			__rig_id: unique id of the rig that wrote the data file (from its RIG-ID line), None if unknown,
+			          property with read-only access
+
+		:param data_file: path to the data_file, as string, if None then no file is read and access periods can be
+		                  added with add_access_period()
 		"""
 		self.__data_file = data_file
 		self.__access_periods = []  # Initially empty until read from CSV data file
-		self.read_data_file()  # Read from the supplied CSV data file
+		self.__starts = []
+		self.__longest = 0
+		self.__ingest_listeners = []
+		self.__update_listeners = []
+		self.__rig_id = None
+		if data_file:
+			self.read_data_file()  # Read from the supplied CSV data file
 
 	def read_data_file(self):
 		"""
@@ -230,6 +628,24 @@ class AccessPeriods:
 		# Clear down any existing entries in access periods list
 		self.__access_periods = []
 
+		# Compact binary archives (see access_compact.py), compressed time series archives (see gorilla_archive.py) and
+		# the rig's binary record logs carry their own period records so load them directly rather than parsing text
+		# lines
+		from access_compact import is_compact_archive, read_compact_archive
+		from gorilla_archive import is_gorilla_archive, read_gorilla_archive
+		if is_compact_archive(self.__data_file):
+			self.__access_periods = read_compact_archive(self.__data_file).to_access_periods()
+			self.__build_index()
+			return
+		if is_gorilla_archive(self.__data_file):
+			self.__access_periods = read_gorilla_archive(self.__data_file)
+			self.__build_index()
+			return
+		if is_record_log(self.__data_file):
+			self.__rig_id, self.__access_periods = read_record_log(self.__data_file)
+			self.__build_index()
+			return
+
 		# Local variables to hold start dates and times of access periods
 		start_date = None
 		start_time = None
@@ -246,7 +662,7 @@ class AccessPeriods:
 
 		# Open the CSV data file for reading and read each text line in sequence until end of file, note: each access
 		# period consists of an ACCESS-STARTED line, any number of data reading lines and then an ACCESS-STOPPED line
-		file = open(self.__data_file, "r")
+		file = open_data_file(self.__data_file)
 		for line in file:
 			# Remove any spurious end-of-line characters from this line as the file was written using UNIX style EOLs
 			line = line.replace("\n", "")
@@ -254,13 +670,18 @@ class AccessPeriods:
 			# Split this line according to the commas in the line
 			entries = line.split(",")
 
+			# A RIG-ID line records which rig wrote this data file, it carries no access period data
+			if entries[0] == RIG_ID_MARKER:
+				self.__rig_id = entries[1].strip()
+				continue
+
 			# If the first entry in the read line is the string "ACCESS-STARTED" then the next two entries are start
 			# date and start time respectively, this is the start of a new access period object so instantiate one
 			# locally
 			if entries[0] == "ACCESS-STARTED":
 				start_date = entries[1]
 				start_time = entries[2]
-				staff = entries[3]
+				staff = entries[3].strip()  # The rig writes a trailing space after the staff id
 				access_period = AccessPeriod(start_date, start_time, staff)
 
 			# If the first entry in the read line is the string "ACCESS-STOPPED" then the next three entries are stop
@@ -293,6 +714,275 @@ class AccessPeriods:
 				# Add this to the access period instance using its add_data_reading() method
 				access_period.add_data_reading(data_reading)
 
+		file.close()
+		self.__build_index()
+
+	def __build_index(self):
+		"""
+		Sort the access periods list by start time and rebuild the start epochs list and longest period length used by
+		the time window queries
+		"""
+		self.__access_periods.sort(key=lambda access_period: access_period.start_epoch)
+		self.__starts = [access_period.start_epoch for access_period in self.__access_periods]
+		self.__longest = max([access_period.stop_epoch - access_period.start_epoch
+		                      for access_period in self.__access_periods] + [0])
+
+	def __len__(self):
+		return len(self.__access_periods)
+
+	@property
+	def rig_id(self):
+		return self.__rig_id
+
+	def __iter__(self):
+		return iter(self.__access_periods)
+
+	def add_access_period(self, access_period):
+		"""
+		Add a single access period, keeping the access periods list sorted by start time, any ingest listeners are
+		called with the access period once it has been added
+
+		:param access_period: AccessPeriod class instance to be added
+
+		:return: nothing
+		"""
+		position = bisect.bisect_right(self.__starts, access_period.start_epoch)
+		self.__starts.insert(position, access_period.start_epoch)
+		self.__access_periods.insert(position, access_period)
+		self.__longest = max(self.__longest, access_period.stop_epoch - access_period.start_epoch)
+
+		for listener in self.__ingest_listeners:
+			listener(access_period)
+
+	def add_ingest_listener(self, listener):
+		"""
+		Register a callable to be called with every access period added by add_access_period(), this is how caches,
+		indexes and alerts are kept up to date as new access periods are ingested
+
+		:param listener: callable taking an AccessPeriod class instance
+
+		:return: nothing
+		"""
+		self.__ingest_listeners.append(listener)
+
+	def remove_ingest_listener(self, listener):
+		"""
+		Unregister a callable previously registered with add_ingest_listener()
+
+		:param listener: callable to be removed
+
+		:return: nothing
+		"""
+		self.__ingest_listeners.remove(listener)
+
+	def add_data_reading(self, access_period, data_reading):
+		"""
+		Add a data reading to an access period that has already been added (e.g. a late reading corrected after the
+		access period was finalised), any update listeners are called with the access period and data reading once it
+		has been added, use this rather than AccessPeriod.add_data_reading() so caches and indexes stay up to date
+
+		:param access_period: AccessPeriod class instance already held
+		:param data_reading: DataReading class instance to be added
+
+		:return: nothing
+		"""
+		access_period.add_data_reading(data_reading)
+		self.__longest = max(self.__longest, access_period.stop_epoch - access_period.start_epoch)
+
+		for listener in self.__update_listeners:
+			listener(access_period, data_reading)
+
+	def add_update_listener(self, listener):
+		"""
+		Register a callable to be called with every data reading added by add_data_reading() to an access period
+		already held
+
+		:param listener: callable taking an AccessPeriod and a DataReading class instance
+
+		:return: nothing
+		"""
+		self.__update_listeners.append(listener)
+
+	def remove_update_listener(self, listener):
+		"""
+		Unregister a callable previously registered with add_update_listener()
+
+		:param listener: callable to be removed
+
+		:return: nothing
+		"""
+		self.__update_listeners.remove(listener)
+
+	def query_access_periods(self, start=None, stop=None, staff=None):
+		"""
+		Find the access periods that overlap a time window, optionally for a single member of staff only
+
+		:param start: start of the time window in seconds since the epoch, as int, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, as int, None for no upper bound
+		:param staff: staff id to filter by, as string, None for all staff
+
+		:return: list of AccessPeriod instances sorted by start time
+		"""
+		# No access period can overlap the window if it started more than the longest period length before the start
+		# of the window, so only that slice of the (sorted) access periods list needs to be checked
+		first = 0 if start is None else bisect.bisect_left(self.__starts, start - self.__longest)
+		last = len(self.__starts) if stop is None else bisect.bisect_right(self.__starts, stop)
+
+		results = []
+		for access_period in self.__access_periods[first:last]:
+			if start is not None and access_period.stop_epoch < start:
+				continue
+			if staff is not None and access_period.staff != staff:
+				continue
+			results.append(access_period)
+
+		return results
+
+	def query_data_readings(self, start=None, stop=None, staff=None):
+		"""
+		Generator of the data readings that fall within a time window, optionally for a single member of staff only
+
+		:param start: start of the time window in seconds since the epoch, as int, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, as int, None for no upper bound
+		:param staff: staff id to filter by, as string, None for all staff
+
+		:return: yields (AccessPeriod, DataReading) tuples in access period order
+		"""
+		for access_period in self.query_access_periods(start, stop, staff):
+			for data_reading in access_period.data_readings:
+				if start is not None and data_reading.epoch < start:
+					continue
+				if stop is not None and data_reading.epoch > stop:
+					continue
+				yield access_period, data_reading
+
+	def query_staff_summaries(self, start=None, stop=None, staff=None):
+		"""
+		Summarise the access periods that overlap a time window per member of staff
+
+		:param start: start of the time window in seconds since the epoch, as int, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, as int, None for no upper bound
+		:param staff: staff id to filter by, as string, None for all staff
+
+		:return: dictionary of {staff id: dictionary of periods, seconds, readings, temp_max, humidity_average,
+		         temp_percentiles and humidity_percentiles}
+		"""
+		return finish_staff_summaries(self.query_staff_partials(start, stop, staff))
+
+	def query_staff_partials(self, start=None, stop=None, staff=None):
+		"""
+		Partial per staff summaries of the access periods that overlap a time window, partials from several sets of
+		access periods (e.g. storage partitions) can be combined with merge_staff_summaries() before being finished
+		with finish_staff_summaries()
+
+		:param start: start of the time window in seconds since the epoch, as int, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, as int, None for no upper bound
+		:param staff: staff id to filter by, as string, None for all staff
+
+		:return: dictionary of {staff id: partial summary dictionary}
+		"""
+		summaries = {}
+		for access_period in self.query_access_periods(start, stop, staff):
+			summary = summaries.get(access_period.staff)
+			if summary is None:
+				summary = summaries[access_period.staff] = {"periods": 0, "seconds": 0, "readings": 0,
+				                                            "temp_max": None, "humidity_total": 0.0,
+				                                            "temp_sketch": KLLSketch(), "humidity_sketch": KLLSketch()}
+			summary["periods"] += 1
+			summary["seconds"] += access_period.period_length
+			summary["readings"] += len(access_period.data_readings)
+			if access_period.temp_max is not None and (summary["temp_max"] is None or
+			                                           access_period.temp_max > summary["temp_max"]):
+				summary["temp_max"] = access_period.temp_max
+			if access_period.humidity_average is not None:
+				summary["humidity_total"] += access_period.humidity_average * len(access_period.data_readings)
+			summary["temp_sketch"].merge(access_period.temp_sketch)
+			summary["humidity_sketch"].merge(access_period.humidity_sketch)
+
+		return summaries
+
+	def publish_shared_memory(self):
+		"""
+		Publish the data readings of all access periods as columns in shared memory blocks, so a pool of report
+		worker processes can attach to them without copying (see shared_dataset.py)
+
+		:return: SharedDataset class instance, call its unlink() method when it is no longer needed
+		"""
+		from shared_dataset import SharedDataset
+
+		return SharedDataset.publish(self)
+
+	@staticmethod
+	def aggregate_external(data_files, group_by="staff", memory_budget=64 * 1024 * 1024):
+		"""
+		Aggregate data files that are too large to load as access periods, the files are streamed into per group
+		partial aggregates that are spilled to disk whenever they outgrow the memory budget (see external_aggregate.py)
+
+		:param data_files: list of data file paths, as strings
+		:param group_by: "staff", "day" or "staff-day"
+		:param memory_budget: approximate bytes the in-memory partial aggregates may use, as int
+
+		:return: ExternalAggregator class instance, iterate its results() method for the aggregates in key order
+		"""
+		from external_aggregate import ExternalAggregator
+
+		aggregator = ExternalAggregator(group_by, memory_budget)
+		for data_file in data_files:
+			aggregator.add_file(data_file)
+
+		return aggregator
+
+	def rollup(self, bucket_seconds, buckets=None):
+		"""
+		Roll the data readings of all access periods up into fixed width time buckets
+
+		:param bucket_seconds: width of each bucket in seconds, as int (e.g. 60 for one minute buckets)
+		:param buckets: optional dictionary of {bucket start: RollupBucket} to add to, this allows the access periods
+		                of several rigs to be rolled up into the same buckets
+
+		:return: dictionary of {bucket start: RollupBucket}
+		"""
+		if buckets is None:
+			buckets = {}
+
+		for access_period in self.__access_periods:
+			for data_reading in access_period.data_readings:
+				start = data_reading.epoch - data_reading.epoch % bucket_seconds
+				bucket = buckets.get(start)
+				if bucket is None:
+					bucket = buckets[start] = RollupBucket(start, bucket_seconds)
+				bucket.add(data_reading.temp_data, data_reading.humidity_data)
+
+		return buckets
+
+	def temp_percentiles(self, fractions=PERCENTILES):
+		"""
+		Approximate temperature percentiles across all access periods, calculated by merging the per period sketches
+
+		:param fractions: iterable of fractions between 0.0 and 1.0
+
+		:return: list of temperatures in the same order as fractions
+		"""
+		sketch = KLLSketch()
+		for access_period in self.__access_periods:
+			sketch.merge(access_period.temp_sketch)
+
+		return sketch.quantiles(fractions)
+
+	def humidity_percentiles(self, fractions=PERCENTILES):
+		"""
+		Approximate humidity percentiles across all access periods, calculated by merging the per period sketches
+
+		:param fractions: iterable of fractions between 0.0 and 1.0
+
+		:return: list of humidities in the same order as fractions
+		"""
+		sketch = KLLSketch()
+		for access_period in self.__access_periods:
+			sketch.merge(access_period.humidity_sketch)
+
+		return sketch.quantiles(fractions)
+
 	def print_access_periods(self):
 		"""
 		Print all access periods to the console
@@ -334,5 +1024,7 @@ def main():
 
 # Invoke main() program entrance
 if __name__ == "__main__":
-	# execute only if run as a script
-	main()
+	# execute only if run as a script, through the DesktopApp module itself so that the access periods read by the
+	# archive modules (which import it) are instances of the same classes
+	import DesktopApp
+	DesktopApp.main()
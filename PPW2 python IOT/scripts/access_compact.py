@@ -0,0 +1,421 @@
+# File: access_compact.py
+# Description: Log compaction tool for PPW2 access data files, merges duplicate-second readings and rewrites one or
+#              more access logs as a compact sorted binary columnar archive (plus an optional gzip compressed CSV)
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import gzip
+import struct
+import sys
+from array import array
+from access_format import (timestamp_to_epoch, marker_to_epoch, epoch_to_timestamp, epoch_to_marker, open_data_file,
+                           RIG_ID_MARKER)
+
+
+# Constants
+ARCHIVE_MAGIC = b"PPWC"
+ARCHIVE_VERSION = 1
+MAX_STAFF_ID_BYTES = 255  # Staff ids are stored with a one byte length
+
+# Archive layout (all little-endian):
+#   header:        magic, version, flags, staff count, period count, row count
+#   staff table:   staff count x (length byte, UTF-8 staff id)
+#   period index:  period count x (start epoch, stop epoch, period length, staff index, row offset, row count)
+#   columns:       row count x uint32 epoch seconds, then int16 centi-degrees, then uint16 centi-percent, then uint16
+#                  number of raw readings merged into each row
+_HEADER = struct.Struct("<4sHHIII")
+_PERIOD = struct.Struct("<IIIIII")
+_COLUMN_TYPES = ("I", "h", "H", "H")
+
+
+# Functions
+def is_compact_archive(data_file):
+	"""
+	Check whether the given file is a compact binary archive written by this module
+
+	:param data_file: path to the data file, as string
+
+	:return: True if the file starts with the archive magic bytes, False otherwise
+	"""
+	with open(data_file, "rb") as file:
+		return file.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+
+def read_compact_archive(data_file):
+	"""
+	Read a compact binary archive from disk
+
+	:param data_file: path to the archive file, as string
+
+	:return: CompactArchive instance
+	"""
+	with open(data_file, "rb") as file:
+		return CompactArchive.from_bytes(file.read())
+
+
+def _load_column(type_code, data, offset, count):
+	"""
+	Load one little-endian column of count items from data starting at offset
+
+	:return: (array, offset of the byte following the column) tuple
+	"""
+	column = array(type_code)
+	end = offset + column.itemsize * count
+	column.frombytes(data[offset:end])
+	if sys.byteorder != "little":
+		column.byteswap()
+
+	return column, end
+
+
+# Classes
+class CompactArchive:
+	"""
+	Class to hold a compacted set of access periods in columnar form, every row is one second of readings (duplicate
+	readings within the same second already merged) and rows are sorted by period and then by time, the period index
+	gives the row range belonging to each access period
+	"""
+	def __init__(self, staff, periods, epochs, temps, humidities, counts):
+		"""
+		Initialiser - instance variables:
+			__staff: list of staff ids, periods refer to staff by position in this list, property with read-only access
+			__periods: list of (start epoch, stop epoch, period length, staff index, row offset, row count) tuples,
+			           property with read-only access
+			__epochs: array of uint32 seconds since the epoch, property with read-only access
+			__temps: array of int16 temperatures in hundredths of a degree C, property with read-only access
+			__humidities: array of uint16 humidities in hundredths of a percent, property with read-only access
+			__counts: array of uint16 number of raw readings merged into each row, property with read-only access
+
+		:param staff: list of staff ids
+		:param periods: list of period index tuples
+		:param epochs: epoch column
+		:param temps: temperature column
+		:param humidities: humidity column
+		:param counts: merged reading count column
+		"""
+		self.__staff = staff
+		self.__periods = periods
+		self.__epochs = epochs
+		self.__temps = temps
+		self.__humidities = humidities
+		self.__counts = counts
+
+	@property
+	def staff(self):
+		return self.__staff
+
+	@property
+	def periods(self):
+		return self.__periods
+
+	@property
+	def epochs(self):
+		return self.__epochs
+
+	@property
+	def temps(self):
+		return self.__temps
+
+	@property
+	def humidities(self):
+		return self.__humidities
+
+	@property
+	def counts(self):
+		return self.__counts
+
+	@classmethod
+	def from_bytes(cls, data):
+		"""
+		Build an archive instance from the bytes of an archive file
+
+		:param data: archive file contents, as bytes
+
+		:return: CompactArchive instance
+		"""
+		magic, version, flags, staff_count, period_count, row_count = _HEADER.unpack_from(data, 0)
+		if magic != ARCHIVE_MAGIC:
+			raise ValueError("Not a compact access archive")
+		if version != ARCHIVE_VERSION:
+			raise ValueError("Unsupported compact access archive version: {0}".format(version))
+		offset = _HEADER.size
+
+		staff = []
+		for i in range(staff_count):
+			length = data[offset]
+			staff.append(data[offset + 1:offset + 1 + length].decode("utf-8"))
+			offset += 1 + length
+
+		periods = []
+		for i in range(period_count):
+			periods.append(_PERIOD.unpack_from(data, offset))
+			offset += _PERIOD.size
+
+		columns = []
+		for type_code in _COLUMN_TYPES:
+			column, offset = _load_column(type_code, data, offset, row_count)
+			columns.append(column)
+
+		return cls(staff, periods, *columns)
+
+	def to_bytes(self):
+		"""
+		Serialise this archive into the binary archive layout
+
+		:return: archive file contents, as bytes
+		"""
+		parts = [_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, 0, len(self.staff), len(self.periods), len(self.epochs))]
+
+		for staff in self.staff:
+			encoded = staff.encode("utf-8")
+			if len(encoded) > MAX_STAFF_ID_BYTES:
+				raise ValueError("Staff id is longer than {0} bytes: {1!r}".format(MAX_STAFF_ID_BYTES, staff))
+			parts.append(bytes([len(encoded)]) + encoded)
+
+		for period in self.periods:
+			parts.append(_PERIOD.pack(*period))
+
+		for column in (self.epochs, self.temps, self.humidities, self.counts):
+			if sys.byteorder != "little":
+				column = array(column.typecode, column)
+				column.byteswap()
+			parts.append(column.tobytes())
+
+		return b"".join(parts)
+
+	def write(self, archive_file):
+		"""
+		Write this archive to disk in the binary archive layout
+
+		:param archive_file: path of the file to write, as string
+
+		:return: number of bytes written
+		"""
+		data = self.to_bytes()
+		with open(archive_file, "wb") as file:
+			file.write(data)
+
+		return len(data)
+
+	def write_csv_gz(self, csv_file):
+		"""
+		Write this archive to disk as a gzip compressed CSV data file in the same layout as the rig's access_data.csv,
+		this can be read back directly by the DesktopApp.py AccessPeriods class
+
+		:param csv_file: path of the file to write, as string (should end in ".gz")
+
+		:return: nothing
+		"""
+		with gzip.open(csv_file, "wt") as file:
+			for start, stop, period_length, staff_index, row_offset, row_count in self.periods:
+				staff = self.staff[staff_index]
+				file.write("{0},{1},{2},{3}\n".format("ACCESS-STARTED", *epoch_to_marker(start), staff))
+				for row in range(row_offset, row_offset + row_count):
+					file.write("{0},{1:.2f},{2:.2f},{3}\n".format(epoch_to_timestamp(self.epochs[row]),
+					                                               self.temps[row] / 100.0,
+					                                               self.humidities[row] / 100.0, staff))
+				file.write("{0},{1},{2},{3}\n".format("ACCESS-STOPPED", *epoch_to_marker(stop), period_length))
+
+	def readings(self, period_number):
+		"""
+		Generator of the rows of a single period in the period index
+
+		:param period_number: position of the period in the period index
+
+		:return: yields (epoch, temperature, humidity, merged count) tuples
+		"""
+		row_offset, row_count = self.periods[period_number][4:6]
+		for row in range(row_offset, row_offset + row_count):
+			yield self.epochs[row], self.temps[row] / 100.0, self.humidities[row] / 100.0, self.counts[row]
+
+	def to_access_periods(self):
+		"""
+		Convert this archive into a list of AccessPeriod class instances
+
+		:return: list of AccessPeriod instances
+		"""
+		from DesktopApp import AccessPeriod, DataReading
+
+		access_periods = []
+		for period_number, (start, stop, period_length, staff_index, row_offset, row_count) in enumerate(self.periods):
+			access_period = AccessPeriod(*epoch_to_marker(start), self.staff[staff_index])
+			for epoch, temp_data, humidity_data, count in self.readings(period_number):
+				access_period.add_data_reading(DataReading(epoch_to_timestamp(epoch), temp_data, humidity_data))
+			access_period.stop_date, access_period.stop_time = epoch_to_marker(stop)
+			access_period.period_length = period_length
+			access_periods.append(access_period)
+
+		return access_periods
+
+
+class LogCompactor:
+	"""
+	Class to read any number of access log files and build a single CompactArchive from them, access periods that
+	appear in more than one log (same start time and staff) are merged and readings that share the same second are
+	collapsed into one reading holding the mean temperature and humidity
+	"""
+	def __init__(self):
+		"""
+		Initialiser - instance variables:
+			__periods: dictionary of {(start epoch, staff): [stop epoch, period length, {epoch: [temp sum, humidity sum,
+			           count]}]}, property with no access
+			lines_read: number of lines read across all log files, as int
+			readings_read: number of data reading lines read across all log files, as int
+			lines_skipped: number of malformed lines or data readings outside of an access period, as int
+		"""
+		self.__periods = {}
+		self.lines_read = 0
+		self.readings_read = 0
+		self.lines_skipped = 0
+
+	def add_file(self, data_file):
+		"""
+		Read an access log file (plain CSV or gzip compressed CSV) and add its access periods to this compactor
+
+		:param data_file: path to the log file, as string
+
+		:return: nothing
+		"""
+		period = None
+		with open_data_file(data_file) as file:
+			for line in file:
+				self.lines_read += 1
+				entries = [entry.strip() for entry in line.split(",")]
+				try:
+					if entries[0] == "ACCESS-STARTED":
+						start = marker_to_epoch(entries[1], entries[2])
+						staff = entries[3] if len(entries) > 3 and entries[3] else None
+						period = [start, staff, start, 0, {}]
+					elif entries[0] == "ACCESS-STOPPED":
+						if period is None:
+							self.lines_skipped += 1
+							continue
+						period[2] = marker_to_epoch(entries[1], entries[2])
+						period[3] = int(entries[3])
+						self.__merge_period(period)
+						period = None
+					elif entries[0] == RIG_ID_MARKER:
+						continue
+					elif entries[0]:
+						if period is None:
+							self.lines_skipped += 1
+							continue
+						epoch = timestamp_to_epoch(entries[0])
+						readings = period[4].setdefault(epoch, [0.0, 0.0, 0])
+						readings[0] += float(entries[1])
+						readings[1] += float(entries[2])
+						readings[2] += 1
+						if period[1] is None and len(entries) > 3 and entries[3]:
+							period[1] = entries[3]
+						self.readings_read += 1
+				except (IndexError, ValueError):
+					self.lines_skipped += 1
+
+		# An access period that was never stopped (e.g. the rig lost power) is kept and closed at its last reading
+		if period is not None:
+			if period[4]:
+				period[2] = max(period[4])
+				period[3] = period[2] - period[0]
+			self.__merge_period(period)
+
+	def add_access_periods(self, access_periods):
+		"""
+		Add access periods that are already loaded (e.g. from an existing archive) to this compactor
+
+		:param access_periods: iterable of AccessPeriod class instances
+
+		:return: nothing
+		"""
+		for access_period in access_periods:
+			readings = {}
+			for data_reading in access_period.data_readings:
+				merged = readings.setdefault(data_reading.epoch, [0.0, 0.0, 0])
+				merged[0] += data_reading.temp_data
+				merged[1] += data_reading.humidity_data
+				merged[2] += 1
+			self.readings_read += len(access_period.data_readings)
+			self.__merge_period([access_period.start_epoch, access_period.staff, access_period.stop_epoch,
+			                     access_period.period_length or 0, readings])
+
+	def __merge_period(self, period):
+		"""
+		Merge a parsed period into the periods already held, keyed on its start time and staff id
+		"""
+		start, staff, stop, period_length, readings = period
+		key = (start, staff if staff is not None else "None")
+		if key not in self.__periods:
+			self.__periods[key] = [stop, period_length, readings]
+			return
+
+		existing = self.__periods[key]
+		existing[0] = max(existing[0], stop)
+		existing[1] = max(existing[1], period_length)
+		for epoch, (temp_sum, humidity_sum, count) in readings.items():
+			merged = existing[2].setdefault(epoch, [0.0, 0.0, 0])
+			merged[0] += temp_sum
+			merged[1] += humidity_sum
+			merged[2] += count
+
+	def build(self):
+		"""
+		Build the compact archive from all the log files added so far, periods are sorted by start time and the rows of
+		each period by time
+
+		:return: CompactArchive instance
+		"""
+		staff_ids = []
+		staff_indexes = {}
+		periods = []
+		epochs = array(_COLUMN_TYPES[0])
+		temps = array(_COLUMN_TYPES[1])
+		humidities = array(_COLUMN_TYPES[2])
+		counts = array(_COLUMN_TYPES[3])
+
+		for (start, staff), (stop, period_length, readings) in sorted(self.__periods.items()):
+			if staff not in staff_indexes:
+				staff_indexes[staff] = len(staff_ids)
+				staff_ids.append(staff)
+
+			row_offset = len(epochs)
+			for epoch in sorted(readings):
+				temp_sum, humidity_sum, count = readings[epoch]
+				epochs.append(epoch)
+				temps.append(int(round(temp_sum * 100.0 / count)))
+				humidities.append(int(round(humidity_sum * 100.0 / count)))
+				counts.append(min(count, 0xffff))
+			periods.append((start, stop, period_length, staff_indexes[staff], row_offset, len(epochs) - row_offset))
+
+		return CompactArchive(staff_ids, periods, epochs, temps, humidities, counts)
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Compact PPW2 access logs into a sorted binary columnar archive")
+	parser.add_argument("archive", help="path of the compact archive to write")
+	parser.add_argument("logs", nargs="+", help="access log files to read (.csv or .csv.gz)")
+	parser.add_argument("--csv-gz", metavar="PATH", help="also write a gzip compressed CSV copy to PATH")
+	args = parser.parse_args(argv)
+
+	compactor = LogCompactor()
+	for data_file in args.logs:
+		compactor.add_file(data_file)
+	archive = compactor.build()
+	size = archive.write(args.archive)
+	if args.csv_gz:
+		archive.write_csv_gz(args.csv_gz)
+
+	print("Read {0} lines ({1} readings, {2} skipped) from {3} file(s)".format(compactor.lines_read,
+	      compactor.readings_read, compactor.lines_skipped, len(args.logs)))
+	print("Wrote {0} periods, {1} rows, {2} bytes to [{3}]".format(len(archive.periods), len(archive.epochs), size,
+	      args.archive))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
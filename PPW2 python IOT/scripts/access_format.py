@@ -0,0 +1,89 @@
+# File: access_format.py
+# Description: Timestamp, marker and data file helpers for the PPW2 access data format, shared by DesktopApp.py and the
+#              archive modules it reads (access_compact.py, gorilla_archive.py) so they do not import each other
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import calendar
+import gzip
+import time
+
+
+# Constants
+RIG_ID_MARKER = "RIG-ID"  # First line of an access data file, followed by the unique id of the rig that wrote it
+
+
+# Functions
+def timestamp_to_epoch(timestamp):
+	"""
+	Convert a data reading timestamp as written by the IoT rig (e.g. "2019-5-17|15:34:12") into the number of seconds
+	since 00:00:00 01-01-1970, note: the rig has no timezone support so all times are treated as UTC
+
+	:param timestamp: data reading timestamp, as string
+
+	:return: seconds since the epoch, as int
+	"""
+	date_part, time_part = timestamp.strip().split("|")
+	year, month, day = date_part.split("-")
+	hour, minute, second = time_part.split(":")
+
+	return calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+
+
+def marker_to_epoch(date_str, time_str):
+	"""
+	Convert the date and time of an ACCESS-STARTED or ACCESS-STOPPED line (e.g. "17/5/2019" and "15:34:12") into the
+	number of seconds since 00:00:00 01-01-1970
+
+	:param date_str: marker date, as string
+	:param time_str: marker time, as string
+
+	:return: seconds since the epoch, as int
+	"""
+	day, month, year = date_str.strip().split("/")
+	hour, minute, second = time_str.strip().split(":")
+
+	return calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+
+
+def epoch_to_timestamp(epoch):
+	"""
+	Convert seconds since the epoch back into a data reading timestamp in the same (unpadded) format the rig writes
+
+	:param epoch: seconds since the epoch, as int
+
+	:return: data reading timestamp, as string
+	"""
+	tm = time.gmtime(epoch)
+
+	return "{0}-{1}-{2}|{3}:{4}:{5}".format(tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec)
+
+
+def epoch_to_marker(epoch):
+	"""
+	Convert seconds since the epoch back into the date and time strings used by ACCESS-STARTED and ACCESS-STOPPED lines
+
+	:param epoch: seconds since the epoch, as int
+
+	:return: (date string, time string) tuple
+	"""
+	tm = time.gmtime(epoch)
+
+	return ("{0}/{1}/{2}".format(tm.tm_mday, tm.tm_mon, tm.tm_year),
+	        "{0}:{1}:{2}".format(tm.tm_hour, tm.tm_min, tm.tm_sec))
+
+
+def open_data_file(data_file):
+	"""
+	Open a text data file for reading, data files ending in ".gz" (as written by access_compact.py) are transparently
+	decompressed
+
+	:param data_file: path to the data file, as string
+
+	:return: open text file object
+	"""
+	if data_file.endswith(".gz"):
+		return gzip.open(data_file, "rt")
+
+	return open(data_file, "r")
@@ -0,0 +1,346 @@
+# File: access_server.py
+# Description: Local asyncio HTTP/JSON query API for PPW2 access data, loads the access periods once, keeps them
+#              indexed in memory and answers queries for period lists, per-staff summaries and time window readings
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import asyncio
+import json
+from urllib.parse import urlsplit, parse_qs, unquote
+from DesktopApp import AccessPeriods, PERCENTILES, timestamp_to_epoch
+from plot_tiers import DownsampleTiers
+from query_cache import CachedAccessPeriods, DEFAULT_MAX_ENTRIES
+
+
+# Constants
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_PLOT_WIDTH = 800  # Pixel width used by /plot when no width parameter is given
+KEEP_ALIVE_TIMEOUT = 15  # Seconds an idle keep-alive connection is held open for
+READINGS_PER_CHUNK = 256  # Number of data readings sent in each chunk of a streamed response
+MAX_HEADER_LINES = 100
+MAX_BODY_SIZE = 8192  # Largest request body accepted (and discarded), larger requests are answered 413 and closed
+
+_STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+
+
+# Functions
+def parse_time(value):
+	"""
+	Convert a time query parameter into seconds since the epoch, the parameter can either be given as seconds since the
+	epoch or as a rig timestamp (e.g. "2019-5-17|15:34:12")
+
+	:param value: query parameter value, as string, or None
+
+	:return: seconds since the epoch, as int, or None if no value was given
+	"""
+	if value is None or value == "":
+		return None
+	if value.lstrip("-").isdigit():
+		return int(value)
+
+	return timestamp_to_epoch(value)
+
+
+def access_period_to_json(access_period):
+	"""
+	Convert an access period into a JSON serialisable dictionary (without its data readings)
+
+	:param access_period: AccessPeriod class instance
+
+	:return: dictionary
+	"""
+	return {"staff": access_period.staff,
+	        "start": "{0} {1}".format(access_period.start_date, access_period.start_time),
+	        "stop": "{0} {1}".format(access_period.stop_date, access_period.stop_time),
+	        "start_epoch": access_period.start_epoch,
+	        "stop_epoch": access_period.stop_epoch,
+	        "length": access_period.period_length,
+	        "readings": len(access_period.data_readings),
+	        "temp_max": access_period.temp_max,
+	        "humidity_average": access_period.humidity_average,
+	        "temp_percentiles": dict(zip(PERCENTILES, access_period.temp_sketch.quantiles(PERCENTILES))),
+	        "humidity_percentiles": dict(zip(PERCENTILES, access_period.humidity_sketch.quantiles(PERCENTILES)))}
+
+
+# Classes
+class HttpError(Exception):
+	"""
+	Exception raised by request handlers to send an HTTP error status and message back to the client
+	"""
+	def __init__(self, status, message):
+		super().__init__(message)
+		self.status = status
+
+
+class AccessDataServer:
+	"""
+	Class to serve access periods over HTTP/1.1 with JSON responses, connections are kept alive between requests and
+	readings are streamed using chunked transfer encoding, so a single process can serve hundreds of concurrent clients
+	without holding whole responses in memory
+	"""
+	def __init__(self, access_periods, host=DEFAULT_HOST, port=DEFAULT_PORT, plot_tiers=None):
+		"""
+		Initialiser - instance variables:
+			access_periods: AccessPeriods class instance to query
+			plot_tiers: DownsampleTiers class instance used to answer /plot queries, or None
+			host: address to listen on, as string
+			port: port to listen on, as int
+			requests_served: number of requests answered since the server started, as int
+			__server: asyncio server once started, property with no access
+
+		:param access_periods: AccessPeriods (or CachedAccessPeriods) class instance, already loaded
+		:param host: address to listen on, as string
+		:param port: port to listen on, as int
+		:param plot_tiers: optional DownsampleTiers class instance built from the same access periods
+		"""
+		self.access_periods = access_periods
+		self.plot_tiers = plot_tiers
+		self.host = host
+		self.port = port
+		self.requests_served = 0
+		self.__server = None
+
+	async def start(self):
+		"""
+		Start listening for connections
+
+		:return: nothing
+		"""
+		self.__server = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=512)
+		self.port = self.__server.sockets[0].getsockname()[1]
+
+	async def serve_forever(self):
+		"""
+		Start listening (if not already) and serve connections until cancelled
+
+		:return: nothing
+		"""
+		if self.__server is None:
+			await self.start()
+		async with self.__server:
+			await self.__server.serve_forever()
+
+	def close(self):
+		"""
+		Stop listening for connections
+
+		:return: nothing
+		"""
+		if self.__server is not None:
+			self.__server.close()
+
+	async def handle_connection(self, reader, writer):
+		"""
+		Serve requests on a single client connection until the client closes it, asks for it to be closed or it is
+		idle for longer than the keep-alive timeout, every read is given the keep-alive timeout and a request line or
+		header too long for the stream reader's limit is answered with a 400 response
+		"""
+		try:
+			while True:
+				try:
+					request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+				except asyncio.TimeoutError:
+					break
+				except ValueError:
+					await self.send_json(writer, 400, {"error": "Request line too long"}, False)
+					break
+				if not request_line.strip():
+					break
+
+				parts = request_line.decode("latin-1").split()
+				if len(parts) != 3:
+					await self.send_json(writer, 400, {"error": "Malformed request line"}, False)
+					break
+				method, target, version = parts
+
+				headers = {}
+				try:
+					for i in range(MAX_HEADER_LINES):
+						line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+						if not line.strip():
+							break
+						name, _, value = line.decode("latin-1").partition(":")
+						headers[name.strip().lower()] = value.strip()
+					else:
+						raise ValueError("too many header lines")
+				except ValueError:
+					await self.send_json(writer, 400, {"error": "Malformed request headers"}, False)
+					break
+
+				# Request bodies are not used by any endpoint but must be consumed to keep the connection usable
+				content_length = headers.get("content-length", "0")
+				content_length = int(content_length) if content_length.isdigit() else 0
+				if content_length > MAX_BODY_SIZE:
+					await self.send_json(writer, 413, {"error": "Request body too large"}, False)
+					break
+				if content_length:
+					await asyncio.wait_for(reader.readexactly(content_length), KEEP_ALIVE_TIMEOUT)
+
+				connection = headers.get("connection", "").lower()
+				keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+				chunked = version == "HTTP/1.1"
+
+				keep_alive = await self.handle_request(writer, method, target, keep_alive, chunked) and keep_alive
+				self.requests_served += 1
+				if not keep_alive:
+					break
+		except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+			pass
+		finally:
+			writer.close()
+
+	async def handle_request(self, writer, method, target, keep_alive, chunked):
+		"""
+		Route a single request to its endpoint and send the response
+
+		:return: False if the connection must be closed after this response, True otherwise
+		"""
+		url = urlsplit(target)
+		query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+		path = [unquote(part) for part in url.path.split("/") if part]
+
+		try:
+			if method != "GET":
+				raise HttpError(405, "Only GET requests are supported")
+			start = parse_time(query.get("start"))
+			stop = parse_time(query.get("stop"))
+			staff = query.get("staff")
+
+			if path == ["periods"]:
+				periods = self.access_periods.query_access_periods(start, stop, staff)
+				await self.send_json(writer, 200, [access_period_to_json(period) for period in periods], keep_alive)
+			elif path == ["staff"]:
+				await self.send_json(writer, 200, self.access_periods.query_staff_summaries(start, stop, staff),
+				                     keep_alive)
+			elif len(path) == 2 and path[0] == "staff":
+				summaries = self.access_periods.query_staff_summaries(start, stop, path[1])
+				if path[1] not in summaries:
+					raise HttpError(404, "No access periods for staff {0}".format(path[1]))
+				await self.send_json(writer, 200, summaries[path[1]], keep_alive)
+			elif path == ["readings"]:
+				return await self.stream_readings(writer, start, stop, staff, keep_alive, chunked)
+			elif path == ["plot"]:
+				if self.plot_tiers is None:
+					raise HttpError(404, "Plot tiers are not available")
+				width = int(query.get("width", DEFAULT_PLOT_WIDTH))
+				if width < 1:
+					raise ValueError("width must be at least 1")
+				await self.send_json(writer, 200, self.plot_tiers.query(query.get("metric", "temp"), width, start, stop),
+				                     keep_alive)
+			elif path == ["stats"]:
+				cache = getattr(self.access_periods, "cache", None)
+				await self.send_json(writer, 200, {"periods": len(self.access_periods),
+				                                   "requests_served": self.requests_served,
+				                                   "cache": cache.stats() if cache else None}, keep_alive)
+			else:
+				raise HttpError(404, "Unknown endpoint /{0}".format("/".join(path)))
+		except HttpError as error:
+			await self.send_json(writer, error.status, {"error": str(error)}, keep_alive)
+		except ValueError as error:
+			await self.send_json(writer, 400, {"error": "Invalid parameter: {0}".format(error)}, keep_alive)
+
+		return True
+
+	async def send_json(self, writer, status, payload, keep_alive):
+		"""
+		Send a complete JSON response with a content length
+		"""
+		body = json.dumps(payload).encode("utf-8")
+		writer.write(self.response_head(status, keep_alive, content_length=len(body)) + body)
+		await writer.drain()
+
+	async def stream_readings(self, writer, start, stop, staff, keep_alive, chunked):
+		"""
+		Stream the data readings within a time window as a JSON array, HTTP/1.1 clients receive the array in chunks
+		and keep their connection, HTTP/1.0 clients receive it unchunked and the connection is then closed
+
+		:return: False if the connection must be closed after this response, True otherwise
+		"""
+		if not chunked:
+			keep_alive = False
+		writer.write(self.response_head(200, keep_alive, chunked=chunked))
+
+		def send(data):
+			data = data.encode("utf-8")
+			writer.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+
+		batch = []
+		separator = "["
+		for access_period, data_reading in self.access_periods.query_data_readings(start, stop, staff):
+			batch.append("{0}{1}".format(separator, json.dumps({"staff": access_period.staff,
+			                                                    "timestamp": data_reading.timestamp,
+			                                                    "epoch": data_reading.epoch,
+			                                                    "temp": data_reading.temp_data,
+			                                                    "humidity": data_reading.humidity_data})))
+			separator = ","
+			if len(batch) >= READINGS_PER_CHUNK:
+				send("".join(batch))
+				batch = []
+				# Let other connections run while this client drains its socket buffer
+				await writer.drain()
+
+		batch.append("[]" if separator == "[" else "]")
+		send("".join(batch))
+		if chunked:
+			writer.write(b"0\r\n\r\n")
+		await writer.drain()
+
+		return keep_alive
+
+	@staticmethod
+	def response_head(status, keep_alive, content_length=None, chunked=False):
+		"""
+		Build the status line and headers of a response
+
+		:return: response head, as bytes
+		"""
+		lines = ["HTTP/1.1 {0} {1}".format(status, _STATUS_TEXT.get(status, "")),
+		         "Content-Type: application/json",
+		         "Connection: {0}".format("keep-alive" if keep_alive else "close")]
+		if keep_alive:
+			lines.append("Keep-Alive: timeout={0}".format(KEEP_ALIVE_TIMEOUT))
+		if content_length is not None:
+			lines.append("Content-Length: {0}".format(content_length))
+		if chunked:
+			lines.append("Transfer-Encoding: chunked")
+
+		return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Serve PPW2 access data as a local HTTP/JSON API")
+	parser.add_argument("data_file", nargs="?", default="access_data.csv",
+	                    help="access data file to load (.csv, .csv.gz or compact archive)")
+	parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on")
+	parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+	parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_ENTRIES,
+	                    help="number of query results to cache, 0 to disable the cache")
+	args = parser.parse_args(argv)
+
+	access_periods = AccessPeriods(args.data_file)
+	plot_tiers = DownsampleTiers(access_periods)
+	if args.cache_size > 0:
+		access_periods = CachedAccessPeriods(access_periods, args.cache_size)
+	server = AccessDataServer(access_periods, args.host, args.port, plot_tiers)
+
+	print("Serving {0} access periods from [{1}] on http://{2}:{3}/".format(len(access_periods), args.data_file,
+	      args.host, args.port))
+	print("Endpoints: /periods, /staff, /staff/<id>, /readings (parameters: start, stop, staff), /plot (parameters: "
+	      "metric, width, start, stop) and /stats")
+	try:
+		asyncio.run(server.serve_forever())
+	except KeyboardInterrupt:
+		print("Finished")
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
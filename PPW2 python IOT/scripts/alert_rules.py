@@ -0,0 +1,427 @@
+# File: alert_rules.py
+# Description: Incremental alert rule engine for PPW2 access data, rules such as "temp_max > 30 and occupied" are
+#              compiled once into predicate closures over running statistics and evaluated per data reading as readings
+#              are ingested or once per completed access period
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import ast
+import operator
+from DesktopApp import AccessPeriods, dewpoint, epoch_to_timestamp
+
+
+# Constants
+SCOPES = ("reading", "period")
+
+# Metrics rules may use, the reading metrics describe the latest data reading and the period metrics are running
+# statistics of the access period the reading belongs to
+READING_METRICS = ("epoch", "temp", "humidity", "dewpoint", "occupied")
+PERIOD_METRICS = ("readings", "seconds", "temp_min", "temp_max", "temp_average", "humidity_min", "humidity_max",
+                  "humidity_average", "dewpoint_max")
+METRICS = READING_METRICS + PERIOD_METRICS
+
+_FUNCTIONS = {"abs": abs, "min": min, "max": max}
+_BINARY_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+_COMPARE_OPERATORS = {ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+                      ast.Eq: operator.eq, ast.NotEq: operator.ne}
+
+
+# Functions
+def _compile_node(node, metrics):
+	"""
+	Compile one expression syntax tree node into a closure taking the statistics dictionary, the metric names used are
+	added to metrics
+	"""
+	if isinstance(node, ast.Expression):
+		return _compile_node(node.body, metrics)
+
+	if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+		value = node.value
+		return lambda stats: value
+
+	if isinstance(node, ast.Name):
+		if node.id not in METRICS:
+			raise ValueError("Unknown metric: {0}".format(node.id))
+		name = node.id
+		metrics.add(name)
+		return lambda stats: stats[name]
+
+	if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.Not)):
+		operand = _compile_node(node.operand, metrics)
+		if isinstance(node.op, ast.USub):
+			return lambda stats: -operand(stats)
+		return lambda stats: not operand(stats)
+
+	if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+		function = _BINARY_OPERATORS[type(node.op)]
+		left = _compile_node(node.left, metrics)
+		right = _compile_node(node.right, metrics)
+		return lambda stats: function(left(stats), right(stats))
+
+	if isinstance(node, ast.BoolOp):
+		operands = [_compile_node(value, metrics) for value in node.values]
+		if len(operands) == 2:
+			first, second = operands
+			if isinstance(node.op, ast.And):
+				return lambda stats: first(stats) and second(stats)
+			return lambda stats: first(stats) or second(stats)
+		if isinstance(node.op, ast.And):
+			return lambda stats: all(operand(stats) for operand in operands)
+		return lambda stats: any(operand(stats) for operand in operands)
+
+	if isinstance(node, ast.Compare) and all(type(op) in _COMPARE_OPERATORS for op in node.ops):
+		operands = [_compile_node(node.left, metrics)] + [_compile_node(value, metrics) for value in node.comparators]
+		functions = [_COMPARE_OPERATORS[type(op)] for op in node.ops]
+		if len(functions) == 1:
+			# The usual single comparison, e.g. "temp_max > 30", without the chained comparison loop
+			function, left, right = functions[0], operands[0], operands[1]
+			return lambda stats: function(left(stats), right(stats))
+
+		def compare(stats):
+			values = [operand(stats) for operand in operands]
+			return all(function(values[i], values[i + 1]) for i, function in enumerate(functions))
+		return compare
+
+	if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS \
+			and not node.keywords:
+		function = _FUNCTIONS[node.func.id]
+		arguments = [_compile_node(argument, metrics) for argument in node.args]
+		return lambda stats: function(*[argument(stats) for argument in arguments])
+
+	raise ValueError("Unsupported expression: {0}".format(ast.dump(node)))
+
+
+def compile_expression(expression):
+	"""
+	Compile a rule expression into a predicate closure, expressions use the metric names in METRICS, numbers, the
+	arithmetic operators + - * /, comparisons, and, or, not and the functions abs(), min() and max(), e.g.
+	"temp_max > 30 and occupied" or "temp - dewpoint <= 2", nothing is passed to eval()
+
+	:param expression: rule expression, as string
+
+	:return: (closure taking a statistics dictionary and returning the result, set of metric names used) tuple
+	"""
+	metrics = set()
+	try:
+		tree = ast.parse(expression, mode="eval")
+	except SyntaxError as error:
+		raise ValueError("Invalid expression: {0}".format(expression)) from error
+
+	return _compile_node(tree, metrics), metrics
+
+
+# Classes
+class AlertRule:
+	"""
+	Class to hold a single compiled alert rule, reading scope rules are evaluated after every data reading and raise an
+	alert when they become true (at most once per access period), period scope rules are evaluated once when an access
+	period completes
+	"""
+	def __init__(self, name, expression, scope="reading"):
+		"""
+		Initialiser - instance variables:
+			name: name of the rule, as string
+			expression: rule expression, as string
+			scope: "reading" or "period"
+			predicate: compiled closure taking the statistics dictionary
+			metrics: set of metric names the rule uses
+
+		:param name: name of the rule, as string
+		:param expression: rule expression, as string (see compile_expression())
+		:param scope: "reading" or "period"
+		"""
+		if scope not in SCOPES:
+			raise ValueError("Unknown scope: {0}".format(scope))
+		self.name = name
+		self.expression = expression
+		self.scope = scope
+		self.predicate, self.metrics = compile_expression(expression)
+
+	def __repr__(self):
+		return "AlertRule({0!r}, {1!r}, {2!r})".format(self.name, self.expression, self.scope)
+
+
+class Alert:
+	"""
+	Class to hold an alert raised by a rule
+	"""
+	def __init__(self, rule, staff, epoch, stats):
+		"""
+		Initialiser - instance variables:
+			rule: AlertRule class instance that raised the alert
+			staff: staff id of the access period, as string
+			epoch: time of the data reading that raised the alert (or the last reading of the period for period
+			       scope rules), in seconds since the epoch
+			values: dictionary of the values of the metrics the rule uses at the time of the alert
+
+		:param rule: AlertRule class instance
+		:param staff: staff id, as string
+		:param epoch: seconds since the epoch, as int
+		:param stats: statistics dictionary the rule was evaluated against
+		"""
+		self.rule = rule
+		self.staff = staff
+		self.epoch = epoch
+		self.values = {name: stats[name] for name in sorted(rule.metrics)}
+
+	def __str__(self):
+		"""
+		To string method
+
+		:return: string representation of this alert instance
+		"""
+		values = ", ".join("{0}={1:.2f}".format(name, float(value)) for name, value in self.values.items())
+		return "{0} [{1}] staff {2}: {3} ({4})".format(epoch_to_timestamp(self.epoch), self.rule.name, self.staff,
+		                                               self.rule.expression, values)
+
+
+class RuleError:
+	"""
+	Class to hold an arithmetic error (e.g. a division by zero) raised while evaluating a rule
+	"""
+	def __init__(self, rule, staff, epoch, error):
+		"""
+		Initialiser - instance variables:
+			rule: AlertRule class instance that raised the error
+			staff: staff id of the access period, as string
+			epoch: time of the data reading the rule was evaluated after, in seconds since the epoch
+			error: the ArithmeticError raised
+
+		:param rule: AlertRule class instance
+		:param staff: staff id, as string
+		:param epoch: seconds since the epoch, as int
+		:param error: ArithmeticError instance
+		"""
+		self.rule = rule
+		self.staff = staff
+		self.epoch = epoch
+		self.error = error
+
+	def __str__(self):
+		"""
+		To string method
+
+		:return: string representation of this rule error instance
+		"""
+		return "{0} [{1}] staff {2}: {3} (error: {4})".format(epoch_to_timestamp(self.epoch), self.rule.name,
+		                                                      self.staff, self.rule.expression, self.error)
+
+
+class AlertEngine:
+	"""
+	Class to evaluate alert rules incrementally, the running statistics of the current access period are updated once
+	per data reading (dewpoint only if a rule uses it) and every reading scope rule's compiled predicate is then called
+	against them, so the cost per reading is one statistics update plus one closure call per rule, a rule raising an
+	arithmetic error (e.g. dividing by a metric that is 0) is treated as false and reported in errors rather than
+	stopping the evaluation
+	"""
+	def __init__(self, rules=(), access_periods=None):
+		"""
+		Initialiser - instance variables:
+			__rules: dictionary of {scope: list of AlertRule}, property with no access
+			__uses_dewpoint: True if any rule uses a dewpoint metric, property with no access
+			__stats: statistics dictionary of the current access period, property with no access
+			__fired: set of names of the reading scope rules already raised during the current access period,
+			         property with no access
+			__errored: set of names of the rules that have already raised an error during the current access period,
+			           property with no access
+			__staff: staff id of the current access period, property with no access
+			__alert_listeners: list of callables called with each alert raised, property with no access
+			alerts: list of Alert class instances raised
+			errors: list of RuleError class instances, at most one per rule per access period
+
+		:param rules: iterable of AlertRule class instances
+		:param access_periods: optional AccessPeriods class instance, access periods later added to it are evaluated
+		                       as they are ingested
+		"""
+		self.__rules = {scope: [] for scope in SCOPES}
+		self.__uses_dewpoint = False
+		self.__stats = None
+		self.__fired = set()
+		self.__errored = set()
+		self.__staff = None
+		self.__alert_listeners = []
+		self.alerts = []
+		self.errors = []
+		for rule in rules:
+			self.add_rule(rule)
+		if access_periods is not None:
+			access_periods.add_ingest_listener(self.on_ingest)
+
+	def add_rule(self, rule):
+		"""
+		Add an alert rule
+
+		:param rule: AlertRule class instance
+
+		:return: nothing
+		"""
+		self.__rules[rule.scope].append(rule)
+		self.__uses_dewpoint = self.__uses_dewpoint or bool(rule.metrics & {"dewpoint", "dewpoint_max"})
+
+	def add_alert_listener(self, listener):
+		"""
+		Register a callable to be called with every alert raised
+
+		:param listener: callable taking an Alert class instance
+
+		:return: nothing
+		"""
+		self.__alert_listeners.append(listener)
+
+	def __raise(self, rule, epoch):
+		alert = Alert(rule, self.__staff, epoch, self.__stats)
+		self.alerts.append(alert)
+		for listener in self.__alert_listeners:
+			listener(alert)
+
+	def __evaluate(self, rule, stats):
+		"""
+		Evaluate a rule's predicate, an arithmetic error is recorded (once per rule per access period) and the rule is
+		treated as false
+		"""
+		try:
+			return rule.predicate(stats)
+		except ArithmeticError as error:
+			if rule.name not in self.__errored:
+				self.__errored.add(rule.name)
+				self.errors.append(RuleError(rule, self.__staff, stats["epoch"], error))
+			return False
+
+	def start_period(self, staff, epoch):
+		"""
+		Start a new access period, resetting the running statistics
+
+		:param staff: staff id of the access period, as string ("None" if unoccupied)
+		:param epoch: start of the access period in seconds since the epoch, as int
+
+		:return: nothing
+		"""
+		self.__staff = staff
+		self.__fired = set()
+		self.__errored = set()
+		self.__stats = {"epoch": epoch, "start": epoch, "temp": None, "humidity": None, "dewpoint": None,
+		                "occupied": staff not in (None, "", "None"), "readings": 0, "seconds": 0, "temp_min": None,
+		                "temp_max": None, "temp_average": None, "temp_total": 0.0, "humidity_min": None,
+		                "humidity_max": None, "humidity_average": None, "humidity_total": 0.0, "dewpoint_max": None}
+
+	def add_reading(self, epoch, temp_data, humidity_data):
+		"""
+		Update the running statistics with a data reading of the current access period and evaluate the reading scope
+		rules
+
+		:param epoch: time of the reading in seconds since the epoch, as int
+		:param temp_data: temperature, as float
+		:param humidity_data: humidity, as float
+
+		:return: nothing
+		"""
+		stats = self.__stats
+		if stats is None:
+			raise ValueError("add_reading() called before start_period()")
+
+		stats["epoch"] = epoch
+		stats["temp"] = temp_data
+		stats["humidity"] = humidity_data
+		stats["readings"] += 1
+		stats["seconds"] = epoch - stats["start"]
+		if stats["readings"] == 1:
+			stats["temp_min"] = stats["temp_max"] = temp_data
+			stats["humidity_min"] = stats["humidity_max"] = humidity_data
+		else:
+			if temp_data < stats["temp_min"]:
+				stats["temp_min"] = temp_data
+			elif temp_data > stats["temp_max"]:
+				stats["temp_max"] = temp_data
+			if humidity_data < stats["humidity_min"]:
+				stats["humidity_min"] = humidity_data
+			elif humidity_data > stats["humidity_max"]:
+				stats["humidity_max"] = humidity_data
+		stats["temp_total"] += temp_data
+		stats["humidity_total"] += humidity_data
+		stats["temp_average"] = stats["temp_total"] / stats["readings"]
+		stats["humidity_average"] = stats["humidity_total"] / stats["readings"]
+		if self.__uses_dewpoint:
+			point = stats["dewpoint"] = dewpoint(temp_data, humidity_data)
+			if stats["dewpoint_max"] is None or point > stats["dewpoint_max"]:
+				stats["dewpoint_max"] = point
+
+		fired = self.__fired
+		for rule in self.__rules["reading"]:
+			if rule.name not in fired and self.__evaluate(rule, stats):
+				fired.add(rule.name)
+				self.__raise(rule, epoch)
+
+	def end_period(self):
+		"""
+		Complete the current access period and evaluate the period scope rules against its final statistics
+
+		:return: nothing
+		"""
+		stats = self.__stats
+		if stats is None:
+			return
+		if stats["readings"]:
+			for rule in self.__rules["period"]:
+				if self.__evaluate(rule, stats):
+					self.__raise(rule, stats["epoch"])
+		self.__stats = None
+
+	def on_ingest(self, access_period):
+		"""
+		Ingest listener, evaluate the rules over a newly added access period
+
+		:param access_period: AccessPeriod class instance that has just been added
+
+		:return: nothing
+		"""
+		self.start_period(access_period.staff, access_period.start_epoch)
+		for data_reading in access_period.data_readings:
+			self.add_reading(data_reading.epoch, data_reading.temp_data, data_reading.humidity_data)
+		self.end_period()
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Evaluate alert rules over PPW2 access data")
+	parser.add_argument("data_files", nargs="+", help="access data files to check")
+	parser.add_argument("--rule", action="append", default=[], metavar="NAME=EXPRESSION",
+	                    help="reading scope rule, evaluated after every data reading (may be repeated)")
+	parser.add_argument("--period-rule", action="append", default=[], metavar="NAME=EXPRESSION",
+	                    help="period scope rule, evaluated once per completed access period (may be repeated)")
+	args = parser.parse_args(argv)
+
+	rules = []
+	for scope, specs in (("reading", args.rule), ("period", args.period_rule)):
+		for spec in specs:
+			name, separator, expression = spec.partition("=")
+			if not separator:
+				parser.error("rules must be given as NAME=EXPRESSION: {0}".format(spec))
+			rules.append(AlertRule(name.strip(), expression.strip(), scope))
+	if not rules:
+		rules = [AlertRule("hot-occupied", "temp_max > 30 and occupied", "period"),
+		         AlertRule("condensation", "temp - dewpoint <= 2")]
+
+	access_periods = AccessPeriods()
+	engine = AlertEngine(rules, access_periods)
+	for data_file in args.data_files:
+		for access_period in AccessPeriods(data_file):
+			access_periods.add_access_period(access_period)
+
+	for alert in engine.alerts:
+		print(alert)
+	for error in engine.errors:
+		print(error)
+	print("{0} alert(s) and {1} rule error(s) from {2} rule(s) over {3} access periods".format(
+		len(engine.alerts), len(engine.errors), len(rules), len(access_periods)))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
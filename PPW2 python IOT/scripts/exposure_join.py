@@ -0,0 +1,281 @@
+# File: exposure_join.py
+# Description: Streaming sorted merge-join (as-of join on timestamp) of RFID access events with the environmental
+#              readings of one or more rigs, giving the environmental exposure of each person in linear time
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import heapq
+from DesktopApp import AccessPeriods, timestamp_to_epoch, open_data_file
+
+
+# Constants
+DEFAULT_MAX_GAP = 30  # Longest gap in seconds between two readings of a rig that still counts as exposure time
+EVENT_IN = "IN"
+EVENT_OUT = "OUT"
+EVENT_SET = "SET"  # Event carrying the (single) occupant of the room as published by mfrc522_read_example.py
+
+
+# Functions
+def event_order(event):
+	"""
+	Sort key of an access event, by time with OUT events after the other events of the same second, so a reading taken
+	in the second someone leaves is still credited to them and back to back access periods never drop the occupant
+	"""
+	return event[0], event[3] == EVENT_OUT
+
+
+def read_access_events(data_file, rig_id=None):
+	"""
+	Generator of access events from an access event log, each line is "timestamp,staff" (the room's occupant as
+	published by the RFID reader app, "None" when the room is empty) or "timestamp,staff,IN|OUT", lines must be in time
+	order and malformed lines are skipped
+
+	:param data_file: path to the access event log (.csv or .csv.gz), as string
+	:param rig_id: rig whose room the log describes, as string, None if the events apply to every rig
+
+	:return: yields (epoch, rig id, staff or None, action) tuples
+	"""
+	with open_data_file(data_file) as file:
+		for line in file:
+			entries = [entry.strip() for entry in line.split(",")]
+			try:
+				epoch = timestamp_to_epoch(entries[0])
+			except (IndexError, ValueError):
+				continue
+			staff = entries[1] if len(entries) > 1 and entries[1] not in ("", "None") else None
+			action = entries[2].upper() if len(entries) > 2 and entries[2] else EVENT_SET
+			yield epoch, rig_id, staff, action
+
+
+def access_events_from_periods(access_periods, rig_id):
+	"""
+	Generator of IN/OUT access events from the start and stop of each access period of one rig, sorted by event_order(),
+	overlapping access periods of the same member of staff are counted so they give a single IN when the first starts
+	and a single OUT when the last stops
+
+	:param access_periods: AccessPeriods class instance holding the rig's access periods
+	:param rig_id: identifier of the rig, as string
+
+	:return: yields (epoch, rig id, staff, action) tuples
+	"""
+	events = []
+	for access_period in access_periods:
+		events.append((access_period.start_epoch, rig_id, access_period.staff, EVENT_IN))
+		events.append((access_period.stop_epoch, rig_id, access_period.staff, EVENT_OUT))
+	events.sort(key=event_order)
+
+	open_periods = {}
+	for event in events:
+		epoch, rig_id, staff, action = event
+		count = open_periods.get(staff, 0)
+		if action == EVENT_IN:
+			open_periods[staff] = count + 1
+			if not count:
+				yield event
+		elif count:
+			open_periods[staff] = count - 1
+			if count == 1:
+				yield event
+
+
+def rig_readings(access_periods, rig_id):
+	"""
+	Generator of the readings of one rig sorted by time, as needed by the merge-join
+
+	:param access_periods: AccessPeriods class instance holding the rig's readings
+	:param rig_id: identifier of the rig, as string
+
+	:return: yields (epoch, rig id, temperature, humidity) tuples
+	"""
+	readings = [(data_reading.epoch, rig_id, data_reading.temp_data, data_reading.humidity_data)
+	            for access_period in access_periods for data_reading in access_period.data_readings]
+	readings.sort(key=lambda reading: reading[0])
+
+	return iter(readings)
+
+
+def asof_join(events, readings):
+	"""
+	Generator joining each reading to the set of people present in its rig's room at its timestamp, i.e. the state of
+	that rig after the latest IN or SET event at or before the reading and the latest OUT event before it, both inputs
+	must be sorted by time (the events by event_order()) and are each read exactly once
+
+	:param events: iterable of (epoch, rig id, staff, action) access events, a rig id of None applies to every rig
+	:param readings: iterable of (epoch, rig id, ...) readings sorted by time
+
+	:return: yields (reading, frozenset of staff ids present) tuples
+	"""
+	events = iter(events)
+	present = {}  # {rig id: set of staff ids}, None holds the events that apply to every rig
+	snapshots = {}
+	pending = next(events, None)
+	for reading in readings:
+		while pending is not None and (pending[0] < reading[0] or pending[0] == reading[0] and pending[3] != EVENT_OUT):
+			epoch, rig_id, staff, action = pending
+			rig_present = present.setdefault(rig_id, set())
+			if action == EVENT_IN:
+				rig_present.add(staff)
+			elif action == EVENT_OUT:
+				rig_present.discard(staff)
+			else:
+				rig_present.clear()
+				if staff:
+					rig_present.add(staff)
+			if rig_id is None:
+				snapshots.clear()
+			else:
+				snapshots.pop(rig_id, None)
+			pending = next(events, None)
+
+		rig_id = reading[1]
+		snapshot = snapshots.get(rig_id)
+		if snapshot is None:
+			snapshot = snapshots[rig_id] = frozenset(present.get(rig_id, set()) | present.get(None, set()))
+		yield reading, snapshot
+
+
+def compute_exposure(events, reading_streams, max_gap=DEFAULT_MAX_GAP):
+	"""
+	Compute the environmental exposure of each person, the reading streams of all rigs are k-way merged by time and
+	as-of joined with the access events, each reading is credited to everyone present in its rig's room along with the
+	time since the rig's previous reading (capped at max_gap)
+
+	:param events: iterable of (epoch, rig id, staff, action) access events sorted by event_order()
+	:param reading_streams: list of iterables of (epoch, rig id, temperature, humidity), each sorted by time
+	:param max_gap: longest gap in seconds between two readings of a rig that still counts as exposure time
+
+	:return: dictionary of {staff id: Exposure}
+	"""
+	exposures = {}
+	last_epochs = {}
+	merged = heapq.merge(*reading_streams, key=lambda reading: reading[0])
+	for (epoch, rig_id, temp_data, humidity_data), present in asof_join(events, merged):
+		last_epoch = last_epochs.get(rig_id)
+		seconds = 0 if last_epoch is None else min(max(epoch - last_epoch, 0), max_gap)
+		last_epochs[rig_id] = epoch
+		for staff in present:
+			exposure = exposures.get(staff)
+			if exposure is None:
+				exposure = exposures[staff] = Exposure(staff)
+			exposure.add(rig_id, seconds, temp_data, humidity_data)
+
+	return exposures
+
+
+# Classes
+class Exposure:
+	"""
+	Class to hold the running environmental exposure of one person
+	"""
+	def __init__(self, staff):
+		"""
+		Initialiser - instance variables:
+			staff: staff id, as string
+			readings: number of readings taken while the person was present, as int
+			seconds: approximate number of seconds of exposure, as int
+			temp_max: maximum temperature, as float
+			humidity_max: maximum humidity, as float
+			rigs: set of rig ids whose readings were credited
+			__temp_weighted: sum of temperature multiplied by seconds, property with no access
+			__humidity_weighted: sum of humidity multiplied by seconds, property with no access
+			__temp_total: sum of temperatures, property with no access
+			__humidity_total: sum of humidities, property with no access
+
+		:param staff: staff id, as string
+		"""
+		self.staff = staff
+		self.readings = 0
+		self.seconds = 0
+		self.temp_max = None
+		self.humidity_max = None
+		self.rigs = set()
+		self.__temp_weighted = 0.0
+		self.__humidity_weighted = 0.0
+		self.__temp_total = 0.0
+		self.__humidity_total = 0.0
+
+	def add(self, rig_id, seconds, temp_data, humidity_data):
+		"""
+		Credit one reading to this person
+
+		:param rig_id: rig the reading came from, as string
+		:param seconds: seconds of exposure the reading stands for, as int
+		:param temp_data: temperature, as float
+		:param humidity_data: humidity, as float
+
+		:return: nothing
+		"""
+		self.readings += 1
+		self.seconds += seconds
+		self.rigs.add(rig_id)
+		self.temp_max = temp_data if self.temp_max is None else max(self.temp_max, temp_data)
+		self.humidity_max = humidity_data if self.humidity_max is None else max(self.humidity_max, humidity_data)
+		self.__temp_weighted += temp_data * seconds
+		self.__humidity_weighted += humidity_data * seconds
+		self.__temp_total += temp_data
+		self.__humidity_total += humidity_data
+
+	@property
+	def temp_average(self):
+		"""
+		Time weighted average temperature (plain average if no exposure time has been credited)
+		"""
+		if self.seconds:
+			return self.__temp_weighted / self.seconds
+		return self.__temp_total / self.readings if self.readings else None
+
+	@property
+	def humidity_average(self):
+		"""
+		Time weighted average humidity (plain average if no exposure time has been credited)
+		"""
+		if self.seconds:
+			return self.__humidity_weighted / self.seconds
+		return self.__humidity_total / self.readings if self.readings else None
+
+	def __str__(self):
+		"""
+		To string method
+
+		:return: string representation of this exposure instance
+		"""
+		return "Staff: {0} {1} readings, {2} seconds from {3} rig(s), temp ave {4:.2f}c max {5}c, " \
+		       "humidity ave {6:.2f}% max {7}%".format(self.staff, self.readings, self.seconds, len(self.rigs),
+		                                             self.temp_average, self.temp_max, self.humidity_average,
+		                                             self.humidity_max)
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Join RFID access events with rig readings to give exposure per person")
+	parser.add_argument("rig_logs", nargs="+", help="access data files, one per rig")
+	parser.add_argument("--events", help="access event log (timestamp,staff[,IN|OUT]), by default the access periods "
+	                                     "of each rig log are used as that rig's events")
+	parser.add_argument("--events-rig", help="rig log whose room the access event log describes, by default the events "
+	                                         "apply to every rig")
+	parser.add_argument("--max-gap", type=int, default=DEFAULT_MAX_GAP,
+	                    help="longest gap in seconds between readings that counts as exposure time")
+	args = parser.parse_args(argv)
+
+	rigs = [(data_file, AccessPeriods(data_file)) for data_file in args.rig_logs]
+	if args.events:
+		events = read_access_events(args.events, args.events_rig)
+	else:
+		events = heapq.merge(*[access_events_from_periods(access_periods, data_file)
+		                       for data_file, access_periods in rigs], key=event_order)
+
+	exposures = compute_exposure(events, [rig_readings(access_periods, data_file) for data_file, access_periods in rigs],
+	                             args.max_gap)
+	for staff in sorted(exposures):
+		print(exposures[staff])
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
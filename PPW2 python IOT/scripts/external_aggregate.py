@@ -0,0 +1,321 @@
+# File: external_aggregate.py
+# Description: Bounded memory external aggregation of PPW2 access data, data files are streamed line by line into
+#              partial per group aggregates, whenever the partials outgrow the memory budget they are sorted and spilled
+#              to a temporary file, and the spill files are finally k-way merged, so histories of any size can be
+#              aggregated per staff member or per day on a small host
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import heapq
+import os
+import tempfile
+import time
+from DesktopApp import (AccessPeriods, RollupBucket, timestamp_to_epoch, marker_to_epoch, open_data_file,
+                        is_record_log, RIG_ID_MARKER)
+
+
+# Constants
+GROUP_KEYS = ("staff", "day", "staff-day")
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024  # Bytes
+GROUP_BYTES = 512  # Approximate memory held by one in-memory partial aggregate (key, dictionary slot and list)
+MAX_MERGE_FAN_IN = 64  # Most spill files open at once in a merge, more are first merged in several passes
+
+# A partial aggregate is the list [periods, count, temp min, temp max, temp total, humidity min, humidity max,
+# humidity total], the same order the spill files use after the group key
+_PERIODS, _COUNT, _TEMP_MIN, _TEMP_MAX, _TEMP_TOTAL, _HUMIDITY_MIN, _HUMIDITY_MAX, _HUMIDITY_TOTAL = range(8)
+
+
+# Functions
+def _group_key(group_by, staff, epoch):
+	"""
+	Group key of a reading or access period, keys sort in staff and then day order
+	"""
+	if group_by == "staff":
+		return staff
+	day = time.strftime("%Y-%m-%d", time.gmtime(epoch))
+
+	return day if group_by == "day" else "{0}|{1}".format(staff, day)
+
+
+def _merge_partial(partial, other):
+	"""
+	Merge one partial aggregate list into another
+	"""
+	partial[_PERIODS] += other[_PERIODS]
+	if other[_COUNT]:
+		if partial[_COUNT]:
+			partial[_TEMP_MIN] = min(partial[_TEMP_MIN], other[_TEMP_MIN])
+			partial[_TEMP_MAX] = max(partial[_TEMP_MAX], other[_TEMP_MAX])
+			partial[_HUMIDITY_MIN] = min(partial[_HUMIDITY_MIN], other[_HUMIDITY_MIN])
+			partial[_HUMIDITY_MAX] = max(partial[_HUMIDITY_MAX], other[_HUMIDITY_MAX])
+		else:
+			partial[_TEMP_MIN], partial[_TEMP_MAX] = other[_TEMP_MIN], other[_TEMP_MAX]
+			partial[_HUMIDITY_MIN], partial[_HUMIDITY_MAX] = other[_HUMIDITY_MIN], other[_HUMIDITY_MAX]
+		partial[_COUNT] += other[_COUNT]
+		partial[_TEMP_TOTAL] += other[_TEMP_TOTAL]
+		partial[_HUMIDITY_TOTAL] += other[_HUMIDITY_TOTAL]
+
+
+def _merge_entries(inputs):
+	"""
+	Generator of the merged (key, partial aggregate) entries of several inputs that are each in key order, entries with
+	the same key are merged into one, in key order
+	"""
+	current_key, current = None, None
+	for key, partial in heapq.merge(*inputs, key=lambda entry: entry[0]):
+		if key == current_key:
+			_merge_partial(current, partial)
+			continue
+		if current is not None:
+			yield current_key, current
+		current_key, current = key, list(partial)
+	if current is not None:
+		yield current_key, current
+
+
+def _read_spill(spill_file):
+	"""
+	Generator of the (key, partial aggregate) entries of a spill file, in key order
+	"""
+	with open(spill_file, "r", encoding="utf-8") as file:
+		for line in file:
+			fields = line.rstrip("\n").split("\t")
+			partial = [int(fields[1]), int(fields[2])] + [float(value) if value else None for value in fields[3:]]
+			yield fields[0], partial
+
+
+# Classes
+class ExternalAggregator:
+	"""
+	Class to aggregate access data files per group under a memory budget, only the partial aggregates of the groups
+	seen since the last spill are held in memory, never the data readings themselves, and at most MAX_MERGE_FAN_IN
+	spill files are open at once. CSV files and compressed time series archives are streamed, but compact archives
+	and binary record logs are decoded whole, one file at a time, so the largest such file must fit in memory on top
+	of the budget
+	"""
+	def __init__(self, group_by="staff", memory_budget=DEFAULT_MEMORY_BUDGET, temp_dir=None):
+		"""
+		Initialiser - instance variables:
+			__group_by: "staff", "day" or "staff-day", property with read-only access
+			__max_groups: number of partial aggregates held before spilling, property with no access
+			__temp_dir: directory for spill files, None for the system default, property with no access
+			__partials: dictionary of {group key: partial aggregate list}, property with no access
+			__spill_files: list of spill file paths, property with no access
+			lines_read: number of lines read, as int
+			lines_skipped: number of malformed lines, as int
+			spills: number of times the partials were spilled to disk, as int
+			merge_passes: number of intermediate merges of MAX_MERGE_FAN_IN spill files, as int
+
+		:param group_by: "staff", "day" or "staff-day"
+		:param memory_budget: approximate bytes the partial aggregates may use before being spilled, as int
+		:param temp_dir: directory for spill files, None for the system default
+		"""
+		if group_by not in GROUP_KEYS:
+			raise ValueError("Unknown group key: {0}".format(group_by))
+		self.__group_by = group_by
+		self.__max_groups = max(memory_budget // GROUP_BYTES, 1)
+		self.__temp_dir = temp_dir
+		self.__partials = {}
+		self.__spill_files = []
+		self.lines_read = 0
+		self.lines_skipped = 0
+		self.spills = 0
+		self.merge_passes = 0
+
+	@property
+	def group_by(self):
+		return self.__group_by
+
+	def __partial(self, key):
+		partial = self.__partials.get(key)
+		if partial is None:
+			if len(self.__partials) >= self.__max_groups:
+				self.__spill()
+			partial = self.__partials[key] = [0, 0, None, None, 0.0, None, None, 0.0]
+
+		return partial
+
+	def add_reading(self, staff, epoch, temp_data, humidity_data):
+		"""
+		Add a single data reading
+
+		:param staff: staff id, as string
+		:param epoch: time of the reading in seconds since the epoch, as int
+		:param temp_data: temperature, as float
+		:param humidity_data: humidity, as float
+
+		:return: nothing
+		"""
+		partial = self.__partial(_group_key(self.__group_by, staff, epoch))
+		if partial[_COUNT]:
+			if temp_data < partial[_TEMP_MIN]:
+				partial[_TEMP_MIN] = temp_data
+			elif temp_data > partial[_TEMP_MAX]:
+				partial[_TEMP_MAX] = temp_data
+			if humidity_data < partial[_HUMIDITY_MIN]:
+				partial[_HUMIDITY_MIN] = humidity_data
+			elif humidity_data > partial[_HUMIDITY_MAX]:
+				partial[_HUMIDITY_MAX] = humidity_data
+		else:
+			partial[_TEMP_MIN] = partial[_TEMP_MAX] = temp_data
+			partial[_HUMIDITY_MIN] = partial[_HUMIDITY_MAX] = humidity_data
+		partial[_COUNT] += 1
+		partial[_TEMP_TOTAL] += temp_data
+		partial[_HUMIDITY_TOTAL] += humidity_data
+
+	def add_period(self, staff, start_epoch):
+		"""
+		Count an access period against the group it started in
+
+		:param staff: staff id, as string
+		:param start_epoch: start of the access period in seconds since the epoch, as int
+
+		:return: nothing
+		"""
+		self.__partial(_group_key(self.__group_by, staff, start_epoch))[_PERIODS] += 1
+
+	def add_file(self, data_file):
+		"""
+		Stream an access data file (.csv or .csv.gz) or compressed time series archive into the aggregates, compact
+		archives and binary record logs are loaded whole, one file at a time, through AccessPeriods
+
+		:param data_file: path to the data file, as string
+
+		:return: nothing
+		"""
+		from access_compact import is_compact_archive
+		from gorilla_archive import is_gorilla_archive, GorillaReader
+		if is_gorilla_archive(data_file):
+			# Decompressed one data block at a time
+			staff = "None"
+			with open(data_file, "rb") as file:
+				for record in GorillaReader(file).records():
+					if record[0] == "start":
+						staff = record[2]
+						self.add_period(staff, record[1])
+					elif record[0] == "readings":
+						for epoch, temp_data, humidity_data in record[1]:
+							self.add_reading(staff, epoch, temp_data, humidity_data)
+			return
+		if is_compact_archive(data_file) or is_record_log(data_file):
+			for access_period in AccessPeriods(data_file):
+				self.add_period(access_period.staff, access_period.start_epoch)
+				for data_reading in access_period.data_readings:
+					self.add_reading(access_period.staff, data_reading.epoch, data_reading.temp_data,
+					                 data_reading.humidity_data)
+			return
+
+		staff = "None"
+		with open_data_file(data_file) as file:
+			for line in file:
+				self.lines_read += 1
+				entries = line.split(",")
+				try:
+					if entries[0] == "ACCESS-STARTED":
+						staff = entries[3].strip() if len(entries) > 3 and entries[3].strip() else "None"
+						self.add_period(staff, marker_to_epoch(entries[1], entries[2]))
+					elif entries[0] in ("ACCESS-STOPPED", RIG_ID_MARKER) or not entries[0].strip():
+						continue
+					else:
+						reading_staff = entries[3].strip() if len(entries) > 3 and entries[3].strip() else staff
+						self.add_reading(reading_staff, timestamp_to_epoch(entries[0]), float(entries[1]),
+						                 float(entries[2]))
+				except (IndexError, ValueError):
+					self.lines_skipped += 1
+
+	def __write_spill(self, entries):
+		"""
+		Write (key, partial aggregate) entries, in key order, to a new spill file
+
+		:return: path of the spill file, as string
+		"""
+		handle, spill_file = tempfile.mkstemp(prefix="ppw-spill-", suffix=".tsv", dir=self.__temp_dir)
+		with os.fdopen(handle, "w", encoding="utf-8") as file:
+			for key, partial in entries:
+				file.write("\t".join([key] + ["" if value is None else repr(value) for value in partial]) + "\n")
+
+		return spill_file
+
+	def __spill(self):
+		"""
+		Write the in-memory partial aggregates to a new spill file in key order and clear them
+		"""
+		partials = self.__partials
+		self.__spill_files.append(self.__write_spill((key, partials[key]) for key in sorted(partials)))
+		self.__partials = {}
+		self.spills += 1
+
+	def __reduce_spills(self):
+		"""
+		Merge the spill files in groups of MAX_MERGE_FAN_IN, in as many passes as needed, until they can all be merged
+		together with the in-memory partials in a single final pass
+		"""
+		while len(self.__spill_files) > MAX_MERGE_FAN_IN - 1:
+			group, self.__spill_files = self.__spill_files[:MAX_MERGE_FAN_IN], self.__spill_files[MAX_MERGE_FAN_IN:]
+			try:
+				merged = self.__write_spill(_merge_entries([_read_spill(spill_file) for spill_file in group]))
+			except BaseException:
+				self.__spill_files = group + self.__spill_files
+				raise
+			for spill_file in group:
+				os.remove(spill_file)
+			self.__spill_files.append(merged)
+			self.merge_passes += 1
+
+	def results(self):
+		"""
+		Generator of the final aggregates in key order, the in-memory partials and every spill file are k-way merged
+		so only one partial per input is held at a time (spill files are first merged in groups of MAX_MERGE_FAN_IN
+		when there are more than that), the spill files are removed once the generator finishes
+
+		:return: yields (group key, number of access periods, RollupBucket) tuples, the buckets have no percentile
+		         sketches
+		"""
+		try:
+			self.__reduce_spills()
+			inputs = [_read_spill(spill_file) for spill_file in self.__spill_files]
+			inputs.append((key, self.__partials[key]) for key in sorted(self.__partials))
+			for key, partial in _merge_entries(inputs):
+				yield self.__result(key, partial)
+		finally:
+			for spill_file in self.__spill_files:
+				os.remove(spill_file)
+			self.__spill_files = []
+			self.__partials = {}
+
+	@staticmethod
+	def __result(key, partial):
+		bucket = RollupBucket.from_totals(0, 0, (partial[_COUNT], partial[_TEMP_MIN], partial[_TEMP_MAX],
+		                                         partial[_TEMP_TOTAL], partial[_HUMIDITY_MIN], partial[_HUMIDITY_MAX],
+		                                         partial[_HUMIDITY_TOTAL]))
+
+		return key, partial[_PERIODS], bucket
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Aggregate PPW2 access data files under a memory budget")
+	parser.add_argument("data_files", nargs="+", help="access data files to aggregate")
+	parser.add_argument("--by", choices=GROUP_KEYS, default="staff", help="group the aggregates by")
+	parser.add_argument("--memory", type=int, default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+	                    help="memory budget for partial aggregates in MB")
+	args = parser.parse_args(argv)
+
+	aggregator = AccessPeriods.aggregate_external(args.data_files, args.by, args.memory * 1024 * 1024)
+	for key, periods, bucket in aggregator.results():
+		print("{0}: {1} periods, {2} readings, temp {3}-{4}c ave {5:.2f}c, humidity ave {6:.2f}%".format(
+			key, periods, bucket.count, bucket.temp_min, bucket.temp_max, bucket.temp_average or 0.0,
+			bucket.humidity_average or 0.0))
+	print("Read {0} lines ({1} skipped), spilled {2} time(s), {3} merge pass(es)".format(
+		aggregator.lines_read, aggregator.lines_skipped, aggregator.spills, aggregator.merge_passes))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
@@ -6,25 +6,31 @@
 # Imports
 import random
 import os
-from time import sleep
-from libs.iot_app import IoTApp
+from libs.iot_app import AsyncIoTApp
+from libs.wifi_manager import WiFiStates
+from libs.buffered_writer import BufferedWriter
+from libs.record_log import RecordLog
+from libs.rotating_log import RotatingLog
+from libs.sd_log import SDLog
+from libs.sdcard import SDCard
 from libs.bme680 import BME680, OS_2X, OS_4X, OS_8X, FILTER_SIZE_3, ENABLE_GAS_MEAS
 from neopixel import NeoPixel
 from machine import Pin
 
 # Classes
-class MainApp(IoTApp):
+class MainApp(AsyncIoTApp):
     """
     This is your custom class that is instantiated as the main app object instance,
-    it inherits from the supplied IoTApp class found in the libs/iot_app.py module
+    it inherits from the supplied AsyncIoTApp class found in the libs/iot_app.py module
     which is copied when the Huzzah32 is prepared.
     This IoTApp in turn encapsulates an instance of the ProtoRig class (which is 
     found in libs/proto_rig.py) and exposes a number of properties of this ProtoRig
     instance so you do not have to do this yourself.
-    Also, the IoTApp provides an execution loop that can be started by calling the
+    Also, the AsyncIoTApp provides an execution loop that can be started by calling the
     run() method of the IoTApp class (which is of course inherited into your custom
-    app class). All you have to do is define your program by providing implementations
-    of the init(), loop() and deinit() methods.
+    app class). This app defines its program by providing implementations of the
+    init(), tasks() and deinit() methods, sampling, networking and the display each run
+    as their own coroutine so a slow MQTT broker does not hold up the sampling.
     Looping of your program can be controlled using the finished flag property of
     your custom class.
     """
@@ -38,6 +44,33 @@ class MainApp(IoTApp):
     # Literal string values can be converted to binary representation by using a b prefix
     MQTT_TEST_TOPIC_1 = b"cet235/test/ticks"
     MQTT_TEST_TOPIC_2 = b"cet235/test/secs"
+    # Buffered lines are written to flash at least this often (so at most this many seconds of readings can
+    # be lost), or sooner when the buffer fills or an access period ends
+    LOG_MAX_AGE = 10
+    # Sensors are sampled once every SAMPLE_PERIOD milliseconds and the OLED display is updated once every
+    # DISPLAY_PERIOD milliseconds, each in its own coroutine timed by the AsyncIoTApp
+    SAMPLE_PERIOD = 1000
+    DISPLAY_PERIOD = 500
+    # Messages from the MQTT broker are checked for every MQTT_CHECK_PERIOD milliseconds in the networking
+    # coroutine and the buffered log is housekept (flushed when due, rotated when full) every LOG_CHECK_PERIOD
+    # milliseconds as a periodic task
+    MQTT_CHECK_PERIOD = 100
+    LOG_CHECK_PERIOD = 500
+    # Registering to the MQTT broker is retried every MQTT_RETRY_PERIOD milliseconds while WiFi is connected
+    # but the broker could not be reached or the connection to it has dropped
+    MQTT_RETRY_PERIOD = 10000
+    LOG_BUFFER_SIZE = 4096
+    # Log packed binary records (see libs/record_log.py) rather than CSV text lines, the records are about a
+    # quarter of the size and are packed without building any strings
+    LOG_BINARY = False
+    # Readings are kept in up to LOG_SEGMENT_COUNT segment files of about LOG_SEGMENT_SIZE bytes each, the
+    # oldest segment is deleted when a new one is needed
+    LOG_SEGMENT_SIZE = 64 * 1024
+    LOG_SEGMENT_COUNT = 8
+    # Log straight to the blocks of an SD card instead of to the internal flash (sd_log_extract.py reads the
+    # data back from an image of the card), SD_CS_PIN is the card's chip select pin
+    LOG_TO_SD = False
+    SD_CS_PIN = 33
 
 
     def init(self):
@@ -51,38 +84,11 @@ class MainApp(IoTApp):
         self.topic_1_count = 0
         self.topic_1_colour = 0
         
-        self.wifi_msg = "No WIFI"
-        connect_count = 0
-        # Try to connect to WiFi 5 times, if unsuccessful then only try again if button A on
-        # the OLED is pressed
-        while connect_count < 5 and not self.is_wifi_connected():
-            self.oled_clear()
-            self.wifi_msg = "Connect WIFI:{0}".format(connect_count + 1) 
-            self.oled_text(self.wifi_msg, 0, 0)
-            self.oled_display()
-            self.connect_to_wifi(wifi_settings=(self.AP_SSID, self.AP_PSWD, True, self.AP_TOUT))
-            connect_count += 1
-
-        if self.is_wifi_connected():
-            self.wifi_msg = "WIFI"
-            self.ntp_msg = "NTP - RTC good"
-            # Register with the MQTT broker and link the method mqtt_callback() as the callback
-            # when messages are recieved
-            self.set_rtc_by_ntp(ntp_ip=self.MQTT_ADDR, ntp_port=self.NTP_PORT)
-            self.register_to_mqtt(server=self.MQTT_ADDR, port=self.MQTT_PORT,
-                                  sub_callback=self.mqtt_callback)
-            # Subscribe to topic "cet235/test/ticks"
-            self.mqtt_client.subscribe(self.MQTT_TEST_TOPIC_1)
-
-            # Subscribe to topic "cet235/test/secs"
-            self.mqtt_client.subscribe(self.MQTT_TEST_TOPIC_2)
-
-            self.oled_clear()
-            self.oled_display()
-        else:
-            self.wifi_msg = "No WIFI"
-            self.oled_clear()
-            self.oled_display()
+        self.wifi_msg = "Connect WIFI"
+        # Start connecting to WiFi without waiting for it so sampling starts straight away, each
+        # attempt is given AP_TOUT milliseconds and retried with a growing backoff, the RTC is set
+        # and the MQTT broker registered to in wifi_state_handler() once connected
+        self.connect_to_wifi(wifi_settings=(self.AP_SSID, self.AP_PSWD, True, self.AP_TOUT))
 
 
 
@@ -102,97 +108,117 @@ class MainApp(IoTApp):
         # method
         self.obtain_sensor_bme680()
         
-        # Name of the file to write to the Huzzah32's root file system
-        self.file_name = "access_data.csv"
-        
-       
-        if self.file_exists(self.file_name):
-            os.remove(self.file_name)
-        
+        if self.LOG_TO_SD:
+            # Readings are appended to the SD card in multi-block chunks, each boot starts a new session after
+            # the data of earlier sessions
+            self.segments = None
+            self.file = SDLog(SDCard(self.rig.get_spi(), Pin(self.SD_CS_PIN)), max_age=self.LOG_MAX_AGE)
+        else:
+            # Readings are logged to a rotating set of segment files on the Huzzah32's root file system (e.g.
+            # access_data.00001.csv), each boot starts a new segment so the data of earlier sessions is kept
+            self.segments = RotatingLog("access_data", ".ppwb" if self.LOG_BINARY else ".csv",
+                                        self.LOG_SEGMENT_SIZE, self.LOG_SEGMENT_COUNT)
         
-        self.file = open(self.file_name, "w+")
+            # Lines are batched in memory and written to flash in blocks rather than once per reading
+            self.file = BufferedWriter(self.segments, buffer_size=self.LOG_BUFFER_SIZE, max_age=self.LOG_MAX_AGE)
+
+        # Record which rig wrote this file so the desktop app can partition the data by rig, a record log
+        # keeps this in its header
+        if self.LOG_BINARY:
+            self.record_log = RecordLog(self.file, self.rig.id)
+        else:
+            self.record_log = None
+            self.file.write("{0},{1}\n".format("RIG-ID", self.rig.id))
         
         
         self.access = False
         self.access_str = ""
+        # ACCESS-STARTED/STOPPED markers from the button handlers, which only record them here because an
+        # interrupt can arrive in the middle of a write to the log, write_markers() logs them from the
+        # sampling coroutine and the log housekeeping task
+        self.start_marker = None
+        self.stop_marker = None
         
         self.off = False
         self.count = 0
         self.lightcount=0
+        
+        # Latest sensor readings, shown on the OLED display by update_display()
+        self.tm_reading = None
+        self.rh_reading = None
 
+        self.every(self.LOG_CHECK_PERIOD, self.check_log, name="log")
+        self.every(self.MQTT_RETRY_PERIOD, self.retry_mqtt, name="mqtt")
         
         self.npm.fill((5,5,5))
         self.npm.write()
         
         self.npm.write()
 
-    def loop(self):
+    def tasks(self):
         """
-        The loop() method is called after the init() method and is designed to contain
-        the part of the program which continues to execute until the finished property
-        is set to True
+        The tasks() method is called after the init() method and returns the coroutines
+        that run concurrently until the finished property is set to True, one each for
+        the periodic tasks, networking (checking for MQTT messages), sampling and the
+        OLED display
         """
-        
-        yr, mn, dy, dn, hr, mi, se, ms = self.rtc.datetime()
+        return [self.periodic_task(), self.mqtt_task(self.MQTT_CHECK_PERIOD),
+                self.repeat_task(self.SAMPLE_PERIOD, self.sample),
+                self.repeat_task(self.DISPLAY_PERIOD, self.update_display)]
+
+    def update_display(self):
+        # Current date and time taken from the real-time clock, read at most once a second
+        yr, mn, dy, dn, hr, mi, se, ms = self.timestamps.refresh()
         self.oled_clear()
+        if self.tm_reading is not None:
+            self.oled_text("{0}c".format(self.tm_reading),0,0)
+            self.oled_text("{0}%".format(self.rh_reading),60,0)
         output = "{0} {1:02d}-{2:02d}-{3}".format(self._DAY_NAMES[dn][0:3], dy, mn, yr)
         self.oled_text(output, 0, 12)
         output = "{0:02d}:{1:02d}:{2:02d}".format(hr, mi, se)
         self.oled_text(output, 0, 22)
 
         self.oled_display()
-        
-        sleep(0.1)
-        if self.is_wifi_connected():
-            # Check for any messages received from the MQTT broker, note this is a non-blocking
-            # operation so if no messages are currently present the loop() method continues
-            self.mqtt_client.check_msg()
-        
-   
+
+    def sample(self):
+        """
+        The sample() method is run by its own coroutine once every SAMPLE_PERIOD
+        milliseconds until the finished property is set to True
+        """
+        # Timestamps for the readings are taken from the real-time clock at most once a second
+        self.timestamps.refresh()
+
+        # Log any access period the buttons have started or stopped before this second's reading
+        self.write_markers()
 
         # If sensor readings are available, read them once a second or so
         if self.sensor_bme680.get_sensor_data():
             tm_reading = self.sensor_bme680.data.temperature  # In degrees Celsius 
             rh_reading = self.sensor_bme680.data.humidity     # As a percentage (ie. relative humidity)
-           
-            self.oled_text("{0}c".format(tm_reading),0,0)
-            self.oled_text("{0}%".format(rh_reading),60,0)
-            self.oled_display()
-            
-            sleep(0.5)
-
-            # Current date and time taken from the real-time clock
-            now = self.rtc.datetime()
-            year = now[0]
-            month = now[1]
-            day = now[2]
-            hour = now[4]
-            minute = now[5]
-            second = now[6]
+            self.tm_reading = tm_reading
+            self.rh_reading = rh_reading
 
-            
-            
             if self.access:
                 
                 if self.count == 0:
-                    date_str = "{0}/{1}/{2}".format(day, month, year)
-                    time_str = "{0}:{1}:{2}".format(hour, minute, second)
-                    
-                    # Write to file
-                    self.file.write("{0},{1},{2},{3} \n".format("ACCESS-STARTED", date_str ,time_str, self.message))
+                    if self.record_log:
+                        self.record_log.access_started(self.message)
+                    else:
+                        # Write to file, the date and time strings are shared with anything else logged
+                        # in the same second
+                        self.file.write("{0},{1},{2},{3} \n".format("ACCESS-STARTED", self.timestamps.date,
+                                                                    self.timestamps.time, self.message))
 
-    
-
-                # Format timestamp
-                
-                timestamp = "{0}-{1}-{2}|{3}:{4}:{5}".format(year, month, day, hour, minute, second)
-
-                # Format line of data
-                data_line = "{0},{1:.2f},{2:.2f},{3}\n".format(timestamp, tm_reading, rh_reading,self.message)
-            
                 # Write data line to the access_data.csv file
                 if self.message != "None":
-                    self.file.write(data_line)
+                    if self.record_log:
+                        self.record_log.reading(tm_reading, rh_reading, self.message)
+                    else:
+                        # Format line of data with the cached timestamp of the current second
+                        data_line = "{0},{1:.2f},{2:.2f},{3}\n".format(self.timestamps.timestamp, tm_reading,
+                                                                       rh_reading, self.message)
+
+                        self.file.write(data_line)
                 
                 # Set correct colour for NeoPixel matrix LEDS and correct access warning string
                 
@@ -214,12 +240,74 @@ class MainApp(IoTApp):
             
             
     
+    def write_markers(self):
+        # Log the ACCESS-STARTED/STOPPED markers recorded by the button handlers, a stop marker also has the
+        # completed access period written out to flash now
+        marker = self.start_marker
+        if marker is not None:
+            self.start_marker = None
+            if self.record_log:
+                self.record_log.access_started()
+            else:
+                self.file.write("{0},{1},{2}\n".format("ACCESS-STARTED", marker[0], marker[1]))
+
+        marker = self.stop_marker
+        if marker is not None:
+            self.stop_marker = None
+            if self.record_log:
+                self.record_log.access_stopped(marker[2])
+            else:
+                self.file.write("{0},{1},{2},{3}\n".format("ACCESS-STOPPED", marker[0], marker[1], marker[2]))
+            self.file.request_flush()
+
+    def check_log(self):
+        # Log any markers from the button handlers, then write out the buffered lines if they are due (or a
+        # flush has been requested)
+        self.write_markers()
+        self.file.poll()
+
+        # Move on to a new segment once the current one is full, only between access periods so that every
+        # segment holds whole access periods and can be read by the desktop app on its own
+        if self.segments and not self.access and self.segments.rotation_due():
+            self.file.flush()
+            self.segments.rotate()
+            self.start_segment()
+
+    def connect_mqtt(self):
+        # Set the RTC by NTP, register with the MQTT broker and link the method mqtt_callback() as the
+        # callback when messages are recieved, a network error leaves mqtt_client None for retry_mqtt()
+        # to try again rather than finishing the app
+        try:
+            self.set_rtc_by_ntp(ntp_ip=self.MQTT_ADDR, ntp_port=self.NTP_PORT)
+            self.register_to_mqtt(server=self.MQTT_ADDR, port=self.MQTT_PORT,
+                                  sub_callback=self.mqtt_callback)
+            # Subscribe to topic "cet235/test/ticks"
+            self.mqtt_client.subscribe(self.MQTT_TEST_TOPIC_1)
+
+            # Subscribe to topic "cet235/test/secs"
+            self.mqtt_client.subscribe(self.MQTT_TEST_TOPIC_2)
+        except OSError:
+            self.mqtt_client = None
+
+    def retry_mqtt(self):
+        # Register with the MQTT broker again if the last attempt failed or the connection has dropped
+        if self.mqtt_client is None and self.is_wifi_connected():
+            self.connect_mqtt()
+
+    def wifi_state_handler(self, old_state, new_state):
+        if new_state == WiFiStates.CONNECTED:
+            self.wifi_msg = "WIFI"
+            self.ntp_msg = "NTP - RTC good"
+            # This is repeated after every reconnection
+            self.connect_mqtt()
+        elif new_state == WiFiStates.CONNECTING:
+            self.wifi_msg = "Connect WIFI"
+        else:
+            self.wifi_msg = "No WIFI"
+
     def mqtt_callback(self, topic, msg):
         
         topic = self.MQTT_TEST_TOPIC_2
-            
-        
-        sleep(1)
 
         # decode the message
         self.message = (str(bytes(msg), "utf-8"))
@@ -249,30 +337,35 @@ class MainApp(IoTApp):
         self.npm.fill((0, 0, 0))
         self.npm.write()
 
+        # Log any markers from the button handlers that have not been written yet
+        self.write_markers()
+
         # If an access period is currently active then write to the access_data.csv file that it
         # is now stopped and also the length of the access period in seconds
         if  self.access:
-            # Current date and time taken from the real-time clock to record as stop date and time
-            # for this access period
-            
-            now = self.rtc.datetime()
-            year = now[0]
-            month = now[1]
-            day = now[2]
-            hour = now[4]
-            minute = now[5]
-            second = now[6]
-            
-            date_str = "{0}/{1}/{2}".format(day, month, year)
-            time_str = "{0}:{1}:{2}".format(hour, minute, second)
+            # Current date and time taken from the real-time clock (through the shared timestamp
+            # cache) to record as stop date and time for this access period
+            date_str = self.timestamps.date
+            time_str = self.timestamps.time
 
             # Write to file, note: self.count is approximately the number of seconds that this access
             # period lasted
-            self.file.write("{0},{1},{2},{3}\n".format("ACCESS-STOPPED", date_str, time_str ,self.count))
+            if self.record_log:
+                self.record_log.access_stopped(self.count)
+            else:
+                self.file.write("{0},{1},{2},{3}\n".format("ACCESS-STOPPED", date_str, time_str ,self.count))
 
-        # Make sure the access_data.csv file is closed
+        # Make sure any buffered lines are written and the access_data.csv file is closed
         self.file.close()
         
+    def start_segment(self):
+        # Record which rig wrote this segment so the desktop app can partition the data by rig, a record log
+        # keeps this in its header
+        if self.record_log:
+            self.record_log.start()
+        else:
+            self.file.write("{0},{1}\n".format("RIG-ID", self.rig.id))
+
     def obtain_sensor_bme680(self):
 
         self.sensor_bme680 = BME680(i2c=self.rig.i2c_adapter, i2c_addr = 0x76)
@@ -285,24 +378,21 @@ class MainApp(IoTApp):
 
         return file_name in file_names
 
+    def finish_handler(self, pin):
+        # Write out the buffered lines before the app finishes, deinit() then closes the file
+        self.finish()
+        self.file.request_flush()
+
     def btnA_handler(self, pin):
 
         if not self.access:
-            # Current date and time taken from the real-time clock to record as start date and time
-            # for this access period
-            now = self.rtc.datetime()
-            year = now[0]
-            month = now[1]
-            day = now[2]
-            hour = now[4]
-            minute = now[5]
-            second = now[6]
-            
-            date_str = "{0}/{1}/{2}".format(day, month, year)
-            time_str = "{0}:{1}:{2}".format(hour, minute, second)
+            # Current date and time taken from the real-time clock (through the shared timestamp
+            # cache) to record as start date and time for this access period
+            date_str = self.timestamps.date
+            time_str = self.timestamps.time
 
-            # Write to file
-            self.file.write("{0},{1},{2}\n".format("ACCESS-STARTED", date_str, time_str))
+            # Have the marker written to file by write_markers(), this handler may have interrupted a write
+            self.start_marker = (date_str, time_str)
         
             # Update access information
             
@@ -313,20 +403,12 @@ class MainApp(IoTApp):
     def btnB_handler(self, pin):
         if self.access:
 
-            now = self.rtc.datetime()
-            year = now[0]
-            month = now[1]
-            day = now[2]
-            hour = now[4]
-            minute = now[5]
-            second = now[6]
-            
-            date_str = "{0}/{1}/{2}".format(day, month, year)
-            time_str = "{0}:{1}:{2}".format(hour, minute, second)
+            date_str = self.timestamps.date
+            time_str = self.timestamps.time
 
-            # Write to file, note: self.count is approximately the number of seconds that this access
-            # period lasted
-            self.file.write("{0},{1},{2},{3}\n".format("ACCESS-STOPPED", date_str, time_str, self.count))
+            # Have the marker written to file (and the completed access period flushed) by write_markers(),
+            # note: self.count is approximately the number of seconds that this access period lasted
+            self.stop_marker = (date_str, time_str, self.count)
         
             # Update access information
             self.access = False
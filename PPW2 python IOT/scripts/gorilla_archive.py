@@ -0,0 +1,539 @@
+# File: gorilla_archive.py
+# Description: Gorilla style compressed time series archive format for PPW2 access period readings, timestamps are
+#              stored as delta-of-deltas and temperatures/humidities as XOR compressed floats, in blocks whose headers
+#              hold min/max values so time range scans can skip whole blocks
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import os
+import struct
+from access_format import epoch_to_marker, epoch_to_timestamp
+
+
+# Constants
+ARCHIVE_MAGIC = b"PPWG"
+ARCHIVE_VERSION = 1
+DEFAULT_BLOCK_ROWS = 1024
+
+# Archive layout (all little-endian): magic and version, followed by a stream of records each starting with a type
+# byte, so the archive can be written and read as a stream:
+#   period start record:  type "P", start epoch, staff id length, UTF-8 staff id
+#   data block record:     type "D", row count, first epoch, last epoch, min/max temperature, min/max humidity,
+#                          payload length, followed by the payload bit stream
+#   period stop record:    type "S", stop epoch, period length
+# The data block payload holds the timestamps of the block as delta-of-deltas and then the temperatures and then the
+# humidities as XOR compressed floats, values are stored in hundredths (as the rig logs them to two decimal places)
+# so consecutive XORs only differ in a few mantissa bits
+_FILE_HEADER = struct.Struct("<4sH")
+_PERIOD_START = struct.Struct("<cIB")
+_DATA_BLOCK = struct.Struct("<cHIIddddI")
+_PERIOD_STOP = struct.Struct("<cII")
+_RECORD_PERIOD_START = b"P"
+_RECORD_DATA_BLOCK = b"D"
+_RECORD_PERIOD_STOP = b"S"
+
+# Delta-of-delta buckets as (control bits, control bit count, value bit count), tried in order
+_DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b1111, 4, 32))
+
+
+# Functions
+def is_gorilla_archive(data_file):
+	"""
+	Check whether the given file is a compressed time series archive written by this module
+
+	:param data_file: path to the data file, as string
+
+	:return: True if the file starts with the archive magic bytes, False otherwise
+	"""
+	with open(data_file, "rb") as file:
+		return file.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+
+def read_gorilla_archive(data_file, start=None, stop=None):
+	"""
+	Read the access periods held in a compressed time series archive
+
+	:param data_file: path to the archive file, as string
+	:param start: only read data readings at or after this epoch, None for no lower bound
+	:param stop: only read data readings at or before this epoch, None for no upper bound
+
+	:return: list of AccessPeriod class instances
+	"""
+	with open(data_file, "rb") as file:
+		return GorillaReader(file).to_access_periods(start, stop)
+
+
+def write_gorilla_archive(access_periods, data_file, block_rows=DEFAULT_BLOCK_ROWS):
+	"""
+	Write access periods to a compressed time series archive
+
+	:param access_periods: iterable of AccessPeriod class instances (e.g. an AccessPeriods instance)
+	:param data_file: path of the archive file to write, as string
+	:param block_rows: maximum number of data readings in each data block, as int
+
+	:return: number of bytes written
+	"""
+	with open(data_file, "wb") as file:
+		writer = GorillaWriter(file, block_rows)
+		for access_period in access_periods:
+			writer.start_period(access_period.start_epoch, access_period.staff)
+			for data_reading in access_period.data_readings:
+				writer.add_reading(data_reading.epoch, data_reading.temp_data, data_reading.humidity_data)
+			writer.stop_period(access_period.stop_epoch, access_period.period_length)
+		writer.close()
+
+		return file.tell()
+
+
+def _float_bits(value):
+	"""
+	Bits of a value in hundredths as a 64 bit double
+	"""
+	return struct.unpack("<Q", struct.pack("<d", float(round(value * 100.0))))[0]
+
+
+def _bits_float(bits):
+	"""
+	Value from the bits of a 64 bit double holding hundredths
+	"""
+	return struct.unpack("<d", struct.pack("<Q", bits))[0] / 100.0
+
+
+# Classes
+class BitWriter:
+	"""
+	Class to pack values of any number of bits, most significant bit first, into a byte array
+	"""
+	def __init__(self):
+		self.__data = bytearray()
+		self.__acc = 0
+		self.__bits = 0
+
+	def write(self, value, bits):
+		"""
+		Append the low bits of value
+
+		:param value: value to write, as int
+		:param bits: number of bits to write, as int
+
+		:return: nothing
+		"""
+		self.__acc = (self.__acc << bits) | (value & ((1 << bits) - 1))
+		self.__bits += bits
+		while self.__bits >= 8:
+			self.__bits -= 8
+			self.__data.append((self.__acc >> self.__bits) & 0xff)
+		self.__acc &= (1 << self.__bits) - 1
+
+	def getvalue(self):
+		"""
+		Bytes written so far, the final byte is padded with zero bits
+
+		:return: bytes
+		"""
+		if self.__bits:
+			return bytes(self.__data) + bytes([(self.__acc << (8 - self.__bits)) & 0xff])
+
+		return bytes(self.__data)
+
+
+class BitReader:
+	"""
+	Class to read values of any number of bits, most significant bit first, from bytes written by a BitWriter
+	"""
+	def __init__(self, data):
+		self.__data = data
+		self.__position = 0
+
+	def read(self, bits):
+		"""
+		Read the next value
+
+		:param bits: number of bits to read, as int
+
+		:return: value, as int
+		"""
+		first = self.__position >> 3
+		end_bit = self.__position + bits
+		last = (end_bit + 7) >> 3
+		chunk = int.from_bytes(self.__data[first:last], "big")
+		self.__position = end_bit
+
+		return (chunk >> ((last << 3) - end_bit)) & ((1 << bits) - 1)
+
+	def read_control(self, maximum):
+		"""
+		Read a unary control code, i.e. count leading one bits up to maximum
+
+		:return: number of one bits read, as int
+		"""
+		count = 0
+		while count < maximum and self.read(1):
+			count += 1
+
+		return count
+
+
+class _XorEncoder:
+	"""
+	Gorilla XOR float compression state for one column of a data block
+	"""
+	def __init__(self, writer):
+		self.__writer = writer
+		self.__previous = None
+		self.__leading = None
+		self.__trailing = None
+
+	def add(self, bits):
+		writer = self.__writer
+		if self.__previous is None:
+			writer.write(bits, 64)
+			self.__previous = bits
+			return
+
+		xor = bits ^ self.__previous
+		self.__previous = bits
+		if not xor:
+			writer.write(0, 1)
+			return
+
+		leading = min(64 - xor.bit_length(), 31)
+		trailing = (xor & -xor).bit_length() - 1
+		if self.__leading is not None and leading >= self.__leading and trailing >= self.__trailing:
+			# The meaningful bits fit within the previous window so only the bits are needed
+			writer.write(0b10, 2)
+			writer.write(xor >> self.__trailing, 64 - self.__leading - self.__trailing)
+		else:
+			length = 64 - leading - trailing
+			writer.write(0b11, 2)
+			writer.write(leading, 5)
+			writer.write(length & 0x3f, 6)  # A length of 64 is stored as 0
+			writer.write(xor >> trailing, length)
+			self.__leading = leading
+			self.__trailing = trailing
+
+
+class _XorDecoder:
+	"""
+	Gorilla XOR float decompression state for one column of a data block
+	"""
+	def __init__(self, reader):
+		self.__reader = reader
+		self.__previous = None
+		self.__leading = None
+		self.__trailing = None
+
+	def next(self):
+		reader = self.__reader
+		if self.__previous is None:
+			self.__previous = reader.read(64)
+			return self.__previous
+
+		control = reader.read_control(2)
+		if control == 0:
+			return self.__previous
+		if control == 2:
+			self.__leading = reader.read(5)
+			length = reader.read(6) or 64
+			self.__trailing = 64 - self.__leading - length
+		length = 64 - self.__leading - self.__trailing
+		self.__previous ^= reader.read(length) << self.__trailing
+
+		return self.__previous
+
+
+class GorillaWriter:
+	"""
+	Class to stream access periods into a compressed time series archive, readings are buffered until a block is full
+	(or its period stops) and the block is then compressed and written
+	"""
+	def __init__(self, file, block_rows=DEFAULT_BLOCK_ROWS):
+		"""
+		Initialiser - instance variables:
+			__file: binary file object to write to, property with no access
+			__block_rows: maximum number of data readings in each data block, property with no access
+			__rows: list of (epoch, temperature, humidity) tuples waiting to be written, property with no access
+			blocks_written: number of data blocks written, as int
+			rows_written: number of data readings written, as int
+
+		:param file: binary file object opened for writing
+		:param block_rows: maximum number of data readings in each data block, as int (at most 65535)
+		"""
+		self.__file = file
+		self.__block_rows = min(block_rows, 0xffff)
+		self.__rows = []
+		self.blocks_written = 0
+		self.rows_written = 0
+		file.write(_FILE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION))
+
+	def start_period(self, start_epoch, staff):
+		"""
+		Write a period start record
+
+		:param start_epoch: start of the access period in seconds since the epoch, as int
+		:param staff: staff id of the access period, as string
+
+		:return: nothing
+		"""
+		self.flush()
+		encoded = (staff or "").encode("utf-8")[:255]
+		self.__file.write(_PERIOD_START.pack(_RECORD_PERIOD_START, start_epoch, len(encoded)) + encoded)
+
+	def add_reading(self, epoch, temp_data, humidity_data):
+		"""
+		Add a data reading to the current period, the block is written once it is full
+
+		:param epoch: timestamp of the data reading in seconds since the epoch, as int
+		:param temp_data: temperature, as float
+		:param humidity_data: humidity, as float
+
+		:return: nothing
+		"""
+		self.__rows.append((epoch, temp_data, humidity_data))
+		if len(self.__rows) >= self.__block_rows:
+			self.flush()
+
+	def stop_period(self, stop_epoch, period_length):
+		"""
+		Write any buffered readings and a period stop record
+
+		:param stop_epoch: end of the access period in seconds since the epoch, as int
+		:param period_length: approximate length of the access period in seconds, as int
+
+		:return: nothing
+		"""
+		self.flush()
+		self.__file.write(_PERIOD_STOP.pack(_RECORD_PERIOD_STOP, stop_epoch, period_length))
+
+	def flush(self):
+		"""
+		Compress and write the buffered readings as one data block, or several if a gap between readings is too large
+		to encode
+
+		:return: nothing
+		"""
+		rows = self.__rows
+		start = 0
+		while start < len(rows):
+			start = self.__write_block(rows, start)
+		self.__rows = []
+
+	def __write_block(self, rows, start):
+		"""
+		Compress and write buffered readings from the given index as one data block, the block ends early at a reading
+		whose delta-of-delta does not fit the widest bucket so that reading starts the next block
+
+		:return: index of the first reading not written, as int
+		"""
+		writer = BitWriter()
+		previous_epoch = rows[start][0]
+		previous_delta = 0
+		stop = start + 1
+		while stop < len(rows):
+			epoch = rows[stop][0]
+			delta = epoch - previous_epoch
+			dod = delta - previous_delta
+			if dod == 0:
+				writer.write(0, 1)
+			else:
+				for control, control_bits, value_bits in _DOD_BUCKETS:
+					bias = (1 << (value_bits - 1)) - 1
+					if -bias <= dod <= bias + 1:
+						writer.write(control, control_bits)
+						writer.write(dod + bias, value_bits)
+						break
+				else:
+					break
+			previous_epoch, previous_delta = epoch, delta
+			stop += 1
+
+		rows = rows[start:stop]
+		for column in (1, 2):
+			encoder = _XorEncoder(writer)
+			for row in rows:
+				encoder.add(_float_bits(row[column]))
+
+		payload = writer.getvalue()
+		temps = [row[1] for row in rows]
+		humidities = [row[2] for row in rows]
+		self.__file.write(_DATA_BLOCK.pack(_RECORD_DATA_BLOCK, len(rows), rows[0][0], max(row[0] for row in rows),
+		                                   min(temps), max(temps), min(humidities), max(humidities), len(payload)))
+		self.__file.write(payload)
+
+		self.blocks_written += 1
+		self.rows_written += len(rows)
+
+		return stop
+
+	def close(self):
+		"""
+		Write any buffered readings, the file itself is left open
+
+		:return: nothing
+		"""
+		self.flush()
+
+
+class BlockHeader:
+	"""
+	Class to hold the header of one data block, used to decide whether the block needs to be decompressed
+	"""
+	def __init__(self, rows, first_epoch, last_epoch, temp_min, temp_max, humidity_min, humidity_max, payload_length):
+		self.rows = rows
+		self.first_epoch = first_epoch
+		self.last_epoch = last_epoch
+		self.temp_min = temp_min
+		self.temp_max = temp_max
+		self.humidity_min = humidity_min
+		self.humidity_max = humidity_max
+		self.payload_length = payload_length
+
+	def overlaps(self, start=None, stop=None):
+		"""
+		Check whether any reading in this block can fall within a time window
+
+		:return: True if the block must be read, False if it can be skipped
+		"""
+		return not ((start is not None and self.last_epoch < start) or (stop is not None and self.first_epoch > stop))
+
+
+class GorillaReader:
+	"""
+	Class to stream the records of a compressed time series archive, data blocks that cannot match a time window are
+	skipped without being decompressed
+	"""
+	def __init__(self, file):
+		"""
+		Initialiser - instance variables:
+			__file: binary file object to read from, property with no access
+			blocks_read: number of data blocks decompressed, as int
+			blocks_skipped: number of data blocks skipped, as int
+
+		:param file: binary file object opened for reading, positioned at the start of the archive
+		"""
+		self.__file = file
+		self.blocks_read = 0
+		self.blocks_skipped = 0
+		magic, version = _FILE_HEADER.unpack(file.read(_FILE_HEADER.size))
+		if magic != ARCHIVE_MAGIC:
+			raise ValueError("Not a compressed time series access archive")
+		if version != ARCHIVE_VERSION:
+			raise ValueError("Unsupported compressed time series access archive version: {0}".format(version))
+
+	def records(self, start=None, stop=None):
+		"""
+		Generator of the records in the archive
+
+		:param start: skip data blocks entirely before this epoch, None for no lower bound
+		:param stop: skip data blocks entirely after this epoch, None for no upper bound
+
+		:return: yields ("start", start epoch, staff), ("readings", list of (epoch, temperature, humidity)) and
+		         ("stop", stop epoch, period length) tuples
+		"""
+		file = self.__file
+		while True:
+			record_type = file.read(1)
+			if not record_type:
+				return
+
+			if record_type == _RECORD_PERIOD_START:
+				start_epoch, length = struct.unpack("<IB", file.read(_PERIOD_START.size - 1))
+				yield "start", start_epoch, file.read(length).decode("utf-8")
+			elif record_type == _RECORD_PERIOD_STOP:
+				yield ("stop",) + struct.unpack("<II", file.read(_PERIOD_STOP.size - 1))
+			elif record_type == _RECORD_DATA_BLOCK:
+				header = BlockHeader(*struct.unpack("<HIIddddI", file.read(_DATA_BLOCK.size - 1)))
+				if not header.overlaps(start, stop):
+					file.seek(header.payload_length, os.SEEK_CUR)
+					self.blocks_skipped += 1
+					continue
+				self.blocks_read += 1
+				yield "readings", self.decode_block(header, file.read(header.payload_length))
+			else:
+				raise ValueError("Corrupt compressed time series access archive")
+
+	@staticmethod
+	def decode_block(header, payload):
+		"""
+		Decompress the payload of one data block
+
+		:param header: BlockHeader of the data block
+		:param payload: payload bytes of the data block
+
+		:return: list of (epoch, temperature, humidity) tuples
+		"""
+		reader = BitReader(payload)
+		epochs = [header.first_epoch]
+		delta = 0
+		for i in range(header.rows - 1):
+			control = reader.read_control(4)
+			if control:
+				control_bits, value_bits = _DOD_BUCKETS[control - 1][1:]
+				delta += reader.read(value_bits) - ((1 << (value_bits - 1)) - 1)
+			epochs.append(epochs[-1] + delta)
+
+		columns = []
+		for column in (1, 2):
+			decoder = _XorDecoder(reader)
+			columns.append([_bits_float(decoder.next()) for i in range(header.rows)])
+
+		return list(zip(epochs, *columns))
+
+	def to_access_periods(self, start=None, stop=None):
+		"""
+		Read the archive into AccessPeriod class instances, when a time window is given only the readings within it are
+		kept and periods with no readings in the window are left out
+
+		:param start: only keep data readings at or after this epoch, None for no lower bound
+		:param stop: only keep data readings at or before this epoch, None for no upper bound
+
+		:return: list of AccessPeriod class instances
+		"""
+		from DesktopApp import AccessPeriod, DataReading
+
+		windowed = start is not None or stop is not None
+		access_periods = []
+		access_period = None
+		for record in self.records(start, stop):
+			if record[0] == "start":
+				access_period = AccessPeriod(*epoch_to_marker(record[1]), record[2])
+			elif record[0] == "readings" and access_period is not None:
+				for epoch, temp_data, humidity_data in record[1]:
+					if (start is None or epoch >= start) and (stop is None or epoch <= stop):
+						access_period.add_data_reading(DataReading(epoch_to_timestamp(epoch), temp_data, humidity_data))
+			elif record[0] == "stop" and access_period is not None:
+				access_period.stop_date, access_period.stop_time = epoch_to_marker(record[1])
+				access_period.period_length = record[2]
+				if access_period.data_readings or not windowed:
+					access_periods.append(access_period)
+				access_period = None
+
+		return access_periods
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Convert PPW2 access data into a compressed time series archive")
+	parser.add_argument("archive", help="path of the archive to write")
+	parser.add_argument("data_file", help="access data file to read (.csv, .csv.gz or compact archive)")
+	parser.add_argument("--block-rows", type=int, default=DEFAULT_BLOCK_ROWS, help="readings per data block")
+	args = parser.parse_args(argv)
+
+	from DesktopApp import AccessPeriods
+	access_periods = AccessPeriods(args.data_file)
+	size = write_gorilla_archive(access_periods, args.archive, args.block_rows)
+	readings = sum(len(access_period.data_readings) for access_period in access_periods)
+
+	print("Wrote {0} periods, {1} readings, {2} bytes ({3:.2f} bytes per reading) to [{4}]".format(
+		len(access_periods), readings, size, size / readings if readings else 0.0, args.archive))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
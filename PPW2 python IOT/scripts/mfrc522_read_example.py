@@ -6,6 +6,7 @@
 
 # Imports
 from libs.iot_app import IoTApp
+from libs.wifi_manager import WiFiStates
 from libs.mfrc522 import MFRC522
 from machine import RTC, Pin
 from neopixel import NeoPixel
@@ -70,28 +71,21 @@ class MainApp(IoTApp):
         self.read = False
         self.data = None
         
-        self.wifi_msg = "No WIFI"
-        connect_count = 0
-        # Try to connect to WiFi 5 times, if unsuccessful then only try again if button A on
-        # the OLED is pressed
-        while connect_count < 5 and not self.is_wifi_connected():
-            self.oled_clear()
-            self.wifi_msg = "Connect WIFI:{0}".format(connect_count + 1) 
-            self.oled_text(self.wifi_msg, 0, 0)
-            self.oled_display()
-            self.connect_to_wifi(wifi_settings=(self.AP_SSID, self.AP_PSWD, True, self.AP_TOUT))
-            connect_count += 1
-            
-        if self.is_wifi_connected():
+        self.wifi_msg = "Connect WIFI"
+        # Start connecting to WiFi without waiting for it so tags can be read straight away, failed
+        # attempts are retried with a growing backoff and the MQTT broker is registered to in
+        # wifi_state_handler() once connected
+        self.connect_to_wifi(wifi_settings=(self.AP_SSID, self.AP_PSWD, True, self.AP_TOUT))
+
+    def wifi_state_handler(self, old_state, new_state):
+        if new_state == WiFiStates.CONNECTED:
             self.wifi_msg = "WIFI"
             # Register to the MQTT broker 
             self.register_to_mqtt(server=self.MQTT_ADDR, port=self.MQTT_PORT)
+        elif new_state == WiFiStates.CONNECTING:
+            self.wifi_msg = "Connect WIFI"
         else:
-            self.oled_clear()
             self.wifi_msg = "No WIFI"
-            self.oled_text(self.wifi_msg, 0, 0)
-            self.oled_display()
-            sleep(2)
 
         
     def loop(self):
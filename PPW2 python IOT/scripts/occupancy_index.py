@@ -0,0 +1,387 @@
+# File: occupancy_index.py
+# Description: Occupancy bitmap index for one room (rig), a roaring-style compressed bitmap of the minute slots each
+#              member of staff was present in plus the set of staff present in each slot, so presence, co-presence and
+#              occupancy count queries are set and bitmap operations instead of scans over every access period
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import bisect
+from array import array
+from DesktopApp import AccessPeriods, timestamp_to_epoch, epoch_to_timestamp
+
+
+# Constants
+DEFAULT_SLOT_SECONDS = 60
+ARRAY_LIMIT = 4096  # Containers holding more values than this are stored as bitmaps rather than sorted arrays
+UNOCCUPIED = ("", "None")
+
+
+# Functions
+def _cardinality(container):
+	"""
+	Number of values in a container
+	"""
+	return bin(container).count("1") if isinstance(container, int) else len(container)
+
+
+def _to_bitmap(container):
+	"""
+	Bitmap (int) form of a container
+	"""
+	if isinstance(container, int):
+		return container
+	bits = bytearray(8192)
+	for value in container:
+		bits[value >> 3] |= 1 << (value & 7)
+
+	return int.from_bytes(bits, "little")
+
+
+def _normalise(bitmap):
+	"""
+	Smallest form of a bitmap container, a sorted array once it holds no more than ARRAY_LIMIT values, None if empty
+	"""
+	if not bitmap:
+		return None
+	if _cardinality(bitmap) > ARRAY_LIMIT:
+		return bitmap
+
+	return array("H", _bitmap_values(bitmap))
+
+
+def _bitmap_values(bitmap):
+	"""
+	Generator of the values set in a bitmap container, in order
+	"""
+	data = bitmap.to_bytes(8192, "little")
+	for index, byte in enumerate(data):
+		if byte:
+			for bit in range(8):
+				if byte & (1 << bit):
+					yield (index << 3) | bit
+
+
+# Classes
+class RoaringBitmap:
+	"""
+	Class to hold a set of unsigned 32-bit integers as a roaring-style compressed bitmap, values are split on their
+	high 16 bits into containers, a sparse container is a sorted array of the low 16 bits and a dense one a 65536 bit
+	bitmap (held as a Python int so whole containers are combined with a single and/or)
+	"""
+	def __init__(self):
+		"""
+		Initialiser - instance variables:
+			__containers: dictionary of {high 16 bits: sorted array("H") or int bitmap}, property with no access
+		"""
+		self.__containers = {}
+
+	def __len__(self):
+		return sum(_cardinality(container) for container in self.__containers.values())
+
+	def __contains__(self, value):
+		container = self.__containers.get(value >> 16)
+		if container is None:
+			return False
+		low = value & 0xffff
+		if isinstance(container, int):
+			return bool(container >> low & 1)
+		position = bisect.bisect_left(container, low)
+
+		return position < len(container) and container[position] == low
+
+	def __iter__(self):
+		for high in sorted(self.__containers):
+			container = self.__containers[high]
+			values = _bitmap_values(container) if isinstance(container, int) else container
+			for low in values:
+				yield (high << 16) | low
+
+	def add_range(self, start, stop):
+		"""
+		Add every value from start up to (but not including) stop
+
+		:param start: first value, as int
+		:param stop: value after the last, as int
+
+		:return: nothing
+		"""
+		while start < stop:
+			high, low = start >> 16, start & 0xffff
+			end = min(stop - (high << 16), 0x10000)
+			container = self.__containers.get(high)
+			if isinstance(container, int) or (end - low) + (len(container) if container is not None else 0) > \
+					ARRAY_LIMIT:
+				bitmap = _to_bitmap(container) if container is not None else 0
+				self.__containers[high] = _normalise(bitmap | (((1 << (end - low)) - 1) << low))
+			elif container is None:
+				self.__containers[high] = array("H", range(low, end))
+			else:
+				self.__containers[high] = array("H", sorted(set(container).union(range(low, end))))
+			start = (high << 16) + end
+
+	def add(self, value):
+		"""
+		Add a single value
+
+		:param value: value to add, as int
+
+		:return: nothing
+		"""
+		self.add_range(value, value + 1)
+
+	def intersects_range(self, start, stop):
+		"""
+		Check whether any value from start up to (but not including) stop is present
+
+		:return: True or False
+		"""
+		for high in range(start >> 16, ((stop - 1) >> 16) + 1):
+			container = self.__containers.get(high)
+			if container is None:
+				continue
+			low = max(start - (high << 16), 0)
+			end = min(stop - (high << 16), 0x10000)
+			if isinstance(container, int):
+				if container >> low & ((1 << (end - low)) - 1):
+					return True
+			else:
+				position = bisect.bisect_left(container, low)
+				if position < len(container) and container[position] < end:
+					return True
+
+		return False
+
+	def __combine(self, other, intersect):
+		result = RoaringBitmap()
+		highs = self.__containers.keys() & other.__containers.keys() if intersect else \
+			self.__containers.keys() | other.__containers.keys()
+		for high in highs:
+			mine, theirs = self.__containers.get(high), other.__containers.get(high)
+			if mine is None or theirs is None:
+				container = mine if theirs is None else theirs
+			elif intersect and not isinstance(mine, int) and not isinstance(theirs, int):
+				container = array("H", sorted(set(mine).intersection(theirs))) or None
+			elif intersect:
+				container = _normalise(_to_bitmap(mine) & _to_bitmap(theirs))
+			else:
+				container = _normalise(_to_bitmap(mine) | _to_bitmap(theirs))
+			if container is not None:
+				result.__containers[high] = container
+
+		return result
+
+	def __and__(self, other):
+		return self.__combine(other, True)
+
+	def __or__(self, other):
+		return self.__combine(other, False)
+
+	def runs(self):
+		"""
+		Generator of the runs of consecutive values
+
+		:return: yields (first value, last value) tuples in order
+		"""
+		first = last = None
+		for value in self:
+			if last is not None and value == last + 1:
+				last = value
+				continue
+			if first is not None:
+				yield first, last
+			first = last = value
+		if first is not None:
+			yield first, last
+
+
+class OccupancyIndex:
+	"""
+	Class to hold the occupancy index of one room, time is split into fixed slots (one minute by default) and a member
+	of staff is present in every slot their access periods touch, the index is kept up to date as access periods are
+	ingested into the AccessPeriods class instance it was built from
+	"""
+	def __init__(self, access_periods=None, slot_seconds=DEFAULT_SLOT_SECONDS):
+		"""
+		Initialiser - instance variables:
+			__slot_seconds: width of each slot in seconds, property with read-only access
+			__bitmaps: dictionary of {staff id: RoaringBitmap of slots present}, property with no access
+			__slots: dictionary of {slot: set of staff ids present}, property with no access
+
+		:param access_periods: optional AccessPeriods class instance to build from and follow
+		:param slot_seconds: width of each slot in seconds, as int
+		"""
+		self.__slot_seconds = slot_seconds
+		self.__bitmaps = {}
+		self.__slots = {}
+		if access_periods is not None:
+			for access_period in access_periods:
+				self.add_period(access_period)
+			access_periods.add_ingest_listener(self.on_ingest)
+			access_periods.add_update_listener(self.on_update)
+
+	@property
+	def slot_seconds(self):
+		return self.__slot_seconds
+
+	@property
+	def staff(self):
+		return sorted(self.__bitmaps)
+
+	def add_period(self, access_period):
+		"""
+		Mark the staff member of an access period present in every slot from its start to its stop
+
+		:param access_period: AccessPeriod class instance
+
+		:return: nothing
+		"""
+		staff = access_period.staff
+		if staff in UNOCCUPIED:
+			return
+		self.__mark(staff, access_period.start_epoch // self.__slot_seconds,
+		            access_period.stop_epoch // self.__slot_seconds)
+
+	def __mark(self, staff, first, last):
+		"""
+		Mark a staff member present in every slot from first to last (inclusive)
+		"""
+		bitmap = self.__bitmaps.get(staff)
+		if bitmap is None:
+			bitmap = self.__bitmaps[staff] = RoaringBitmap()
+		bitmap.add_range(first, last + 1)
+		for slot in range(first, last + 1):
+			present = self.__slots.get(slot)
+			if present is None:
+				present = self.__slots[slot] = set()
+			present.add(staff)
+
+	def on_ingest(self, access_period):
+		"""
+		Ingest listener, add a newly added access period to the index
+
+		:param access_period: AccessPeriod class instance that has just been added
+
+		:return: nothing
+		"""
+		self.add_period(access_period)
+
+	def on_update(self, access_period, data_reading):
+		"""
+		Update listener, mark the staff member of an access period a data reading has been added to present in the
+		slots between the reading and the nearest slot of the access period already marked, so a late reading only
+		costs the slots the access period has grown by
+
+		:param access_period: AccessPeriod class instance that has been updated
+		:param data_reading: DataReading class instance that has been added
+
+		:return: nothing
+		"""
+		staff = access_period.staff
+		if staff in UNOCCUPIED:
+			return
+		slot = data_reading.epoch // self.__slot_seconds
+		if staff in self.__slots.get(slot, ()):
+			return
+
+		first = last = slot
+		period_first = access_period.start_epoch // self.__slot_seconds
+		period_last = access_period.stop_epoch // self.__slot_seconds
+		while first > period_first and staff not in self.__slots.get(first - 1, ()):
+			first -= 1
+		while last < period_last and staff not in self.__slots.get(last + 1, ()):
+			last += 1
+		self.__mark(staff, first, last)
+
+	def present_at(self, epoch):
+		"""
+		Staff present at a given time
+
+		:param epoch: seconds since the epoch, as int
+
+		:return: sorted list of staff ids
+		"""
+		return sorted(self.__slots.get(epoch // self.__slot_seconds, ()))
+
+	def occupancy_count(self, epoch):
+		"""
+		Number of staff present at a given time
+
+		:param epoch: seconds since the epoch, as int
+
+		:return: number of staff, as int
+		"""
+		return len(self.__slots.get(epoch // self.__slot_seconds, ()))
+
+	def present_between(self, start, stop):
+		"""
+		Staff present at any time within a time window
+
+		:param start: start of the time window in seconds since the epoch, as int
+		:param stop: end of the time window in seconds since the epoch, as int
+
+		:return: sorted list of staff ids
+		"""
+		first, last = int(start) // self.__slot_seconds, int(stop) // self.__slot_seconds
+		return sorted(staff for staff, bitmap in self.__bitmaps.items() if bitmap.intersects_range(first, last + 1))
+
+	def seconds_present(self, staff):
+		"""
+		Approximate time a member of staff was present (the number of slots they touched times the slot width)
+
+		:param staff: staff id, as string
+
+		:return: seconds, as int
+		"""
+		bitmap = self.__bitmaps.get(staff)
+		return len(bitmap) * self.__slot_seconds if bitmap is not None else 0
+
+	def copresence(self, *staff):
+		"""
+		Time windows in which all of the given staff were present together
+
+		:param staff: two or more staff ids, as strings
+
+		:return: list of (start epoch, stop epoch) tuples, a stop is the end of the last shared slot
+		"""
+		if not staff or any(member not in self.__bitmaps for member in staff):
+			return []
+		shared = self.__bitmaps[staff[0]]
+		for member in staff[1:]:
+			shared = shared & self.__bitmaps[member]
+
+		return [(first * self.__slot_seconds, (last + 1) * self.__slot_seconds) for first, last in shared.runs()]
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Query who was present in a room from its PPW2 access data")
+	parser.add_argument("data_files", nargs="+", help="access data files of the room")
+	parser.add_argument("--at", help="list the staff present at this time (rig timestamp, e.g. 2019-5-17|15:34:00)")
+	parser.add_argument("--together", nargs="+", metavar="STAFF", help="list when these staff were present together")
+	args = parser.parse_args(argv)
+
+	index = OccupancyIndex()
+	for data_file in args.data_files:
+		for access_period in AccessPeriods(data_file):
+			index.add_period(access_period)
+
+	if args.at:
+		epoch = timestamp_to_epoch(args.at)
+		print("{0}: {1} present {2}".format(args.at, index.occupancy_count(epoch), index.present_at(epoch)))
+	if args.together:
+		for start, stop in index.copresence(*args.together):
+			print("{0} to {1}".format(epoch_to_timestamp(start), epoch_to_timestamp(stop)))
+	if not args.at and not args.together:
+		for staff in index.staff:
+			print("{0}: present for about {1} minutes".format(staff, index.seconds_present(staff) // 60))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
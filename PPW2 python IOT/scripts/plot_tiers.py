@@ -0,0 +1,313 @@
+# File: plot_tiers.py
+# Description: Multi-resolution downsampled tiers for plotting long histories of PPW2 readings, each tier holds one
+#              Largest-Triangle-Three-Buckets point and a min/max envelope per time bucket and is built incrementally
+#              as readings are ingested, queries pick the coarsest tier that still fills the requested pixel width
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import bisect
+
+
+# Constants
+DEFAULT_RESOLUTIONS = (10, 60, 600, 3600, 86400)  # Tier bucket widths in seconds
+METRICS = ("temp", "humidity")
+
+
+# Functions
+def _triangle_area(a, b, c):
+	"""
+	Twice the area of the triangle formed by three (x, y) points, only used for comparisons
+	"""
+	return abs((a[0] - c[0]) * (b[1] - a[1]) - (a[0] - b[0]) * (c[1] - a[1]))
+
+
+def lttb(points, threshold):
+	"""
+	Downsample (x, y) points with the Largest-Triangle-Three-Buckets algorithm, the first and last points are always
+	kept and from every bucket in between the point forming the largest triangle with the previously selected point and
+	the average of the next bucket is kept
+
+	:param points: list of (x, y) tuples sorted by x
+	:param threshold: number of points to keep, as int
+
+	:return: list of (x, y) tuples
+	"""
+	if threshold >= len(points) or threshold < 3:
+		return list(points)
+
+	sampled = [points[0]]
+	every = (len(points) - 2) / (threshold - 2)
+	previous = points[0]
+	for i in range(threshold - 2):
+		first = int(i * every) + 1
+		last = int((i + 1) * every) + 1
+		next_first, next_last = last, min(int((i + 2) * every) + 1, len(points))
+		next_bucket = points[next_first:next_last] or [points[-1]]
+		average = (sum(point[0] for point in next_bucket) / len(next_bucket),
+		           sum(point[1] for point in next_bucket) / len(next_bucket))
+		previous = max(points[first:last], key=lambda point: _triangle_area(previous, point, average))
+		sampled.append(previous)
+	sampled.append(points[-1])
+
+	return sampled
+
+
+# Classes
+class DownsampleTier:
+	"""
+	Class to hold one resolution of downsampled points for a single metric, buckets are closed as soon as a reading for
+	a later bucket arrives, a closed bucket's LTTB point is selected once the bucket after it has also closed (LTTB needs
+	the average of the next bucket), so only the raw readings of the last two buckets are ever held
+	"""
+	def __init__(self, bucket_seconds):
+		"""
+		Initialiser - instance variables:
+			__bucket_seconds: width of each bucket in seconds, property with read-only access
+			__starts: list of bucket start epochs of the selected points, property with no access
+			__points: list of selected (x, y) points, one per bucket, property with no access
+			__envelopes: list of (minimum, maximum) per bucket, property with no access
+			__pending: raw (x, y) points of the closed bucket still waiting for its point to be selected, property
+			           with no access
+			__open: raw (x, y) points of the bucket currently being filled, property with no access
+			__pending_start: start epoch of the pending bucket, property with no access
+			__open_start: start epoch of the bucket currently being filled, property with no access
+
+		:param bucket_seconds: width of each bucket in seconds, as int
+		"""
+		self.__bucket_seconds = bucket_seconds
+		self.__starts = []
+		self.__points = []
+		self.__envelopes = []
+		self.__pending = None
+		self.__pending_start = None
+		self.__open = []
+		self.__open_start = None
+
+	@property
+	def bucket_seconds(self):
+		return self.__bucket_seconds
+
+	def __select(self, bucket, next_average):
+		"""
+		Pick the LTTB point of a closed bucket given the average point of the bucket that follows it
+		"""
+		if not self.__points:
+			return bucket[0]
+		previous = self.__points[-1]
+
+		return max(bucket, key=lambda point: _triangle_area(previous, point, next_average))
+
+	def __close_open_bucket(self):
+		"""
+		Close the bucket being filled, selecting the point of the pending bucket now its next bucket is complete
+		"""
+		bucket = self.__open
+		average = (sum(point[0] for point in bucket) / len(bucket), sum(point[1] for point in bucket) / len(bucket))
+		if self.__pending is not None:
+			self.__append(self.__pending_start, self.__pending, average)
+		self.__pending, self.__pending_start = bucket, self.__open_start
+		self.__open, self.__open_start = [], None
+
+	def __append(self, start, bucket, next_average):
+		self.__starts.append(start)
+		self.__points.append(self.__select(bucket, next_average))
+		values = [point[1] for point in bucket]
+		self.__envelopes.append((min(values), max(values)))
+
+	def add(self, epoch, value):
+		"""
+		Add a single reading, readings should arrive in time order, a late reading for an already selected bucket only
+		widens that bucket's envelope and a late reading for a bucket the tier has not seen yet inserts that bucket
+
+		:param epoch: timestamp of the reading in seconds since the epoch, as int
+		:param value: value of the reading, as float
+
+		:return: nothing
+		"""
+		start = epoch - epoch % self.__bucket_seconds
+		if self.__open_start is not None and start != self.__open_start:
+			if start < self.__open_start:
+				self.__add_late(start, epoch, value)
+				return
+			self.__close_open_bucket()
+		self.__open_start = start
+		self.__open.append((epoch, value))
+
+	def __add_late(self, start, epoch, value):
+		"""
+		Fold a reading that arrived after its bucket was closed into that bucket, or insert a new bucket in time order if
+		there is none (backfilled days, gaps, interleaved rigs), the raw readings of selected buckets are not kept so the
+		points of the neighbours of an inserted bucket stay as they were
+		"""
+		if start == self.__pending_start:
+			self.__pending.append((epoch, value))
+			return
+
+		if self.__pending_start is not None and start > self.__pending_start:
+			# The bucket falls in the gap between the pending and the open bucket, it becomes the pending bucket
+			self.__append(self.__pending_start, self.__pending, (epoch, value))
+			self.__pending, self.__pending_start = [(epoch, value)], start
+			return
+
+		position = bisect.bisect_left(self.__starts, start)
+		if position < len(self.__starts) and self.__starts[position] == start:
+			low, high = self.__envelopes[position]
+			self.__envelopes[position] = (min(low, value), max(high, value))
+		else:
+			self.__starts.insert(position, start)
+			self.__points.insert(position, (epoch, value))
+			self.__envelopes.insert(position, (value, value))
+
+	def __len__(self):
+		return len(self.__starts) + (self.__pending is not None) + bool(self.__open)
+
+	def query(self, start=None, stop=None):
+		"""
+		Points and envelopes of the buckets within a time window, the buckets still being filled are included using
+		their current readings
+
+		:param start: start of the time window in seconds since the epoch, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, None for no upper bound
+
+		:return: (list of (x, y) points, list of (bucket start, minimum, maximum) envelopes) tuple
+		"""
+		width = self.__bucket_seconds
+		first = 0 if start is None else bisect.bisect_left(self.__starts, start - start % width)
+		last = len(self.__starts) if stop is None else bisect.bisect_right(self.__starts, stop)
+		points = self.__points[first:last]
+		envelopes = [(self.__starts[i],) + self.__envelopes[i] for i in range(first, last)]
+
+		# Select provisional points for the unfinished buckets without changing the tier
+		tail = [(self.__pending_start, self.__pending), (self.__open_start, self.__open)]
+		tail = [(bucket_start, bucket) for bucket_start, bucket in tail if bucket]
+		previous = self.__points[-1] if self.__points else None
+		for i, (bucket_start, bucket) in enumerate(tail):
+			following = tail[i + 1][1] if i + 1 < len(tail) else bucket
+			average = (sum(point[0] for point in following) / len(following),
+			           sum(point[1] for point in following) / len(following))
+			point = bucket[0] if previous is None else max(bucket, key=lambda p: _triangle_area(previous, p, average))
+			previous = point
+			if (start is None or bucket_start + width > start) and (stop is None or bucket_start <= stop):
+				points.append(point)
+				values = [value for epoch, value in bucket]
+				envelopes.append((bucket_start, min(values), max(values)))
+
+		return points, envelopes
+
+	def count(self, start=None, stop=None):
+		"""
+		Number of buckets within a time window
+
+		:return: number of buckets, as int
+		"""
+		return len(self.query(start, stop)[0])
+
+
+class DownsampleTiers:
+	"""
+	Class to hold downsampled tiers at several resolutions for temperature and humidity, the tiers are kept up to date
+	as access periods are ingested into the AccessPeriods class instance they were built from
+	"""
+	def __init__(self, access_periods=None, resolutions=DEFAULT_RESOLUTIONS):
+		"""
+		Initialiser - instance variables:
+			access_periods: AccessPeriods class instance the tiers were built from (used for raw readings when even
+			                the finest tier is too coarse for a query), or None
+			resolutions: tier bucket widths in seconds, finest first
+			tiers: dictionary of {metric: list of DownsampleTier, finest first}
+
+		:param access_periods: optional AccessPeriods class instance to build from and follow
+		:param resolutions: iterable of tier bucket widths in seconds
+		"""
+		self.access_periods = access_periods
+		self.resolutions = tuple(sorted(resolutions))
+		self.tiers = {metric: [DownsampleTier(seconds) for seconds in self.resolutions] for metric in METRICS}
+
+		if access_periods is not None:
+			readings = sorted((data_reading.epoch, data_reading.temp_data, data_reading.humidity_data)
+			                  for access_period in access_periods for data_reading in access_period.data_readings)
+			for epoch, temp_data, humidity_data in readings:
+				self.add(epoch, temp_data, humidity_data)
+			access_periods.add_ingest_listener(self.on_ingest)
+			access_periods.add_update_listener(self.on_update)
+
+	def add(self, epoch, temp_data, humidity_data):
+		"""
+		Add a single reading to every tier
+
+		:param epoch: timestamp of the reading in seconds since the epoch, as int
+		:param temp_data: temperature, as float
+		:param humidity_data: humidity, as float
+
+		:return: nothing
+		"""
+		for tier in self.tiers["temp"]:
+			tier.add(epoch, temp_data)
+		for tier in self.tiers["humidity"]:
+			tier.add(epoch, humidity_data)
+
+	def on_ingest(self, access_period):
+		"""
+		Ingest listener, add the readings of a newly added access period to every tier
+
+		:param access_period: AccessPeriod class instance that has just been added
+
+		:return: nothing
+		"""
+		for data_reading in access_period.data_readings:
+			self.add(data_reading.epoch, data_reading.temp_data, data_reading.humidity_data)
+
+	def on_update(self, access_period, data_reading):
+		"""
+		Update listener, add a data reading added late to an already ingested access period to every tier
+
+		:param access_period: AccessPeriod class instance that has been updated
+		:param data_reading: DataReading class instance that has been added
+
+		:return: nothing
+		"""
+		self.add(data_reading.epoch, data_reading.temp_data, data_reading.humidity_data)
+
+	def query(self, metric, pixel_width, start=None, stop=None):
+		"""
+		Points to plot a metric over a time window at a given pixel width, the coarsest tier that still has at least one
+		bucket per pixel is used (falling back to the raw readings if even the finest tier is too coarse) and its points
+		are then reduced to the pixel width with LTTB
+
+		:param metric: "temp" or "humidity"
+		:param pixel_width: width of the plot in pixels, as int
+		:param start: start of the time window in seconds since the epoch, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, None for no upper bound
+
+		:return: dictionary of resolution (tier bucket seconds, 0 for raw readings), points (list of (x, y)) and
+		         envelope (list of (start, minimum, maximum))
+		"""
+		if metric not in METRICS:
+			raise ValueError("Unknown metric: {0}".format(metric))
+
+		for tier in reversed(self.tiers[metric]):
+			points, envelopes = tier.query(start, stop)
+			if len(points) >= pixel_width:
+				resolution = tier.bucket_seconds
+				break
+		else:
+			if self.access_periods is not None:
+				attribute = "temp_data" if metric == "temp" else "humidity_data"
+				points = sorted((data_reading.epoch, getattr(data_reading, attribute))
+				                for access_period, data_reading in self.access_periods.query_data_readings(start, stop))
+				envelopes = [(x, y, y) for x, y in points]
+				resolution = 0
+			else:
+				resolution = self.tiers[metric][0].bucket_seconds
+
+		if len(envelopes) > pixel_width:
+			# Merge neighbouring envelopes so there is one per pixel
+			per_pixel = len(envelopes) / pixel_width
+			merged = []
+			for i in range(pixel_width):
+				group = envelopes[int(i * per_pixel):int((i + 1) * per_pixel)]
+				merged.append((group[0][0], min(low for x, low, high in group), max(high for x, low, high in group)))
+			envelopes = merged
+
+		return {"resolution": resolution, "points": lttb(points, pixel_width), "envelope": envelopes}
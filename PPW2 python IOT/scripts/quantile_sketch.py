@@ -0,0 +1,218 @@
+# File: quantile_sketch.py
+# Description: Mergeable approximate quantile sketch (KLL) used by the Desktop App PPW2 to answer percentile queries
+#              over temperature and humidity readings in bounded memory
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import math
+
+
+# Classes
+class KLLSketch:
+	"""
+	Class to hold a KLL (Karnin, Lang, Liberty) quantile sketch, values are added one at a time into a stack of
+	compactors, when a compactor fills it is sorted and every other value is promoted to the compactor above (which
+	weighs each value twice as much), so memory stays at roughly 3k values regardless of how many readings are added.
+	Which half is promoted alternates between the odd and even values with every compaction, rather than being chosen
+	at random, so sketches are cheap to create and the same data always gives the same percentiles.
+	Two sketches can be merged, so sketches for periods, rollup buckets and rigs can be combined into one
+	"""
+	DEFAULT_K = 200
+
+	def __init__(self, k=DEFAULT_K, seed=None):
+		"""
+		Initialiser - instance variables:
+			__k: accuracy parameter, the top compactor holds k values, property with read-only access
+			__compactors: list of lists of values, compactor h holds values of weight 2 ** h, property with no access
+			__size: number of values held across all compactors, as int, property with no access
+			__max_size: total capacity across all compactors, as int, property with no access
+			__count: number of values added to this sketch, as int, property with read-only access
+			__min: smallest value added, as float, property with read-only access
+			__max: largest value added, as float, property with read-only access
+			__offset: offset (0 or 1) of the half of a compactor promoted by the next compaction, alternated after
+			          every compaction, property with no access
+
+		:param k: accuracy parameter, the rank error is roughly 1.7 / k
+		:param seed: optional int, its parity chooses the half promoted by the first compaction
+		"""
+		self.__k = k
+		self.__compactors = []
+		self.__size = 0
+		self.__max_size = 0
+		self.__count = 0
+		self.__min = None
+		self.__max = None
+		self.__offset = (seed or 0) & 1
+		self.__grow()
+
+	@property
+	def k(self):
+		return self.__k
+
+	@property
+	def count(self):
+		return self.__count
+
+	@property
+	def min(self):
+		return self.__min
+
+	@property
+	def max(self):
+		return self.__max
+
+	def __len__(self):
+		return self.__count
+
+	def __capacity(self, height):
+		"""
+		Capacity of the compactor at the given height, lower compactors are geometrically smaller (by a factor of 2/3)
+		than the top compactor
+		"""
+		depth = len(self.__compactors) - height - 1
+		return int(math.ceil((2.0 / 3.0) ** depth * self.__k)) + 1
+
+	def __grow(self):
+		"""
+		Add a new compactor on top of the stack and recalculate the total capacity
+		"""
+		self.__compactors.append([])
+		self.__max_size = sum(self.__capacity(height) for height in range(len(self.__compactors)))
+
+	def __compress(self):
+		"""
+		Compact the lowest compactor that is at (or over) capacity, promoting half of its values to the one above
+		"""
+		for height, compactor in enumerate(self.__compactors):
+			if len(compactor) >= self.__capacity(height):
+				if height + 1 >= len(self.__compactors):
+					self.__grow()
+
+				compactor.sort()
+				leftover = compactor.pop() if len(compactor) % 2 else None
+				self.__compactors[height + 1].extend(compactor[self.__offset::2])
+				self.__offset ^= 1
+				del compactor[:]
+				if leftover is not None:
+					compactor.append(leftover)
+
+				self.__size = sum(len(compactor) for compactor in self.__compactors)
+				return
+
+	def add(self, value):
+		"""
+		Add a single value to this sketch
+
+		:param value: value to be added, as float
+
+		:return: nothing
+		"""
+		self.__compactors[0].append(value)
+		self.__size += 1
+		self.__count += 1
+		if self.__min is None or value < self.__min:
+			self.__min = value
+		if self.__max is None or value > self.__max:
+			self.__max = value
+
+		if self.__size >= self.__max_size:
+			self.__compress()
+
+	def merge(self, other):
+		"""
+		Merge another sketch into this sketch, the other sketch is left unchanged
+
+		:param other: KLLSketch instance to be merged
+
+		:return: this sketch (to allow chaining)
+		"""
+		if not other.count:
+			return self
+
+		while len(self.__compactors) < len(other.__compactors):
+			self.__grow()
+
+		for height, compactor in enumerate(other.__compactors):
+			self.__compactors[height].extend(compactor)
+
+		self.__count += other.count
+		self.__min = other.min if self.__min is None else min(self.__min, other.min)
+		self.__max = other.max if self.__max is None else max(self.__max, other.max)
+		self.__size = sum(len(compactor) for compactor in self.__compactors)
+		while self.__size >= self.__max_size:
+			self.__compress()
+
+		return self
+
+	def __weighted_values(self):
+		"""
+		Sorted list of (value, weight) tuples held by this sketch
+		"""
+		weighted = []
+		for height, compactor in enumerate(self.__compactors):
+			weight = 1 << height
+			weighted.extend((value, weight) for value in compactor)
+		weighted.sort()
+
+		return weighted
+
+	def rank(self, value):
+		"""
+		Approximate number of added values that are less than or equal to the given value
+
+		:param value: value to rank, as float
+
+		:return: approximate rank, as int
+		"""
+		rank = 0
+		for height, compactor in enumerate(self.__compactors):
+			rank += sum(1 for held in compactor if held <= value) << height
+
+		return rank
+
+	def quantiles(self, fractions):
+		"""
+		Approximate quantiles of the added values
+
+		:param fractions: iterable of fractions between 0.0 and 1.0 (e.g. 0.5 for the median, 0.95 for p95)
+
+		:return: list of values in the same order as fractions, values are None if the sketch is empty
+		"""
+		fractions = list(fractions)
+		if not self.__count:
+			return [None] * len(fractions)
+
+		weighted = self.__weighted_values()
+		total = sum(weight for value, weight in weighted)
+
+		results = []
+		for fraction in fractions:
+			if fraction <= 0.0:
+				results.append(self.__min)
+				continue
+			if fraction >= 1.0:
+				results.append(self.__max)
+				continue
+
+			target = fraction * total
+			cumulative = 0
+			for value, weight in weighted:
+				cumulative += weight
+				if cumulative >= target:
+					results.append(value)
+					break
+			else:
+				results.append(self.__max)
+
+		return results
+
+	def quantile(self, fraction):
+		"""
+		Approximate single quantile of the added values
+
+		:param fraction: fraction between 0.0 and 1.0
+
+		:return: value, or None if the sketch is empty
+		"""
+		return self.quantiles([fraction])[0]
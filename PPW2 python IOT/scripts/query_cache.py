@@ -0,0 +1,252 @@
+# File: query_cache.py
+# Description: Bounded LRU result cache in front of the AccessPeriods query layer, cached results are invalidated
+#              precisely when access periods overlapping their time window are ingested or corrected
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+from collections import OrderedDict
+
+
+# Constants
+DEFAULT_MAX_ENTRIES = 256
+
+
+# Functions
+def _overlaps(start, stop, other_start, other_stop):
+	"""
+	Check whether two time windows overlap, a bound of None means the window is unbounded on that side
+
+	:return: True if the windows overlap, False otherwise
+	"""
+	if stop is not None and other_start is not None and stop < other_start:
+		return False
+	if start is not None and other_stop is not None and other_stop < start:
+		return False
+
+	return True
+
+
+# Classes
+class QueryCache:
+	"""
+	Class to hold a bounded least recently used cache of query results, every entry records the time window its query
+	covered so that ingesting new data only evicts the entries it could have changed
+	"""
+	def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+		"""
+		Initialiser - instance variables:
+			__entries: ordered dictionary of {key: (result, start, stop)} with the most recently used entry last,
+			           property with no access
+			max_entries: maximum number of entries held before the least recently used entry is evicted, as int
+			hits: number of lookups answered from the cache, as int
+			misses: number of lookups not found in the cache, as int
+			evictions: number of entries evicted because the cache was full, as int
+			invalidations: number of entries removed because overlapping data was ingested, as int
+
+		:param max_entries: maximum number of entries, as int
+		"""
+		self.__entries = OrderedDict()
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	def __len__(self):
+		return len(self.__entries)
+
+	def get(self, key, default=None):
+		"""
+		Look up a cached result, marking it as the most recently used entry
+
+		:param key: normalised query key, as a hashable tuple
+		:param default: value to return if the key is not cached
+
+		:return: cached result or default
+		"""
+		entry = self.__entries.get(key)
+		if entry is None:
+			self.misses += 1
+			return default
+
+		self.__entries.move_to_end(key)
+		self.hits += 1
+		return entry[0]
+
+	def put(self, key, result, start=None, stop=None):
+		"""
+		Cache a query result, evicting the least recently used entry if the cache is full
+
+		:param key: normalised query key, as a hashable tuple
+		:param result: query result to cache
+		:param start: start of the time window the query covered in seconds since the epoch, None if unbounded
+		:param stop: end of the time window the query covered in seconds since the epoch, None if unbounded
+
+		:return: nothing
+		"""
+		self.__entries[key] = (result, start, stop)
+		self.__entries.move_to_end(key)
+		while len(self.__entries) > self.max_entries:
+			self.__entries.popitem(last=False)
+			self.evictions += 1
+
+	def invalidate(self, start=None, stop=None):
+		"""
+		Remove every cached entry whose time window overlaps the given time window
+
+		:param start: start of the changed time window in seconds since the epoch, None if unbounded
+		:param stop: end of the changed time window in seconds since the epoch, None if unbounded
+
+		:return: number of entries removed, as int
+		"""
+		stale = [key for key, (result, entry_start, entry_stop) in self.__entries.items()
+		         if _overlaps(start, stop, entry_start, entry_stop)]
+		for key in stale:
+			del self.__entries[key]
+		self.invalidations += len(stale)
+
+		return len(stale)
+
+	def clear(self):
+		"""
+		Remove every cached entry (the counters are kept)
+
+		:return: nothing
+		"""
+		self.invalidations += len(self.__entries)
+		self.__entries.clear()
+
+	def stats(self):
+		"""
+		Snapshot of the cache counters
+
+		:return: dictionary of entries, max_entries, hits, misses, hit_ratio, evictions and invalidations
+		"""
+		lookups = self.hits + self.misses
+		return {"entries": len(self.__entries), "max_entries": self.max_entries, "hits": self.hits,
+		        "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else None,
+		        "evictions": self.evictions, "invalidations": self.invalidations}
+
+
+class CachedAccessPeriods:
+	"""
+	Class to put a QueryCache in front of the query methods of an AccessPeriods class instance, it offers the same
+	query methods so it can be used wherever the AccessPeriods instance was queried, results are shared between
+	callers so they must be treated as read-only, raw data readings are streamed from the AccessPeriods instance rather
+	than cached so a wide query never pins a copy of the readings in memory. Cached results are invalidated as access
+	periods are ingested or updated through AccessPeriods.add_data_reading(), anything else changing already ingested
+	access periods in place must call invalidate() (e.g. register on_correction() with
+	WatermarkIngestor.add_correction_listener())
+	"""
+	def __init__(self, access_periods, max_entries=DEFAULT_MAX_ENTRIES):
+		"""
+		Initialiser - instance variables:
+			access_periods: AccessPeriods class instance being queried
+			cache: QueryCache class instance holding the results
+
+		:param access_periods: AccessPeriods class instance
+		:param max_entries: maximum number of cached results, as int
+		"""
+		self.access_periods = access_periods
+		self.cache = QueryCache(max_entries)
+		access_periods.add_ingest_listener(self.on_ingest)
+		access_periods.add_update_listener(self.on_update)
+
+	def __len__(self):
+		return len(self.access_periods)
+
+	def __iter__(self):
+		return iter(self.access_periods)
+
+	def on_ingest(self, access_period):
+		"""
+		Ingest listener, invalidate every cached result whose time window overlaps the ingested access period
+
+		:param access_period: AccessPeriod class instance that has just been added
+
+		:return: nothing
+		"""
+		self.cache.invalidate(access_period.start_epoch, access_period.stop_epoch)
+
+	def on_update(self, access_period, data_reading):
+		"""
+		Update listener, invalidate every cached result whose time window overlaps an access period a data reading has
+		been added to
+
+		:param access_period: AccessPeriod class instance that has been updated
+		:param data_reading: DataReading class instance that has been added
+
+		:return: nothing
+		"""
+		self.cache.invalidate(access_period.start_epoch, access_period.stop_epoch)
+
+	def on_correction(self, bucket, access_period):
+		"""
+		Correction listener for WatermarkIngestor.add_correction_listener(), invalidate every cached result whose time
+		window overlaps the access period a late reading was added to
+
+		:param bucket: RollupBucket class instance the late reading was added to
+		:param access_period: AccessPeriod class instance the late reading was added to, None if no access period
+		                      covers it
+
+		:return: nothing
+		"""
+		if access_period is not None:
+			self.invalidate(access_period.start_epoch, access_period.stop_epoch)
+
+	def invalidate(self, start=None, stop=None):
+		"""
+		Invalidate every cached result whose time window overlaps a time window of already ingested data that has
+		changed in place
+
+		:param start: start of the changed time window in seconds since the epoch, None if unbounded
+		:param stop: end of the changed time window in seconds since the epoch, None if unbounded
+
+		:return: number of cached results removed, as int
+		"""
+		return self.cache.invalidate(start, stop)
+
+	def add_access_period(self, access_period):
+		"""
+		Add an access period to the underlying AccessPeriods instance (which invalidates the affected results)
+
+		:param access_period: AccessPeriod class instance to be added
+
+		:return: nothing
+		"""
+		self.access_periods.add_access_period(access_period)
+
+	def __cached(self, name, start, stop, staff, query):
+		"""
+		Answer a query from the cache, running it and caching its result on a miss
+		"""
+		# Normalise the parameters so equivalent queries share an entry (e.g. 1558107252.0 and 1558107252)
+		start = None if start is None else int(start)
+		stop = None if stop is None else int(stop)
+		key = (name, start, stop, staff)
+
+		result = self.cache.get(key)
+		if result is None:
+			result = query(start, stop, staff)
+			self.cache.put(key, result, start, stop)
+
+		return result
+
+	def query_access_periods(self, start=None, stop=None, staff=None):
+		"""
+		Cached version of AccessPeriods.query_access_periods()
+		"""
+		return self.__cached("periods", start, stop, staff, self.access_periods.query_access_periods)
+
+	def query_data_readings(self, start=None, stop=None, staff=None):
+		"""
+		Uncached AccessPeriods.query_data_readings(), the readings are streamed straight from the AccessPeriods instance
+		"""
+		return self.access_periods.query_data_readings(start, stop, staff)
+
+	def query_staff_summaries(self, start=None, stop=None, staff=None):
+		"""
+		Cached version of AccessPeriods.query_staff_summaries()
+		"""
+		return self.__cached("staff", start, stop, staff, self.access_periods.query_staff_summaries)
@@ -0,0 +1,276 @@
+# File: retention.py
+# Description: Retention manager for the rig and day partitioned store (see rig_partitions.py), ages each partition
+#              through tiers of raw readings, one minute rollups and one hour rollups, rewriting whole partitions in
+#              bulk and deleting the raw readings once they are past their time to live
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import os
+import shutil
+import struct
+import time
+from DesktopApp import AccessPeriods, RollupBucket
+from rig_partitions import PartitionedStore, SECONDS_PER_DAY
+from zone_maps import zone_map_file
+
+
+# Constants
+TIER_MAGIC = b"PPWR"
+TIER_VERSION = 1
+MINUTE = 60
+HOUR = 3600
+DEFAULT_RAW_TTL_DAYS = 28
+DEFAULT_MINUTE_TTL_DAYS = 365
+
+# Rollup tier file layout (all little-endian):
+#   header:  magic, version, flags, bucket width in seconds, bucket count
+#   buckets: bucket count x (start epoch, count, temp min, temp max, temp total, humidity min, humidity max, humidity
+#            total), sorted by start
+_TIER_HEADER = struct.Struct("<4sHHII")
+_TIER_BUCKET = struct.Struct("<qIdddddd")
+
+
+# Functions
+def tier_file_name(bucket_seconds):
+	"""
+	Name of the rollup tier file of a partition
+
+	:param bucket_seconds: width of the tier's buckets in seconds, as int
+
+	:return: file name, as string
+	"""
+	return "rollup-{0}.ppwr".format(bucket_seconds)
+
+
+def write_rollup_file(tier_file, buckets, bucket_seconds):
+	"""
+	Write rollup buckets to a tier file, the file is written beside the old one and then swapped in
+
+	:param tier_file: path of the tier file, as string
+	:param buckets: dictionary of {bucket start: RollupBucket}
+	:param bucket_seconds: width of the buckets in seconds, as int
+
+	:return: number of bytes written
+	"""
+	parts = [_TIER_HEADER.pack(TIER_MAGIC, TIER_VERSION, 0, bucket_seconds, len(buckets))]
+	for start in sorted(buckets):
+		parts.append(_TIER_BUCKET.pack(start, *buckets[start].totals()))
+	data = b"".join(parts)
+
+	temp_file = tier_file + ".tmp"
+	with open(temp_file, "wb") as file:
+		file.write(data)
+	os.replace(temp_file, tier_file)
+
+	return len(data)
+
+
+def read_rollup_file(tier_file):
+	"""
+	Read the rollup buckets of a tier file, the buckets' percentile sketches are not stored so are empty
+
+	:param tier_file: path of the tier file, as string
+
+	:return: dictionary of {bucket start: RollupBucket}
+	"""
+	with open(tier_file, "rb") as file:
+		data = file.read()
+
+	magic, version, flags, bucket_seconds, count = _TIER_HEADER.unpack_from(data, 0)
+	if magic != TIER_MAGIC or version != TIER_VERSION:
+		raise ValueError("Not a rollup tier file: {0}".format(tier_file))
+
+	buckets = {}
+	for fields in _TIER_BUCKET.iter_unpack(data[_TIER_HEADER.size:_TIER_HEADER.size + count * _TIER_BUCKET.size]):
+		buckets[fields[0]] = RollupBucket.from_totals(fields[0], bucket_seconds, fields[1:])
+
+	return buckets
+
+
+def rebucket(buckets, bucket_seconds):
+	"""
+	Merge rollup buckets into coarser buckets, the new width should be a multiple of the old one
+
+	:param buckets: dictionary of {bucket start: RollupBucket}
+	:param bucket_seconds: width of the new buckets in seconds, as int
+
+	:return: dictionary of {bucket start: RollupBucket}
+	"""
+	merged = {}
+	for start, bucket in buckets.items():
+		merged_start = start - start % bucket_seconds
+		if merged_start not in merged:
+			merged[merged_start] = RollupBucket(merged_start, bucket_seconds)
+		merged[merged_start].merge(bucket)
+
+	return merged
+
+
+def merge_rollups(buckets, other):
+	"""
+	Merge one dictionary of rollup buckets of the same width into another
+
+	:param buckets: dictionary of {bucket start: RollupBucket} to merge into, updated in place
+	:param other: dictionary of {bucket start: RollupBucket} to be merged
+
+	:return: buckets
+	"""
+	for start, bucket in other.items():
+		if start in buckets:
+			buckets[start].merge(bucket)
+		else:
+			buckets[start] = bucket
+
+	return buckets
+
+
+def read_partition_rollup(partition, bucket_seconds):
+	"""
+	Roll up the readings of a partition at a given width from the data the partition still holds, the raw archive
+	merged with every rollup tier no wider than the requested width, a partition holds both when late data was
+	ingested after it was aged
+
+	:param partition: Partition class instance
+	:param bucket_seconds: width of the buckets in seconds, as int
+
+	:return: dictionary of {bucket start: RollupBucket}, empty if the partition has no data fine enough
+	"""
+	buckets = {}
+	if os.path.exists(partition.archive_file):
+		buckets = AccessPeriods(partition.archive_file).rollup(bucket_seconds)
+
+	for tier_seconds in (MINUTE, HOUR):
+		tier_file = os.path.join(partition.path, tier_file_name(tier_seconds))
+		if tier_seconds <= bucket_seconds and os.path.exists(tier_file):
+			buckets = merge_rollups(buckets, rebucket(read_rollup_file(tier_file), bucket_seconds))
+
+	return buckets
+
+
+# Classes
+class RetentionPolicy:
+	"""
+	Class to hold how long each tier of data is kept, ages are measured from the end of a partition's day
+	"""
+	def __init__(self, raw_ttl_days=DEFAULT_RAW_TTL_DAYS, minute_ttl_days=DEFAULT_MINUTE_TTL_DAYS, hour_ttl_days=None):
+		"""
+		Initialiser - instance variables:
+			raw_ttl: seconds raw readings are kept before being rolled up into one minute buckets, as int
+			minute_ttl: seconds one minute buckets are kept before being rolled up into one hour buckets, as int
+			hour_ttl: seconds one hour buckets are kept before the partition is deleted, None to keep them forever
+
+		:param raw_ttl_days: days raw readings are kept, as int
+		:param minute_ttl_days: days one minute rollups are kept, as int
+		:param hour_ttl_days: days one hour rollups are kept, as int, None to keep them forever
+		"""
+		if minute_ttl_days < raw_ttl_days or (hour_ttl_days is not None and hour_ttl_days < minute_ttl_days):
+			raise ValueError("Each tier must be kept at least as long as the tier before it")
+		self.raw_ttl = raw_ttl_days * SECONDS_PER_DAY
+		self.minute_ttl = minute_ttl_days * SECONDS_PER_DAY
+		self.hour_ttl = hour_ttl_days * SECONDS_PER_DAY if hour_ttl_days is not None else None
+
+
+class RetentionManager:
+	"""
+	Class to apply a retention policy to a partitioned store, each run rewrites every partition that has aged past a
+	tier's time to live in one pass: raw archive to one minute tier, one minute tier to one hour tier, and finally
+	removal, so the partitions holding raw readings (the ones scans pay for) only cover the raw time to live
+	"""
+	def __init__(self, store, policy=None):
+		"""
+		Initialiser - instance variables:
+			store: PartitionedStore class instance
+			policy: RetentionPolicy class instance
+
+		:param store: PartitionedStore class instance
+		:param policy: optional RetentionPolicy class instance, the defaults are used if None
+		"""
+		self.store = store
+		self.policy = policy if policy is not None else RetentionPolicy()
+
+	def run(self, now=None):
+		"""
+		Age every partition of the store according to the retention policy
+
+		:param now: current time in seconds since the epoch, the system clock is used if None
+
+		:return: dictionary of counters (partitions, minute, hour, deleted and bytes freed)
+		"""
+		now = int(time.time()) if now is None else now
+		stats = {"partitions": 0, "minute": 0, "hour": 0, "deleted": 0, "bytes_freed": 0}
+		for partition in self.store.partitions(with_rollups=True):
+			stats["partitions"] += 1
+			age = now - (partition.day + SECONDS_PER_DAY)
+			before = self.__partition_size(partition)
+			minute_file = os.path.join(partition.path, tier_file_name(MINUTE))
+			hour_file = os.path.join(partition.path, tier_file_name(HOUR))
+
+			if self.policy.hour_ttl is not None and age > self.policy.hour_ttl:
+				shutil.rmtree(partition.path)
+				stats["deleted"] += 1
+				stats["bytes_freed"] += before
+				continue
+
+			if age > self.policy.raw_ttl and os.path.exists(partition.archive_file):
+				# Merge with any existing minute tier, e.g. when late data was ingested into an aged partition
+				buckets = AccessPeriods(partition.archive_file).rollup(MINUTE)
+				if os.path.exists(minute_file):
+					buckets = merge_rollups(read_rollup_file(minute_file), buckets)
+				write_rollup_file(minute_file, buckets, MINUTE)
+				os.remove(partition.archive_file)
+				if os.path.exists(zone_map_file(partition.archive_file)):
+					os.remove(zone_map_file(partition.archive_file))
+				stats["minute"] += 1
+
+			if age > self.policy.minute_ttl and os.path.exists(minute_file):
+				buckets = rebucket(read_rollup_file(minute_file), HOUR)
+				if os.path.exists(hour_file):
+					buckets = merge_rollups(read_rollup_file(hour_file), buckets)
+				write_rollup_file(hour_file, buckets, HOUR)
+				os.remove(minute_file)
+				stats["hour"] += 1
+
+			stats["bytes_freed"] += before - self.__partition_size(partition)
+
+		return stats
+
+	@staticmethod
+	def __partition_size(partition):
+		"""
+		Total size in bytes of the files of a partition
+		"""
+		return sum(os.path.getsize(os.path.join(partition.path, name)) for name in os.listdir(partition.path))
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Age a PPW2 partitioned store through its retention tiers")
+	parser.add_argument("root", help="root directory of the partitioned store")
+	parser.add_argument("--raw-ttl", type=int, default=DEFAULT_RAW_TTL_DAYS, help="days raw readings are kept")
+	parser.add_argument("--minute-ttl", type=int, default=DEFAULT_MINUTE_TTL_DAYS, help="days minute rollups are kept")
+	parser.add_argument("--hour-ttl", type=int, default=None, help="days hour rollups are kept (default forever)")
+	parser.add_argument("--every", type=int, default=None, metavar="SECONDS",
+	                    help="keep running, applying the policy every SECONDS seconds")
+	args = parser.parse_args(argv)
+
+	manager = RetentionManager(PartitionedStore(args.root), RetentionPolicy(args.raw_ttl, args.minute_ttl,
+	                                                                        args.hour_ttl))
+	while True:
+		stats = manager.run()
+		print("{0} partitions checked: {1} aged to minute rollups, {2} aged to hour rollups, {3} deleted, {4} bytes "
+		      "freed".format(stats["partitions"], stats["minute"], stats["hour"], stats["deleted"],
+		                     stats["bytes_freed"]))
+		if args.every is None:
+			break
+		time.sleep(args.every)
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
@@ -0,0 +1,377 @@
+# File: rig_partitions.py
+# Description: Rig and day partitioned storage for PPW2 access data, each partition (root/rig=<id>/day=YYYY-MM-DD) holds
+#              one compact archive (see access_compact.py) and queries fan out across the partitions that can match on a
+#              pool of worker processes, so adding rigs adds partitions that are queried in parallel
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import calendar
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from access_compact import LogCompactor
+from DesktopApp import AccessPeriods, merge_staff_summaries, finish_staff_summaries
+from zone_maps import build_zone_map, plan_scan
+
+
+# Constants
+SECONDS_PER_DAY = 86400
+ARCHIVE_NAME = "access.ppwc"
+LONGEST_NAME = "longest_period"  # File in each rig directory holding the length in seconds of its longest access period
+UNKNOWN_RIG = "unknown"  # Rig id used for data files written before rigs recorded a RIG-ID line
+QUERIES = ("periods", "staff", "rollup")
+
+
+# Functions
+def day_start(epoch):
+	"""
+	Start of the (UTC) day holding the given time
+
+	:param epoch: seconds since the epoch, as int
+
+	:return: seconds since the epoch, as int
+	"""
+	return epoch - epoch % SECONDS_PER_DAY
+
+
+def _query_partition(task):
+	"""
+	Partition worker task, load one partition's archive and run a query against it
+
+	:param task: (Partition, query name, query arguments tuple) tuple, query name is one of QUERIES
+
+	:return: list of AccessPeriod instances, partial staff summaries dictionary or rollup buckets dictionary
+	"""
+	partition, query, arguments = task
+	if query == "rollup":
+		# Partitions aged by the retention manager only hold rollup tiers, which it knows how to read
+		from retention import read_partition_rollup
+		return read_partition_rollup(partition, *arguments)
+
+	if not os.path.exists(partition.archive_file):
+		return [] if query == "periods" else {}
+	access_periods = AccessPeriods(partition.archive_file)
+	if query == "periods":
+		return access_periods.query_access_periods(*arguments)
+
+	return access_periods.query_staff_partials(*arguments)
+
+
+# Classes
+class Partition:
+	"""
+	Class to hold the location of a single rig and day partition
+	"""
+	def __init__(self, root, rig_id, day):
+		"""
+		Initialiser - instance variables:
+			rig_id: unique id of the rig, as string
+			day: start of the partition's day in seconds since the epoch, as int
+			path: directory of the partition, as string
+
+		:param root: root directory of the partitioned store, as string
+		:param rig_id: unique id of the rig, as string
+		:param day: start of the partition's day in seconds since the epoch, as int
+		"""
+		self.rig_id = rig_id
+		self.day = day
+		self.path = os.path.join(root, "rig={0}".format(rig_id), "day={0}".format(time.strftime("%Y-%m-%d",
+		                                                                                      time.gmtime(day))))
+
+	@property
+	def archive_file(self):
+		return os.path.join(self.path, ARCHIVE_NAME)
+
+	def __repr__(self):
+		return "Partition({0!r}, {1})".format(self.rig_id, time.strftime("%Y-%m-%d", time.gmtime(self.day)))
+
+
+class PartitionedStore:
+	"""
+	Class to hold access periods partitioned by rig id and by the day each access period started, queries only open the
+	partitions whose rig and day can match and run them in parallel on a pool of worker processes
+	"""
+	def __init__(self, root, max_workers=None):
+		"""
+		Initialiser - instance variables:
+			__root: root directory of the store, property with read-only access
+			__max_workers: number of query worker processes, None for one per core, property with no access
+			__executor: pool of query worker processes, started by the first query that needs it, property with no
+			            access
+			last_plan: dictionary of the numbers of partitions scanned and skipped by the last plan(), None before the
+			           first
+
+		:param root: root directory of the store, as string, created if it does not exist
+		:param max_workers: number of query worker processes, None for one per core
+		"""
+		self.__root = root
+		self.__max_workers = max_workers
+		self.__executor = None
+		self.last_plan = None
+		os.makedirs(root, exist_ok=True)
+
+	@property
+	def root(self):
+		return self.__root
+
+	def close(self):
+		"""
+		Shut down the pool of query worker processes, a later query starts a new one
+
+		:return: nothing
+		"""
+		if self.__executor is not None:
+			self.__executor.shutdown()
+			self.__executor = None
+
+	def longest_period(self, rig_id):
+		"""
+		Length of the longest access period written for a rig
+
+		:param rig_id: unique id of the rig, as string
+
+		:return: length in seconds, as int, None if it is not known (e.g. a store written before it was recorded)
+		"""
+		try:
+			with open(os.path.join(self.__root, "rig={0}".format(rig_id), LONGEST_NAME)) as file:
+				return int(file.read())
+		except (OSError, ValueError):
+			return None
+
+	def write(self, access_periods, rig_id=None):
+		"""
+		Add access periods to their rig and day partitions, access periods already held by a partition (same start
+		time and staff id) are merged with the new ones rather than duplicated
+
+		:param access_periods: AccessPeriods class instance, or iterable of AccessPeriod instances
+		:param rig_id: unique id of the rig that recorded the access periods, by default the rig id read from the data
+		               file
+
+		:return: list of the Partition instances written
+		"""
+		if rig_id is None:
+			rig_id = getattr(access_periods, "rig_id", None) or UNKNOWN_RIG
+
+		days = {}
+		longest = 0
+		for access_period in access_periods:
+			days.setdefault(day_start(access_period.start_epoch), []).append(access_period)
+			longest = max(longest, access_period.stop_epoch - access_period.start_epoch)
+
+		written = []
+		for day, day_periods in sorted(days.items()):
+			partition = Partition(self.__root, rig_id, day)
+			compactor = LogCompactor()
+			if os.path.exists(partition.archive_file):
+				compactor.add_access_periods(AccessPeriods(partition.archive_file))
+			compactor.add_access_periods(day_periods)
+
+			# Write beside the old archive and then swap it in, so a query never sees a partly written partition
+			os.makedirs(partition.path, exist_ok=True)
+			temp_file = partition.archive_file + ".tmp"
+			archive = compactor.build()
+			archive.write(temp_file)
+			os.replace(temp_file, partition.archive_file)
+			build_zone_map(partition.archive_file, archive.to_access_periods())
+			written.append(partition)
+
+		# Record the longest access period of the rig so partitions() knows how far back a period can start and
+		# still overlap a time window
+		if written:
+			known = self.longest_period(rig_id)
+			if known is None or longest > known:
+				longest_file = os.path.join(self.__root, "rig={0}".format(rig_id), LONGEST_NAME)
+				with open(longest_file + ".tmp", "w") as file:
+					file.write(str(longest if known is None else max(longest, known)))
+				os.replace(longest_file + ".tmp", longest_file)
+
+		return written
+
+	def ingest(self, data_file, rig_id=None):
+		"""
+		Read an access data file and add its access periods to the store
+
+		:param data_file: path to the access data file, as string
+		:param rig_id: unique id of the rig, by default the id from the file's RIG-ID line
+
+		:return: list of the Partition instances written
+		"""
+		return self.write(AccessPeriods(data_file), rig_id)
+
+	def partitions(self, start=None, stop=None, rig_ids=None, with_rollups=False):
+		"""
+		Find the partitions that can hold access periods overlapping a time window, an access period is stored under
+		the day it started so the days before the window are included as far back as the rig's longest access period
+		(every earlier day if that is not known)
+
+		:param start: start of the time window in seconds since the epoch, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, None for no upper bound
+		:param rig_ids: iterable of rig ids to restrict the search to, None for all rigs
+		:param with_rollups: also include partitions whose raw archive has been replaced by rollup tiers (see
+		                     retention.py)
+
+		:return: list of Partition instances sorted by day and rig id
+		"""
+		partitions = []
+		for rig_name in sorted(os.listdir(self.__root)):
+			if not rig_name.startswith("rig="):
+				continue
+			rig_id = rig_name[len("rig="):]
+			if rig_ids is not None and rig_id not in rig_ids:
+				continue
+			longest = self.longest_period(rig_id)
+			for day_name in os.listdir(os.path.join(self.__root, rig_name)):
+				if not day_name.startswith("day="):
+					continue
+				try:
+					day = calendar.timegm(time.strptime(day_name[len("day="):], "%Y-%m-%d"))
+				except ValueError:
+					continue
+				if stop is not None and day > stop:
+					continue
+				if start is not None and longest is not None and day + SECONDS_PER_DAY + longest < start:
+					continue
+				partition = Partition(self.__root, rig_id, day)
+				if os.path.exists(partition.archive_file) or (with_rollups and os.path.isdir(partition.path)):
+					partitions.append(partition)
+
+		partitions.sort(key=lambda partition: (partition.day, partition.rig_id))
+
+		return partitions
+
+	def plan(self, start=None, stop=None, staff=None, rig_ids=None):
+		"""
+		Find the partitions a query has to scan, the partitions matching the rig ids and days are narrowed down further
+		with their zone maps (see zone_maps.py) so partitions whose time range or staff ids rule out a match are never
+		opened, the numbers scanned and skipped are kept in the last_plan attribute
+
+		:param start: start of the time window in seconds since the epoch, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, None for no upper bound
+		:param staff: staff id the query is for, None for any
+		:param rig_ids: iterable of rig ids to restrict the search to, None for all rigs
+
+		:return: list of Partition instances sorted by day and rig id
+		"""
+		partitions = self.partitions(start, stop, rig_ids)
+		scan, skipped = plan_scan([partition.archive_file for partition in partitions], start, stop, staff)
+		scan = set(scan)
+		self.last_plan = {"scanned": len(scan), "skipped": len(skipped)}
+
+		return [partition for partition in partitions if partition.archive_file in scan]
+
+	def __fan_out(self, partitions, query, arguments):
+		"""
+		Run a query against every partition on the worker pool, the pool is kept for the store's later queries until
+		close() is called
+
+		:return: list of (Partition, result) tuples in partition order
+		"""
+		tasks = [(partition, query, arguments) for partition in partitions]
+		if len(tasks) <= 1 or self.__max_workers == 1:
+			results = [_query_partition(task) for task in tasks]
+		else:
+			if self.__executor is None:
+				self.__executor = ProcessPoolExecutor(max_workers=self.__max_workers)
+			results = list(self.__executor.map(_query_partition, tasks))
+
+		return list(zip(partitions, results))
+
+	def query_access_periods(self, start=None, stop=None, staff=None, rig_ids=None):
+		"""
+		Find the access periods that overlap a time window across all matching partitions
+
+		:param start: start of the time window in seconds since the epoch, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, None for no upper bound
+		:param staff: staff id to filter by, as string, None for all staff
+		:param rig_ids: iterable of rig ids to restrict the query to, None for all rigs
+
+		:return: list of (rig id, AccessPeriod) tuples sorted by start time
+		"""
+		results = []
+		for partition, access_periods in self.__fan_out(self.plan(start, stop, staff, rig_ids), "periods",
+		                                                (start, stop, staff)):
+			results.extend((partition.rig_id, access_period) for access_period in access_periods)
+		results.sort(key=lambda result: result[1].start_epoch)
+
+		return results
+
+	def query_staff_summaries(self, start=None, stop=None, staff=None, rig_ids=None):
+		"""
+		Summarise the access periods that overlap a time window per member of staff across all matching partitions,
+		each partition produces partial summaries which are then merged
+
+		:return: dictionary of {staff id: dictionary of periods, seconds, readings, temp_max, humidity_average,
+		         temp_percentiles and humidity_percentiles}, as AccessPeriods.query_staff_summaries()
+		"""
+		summaries = {}
+		for partition, partials in self.__fan_out(self.plan(start, stop, staff, rig_ids), "staff", (start, stop, staff)):
+			merge_staff_summaries(summaries, partials)
+
+		return finish_staff_summaries(summaries)
+
+	def rollup(self, bucket_seconds, start=None, stop=None, rig_ids=None):
+		"""
+		Roll the readings of the matching partitions up into fixed width time buckets, partitions are selected by the
+		time window but all of their readings are rolled up, partitions that have been aged to rollup tiers contribute
+		their finest tier no wider than bucket_seconds
+
+		:param bucket_seconds: width of each bucket in seconds, as int
+		:param start: start of the time window in seconds since the epoch, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, None for no upper bound
+		:param rig_ids: iterable of rig ids to restrict the rollup to, None for all rigs
+
+		:return: dictionary of {bucket start: RollupBucket}
+		"""
+		buckets = {}
+		partitions = self.partitions(start, stop, rig_ids, with_rollups=True)
+		for partition, partials in self.__fan_out(partitions, "rollup", (bucket_seconds,)):
+			for bucket_start, bucket in partials.items():
+				if bucket_start in buckets:
+					buckets[bucket_start].merge(bucket)
+				else:
+					buckets[bucket_start] = bucket
+
+		return buckets
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Rig and day partitioned storage for PPW2 access data")
+	parser.add_argument("root", help="root directory of the partitioned store")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+	ingest_parser = subparsers.add_parser("ingest", help="add access data files to the store")
+	ingest_parser.add_argument("data_files", nargs="+", help="access data files to add")
+	ingest_parser.add_argument("--rig", help="rig id for files without a RIG-ID line")
+	query_parser = subparsers.add_parser("query", help="summarise the store per member of staff")
+	query_parser.add_argument("--rig", action="append", dest="rigs", help="restrict to a rig id (may be repeated)")
+	query_parser.add_argument("--staff", help="restrict to a staff id")
+	query_parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+	args = parser.parse_args(argv)
+
+	if args.command == "ingest":
+		store = PartitionedStore(args.root)
+		for data_file in args.data_files:
+			access_periods = AccessPeriods(data_file)
+			partitions = store.write(access_periods, access_periods.rig_id or args.rig)
+			print("Wrote {0} access periods from [{1}] to {2} partition(s)".format(len(access_periods), data_file,
+			                                                                      len(partitions)))
+	else:
+		store = PartitionedStore(args.root, args.workers)
+		summaries = store.query_staff_summaries(staff=args.staff, rig_ids=args.rigs)
+		store.close()
+		for staff in sorted(summaries):
+			summary = summaries[staff]
+			print("{0}: {1} periods, {2} readings, temp max {3}c p50/p95/p99 {4}, humidity ave {5:.2f}%".format(
+				staff, summary["periods"], summary["readings"], summary["temp_max"], summary["temp_percentiles"],
+				summary["humidity_average"]))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
@@ -0,0 +1,103 @@
+# File: sd_log_extract.py
+# Description: Extract the access data logged by a rig straight to the blocks of an SD card (see libs/sd_log.py) from
+#              an image of the card (e.g. made with dd), each logging session is written out as its own data file that
+#              the desktop app can read, CSV text or a binary record log depending on what the rig logged
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import struct
+import zlib
+from DesktopApp import RECORD_LOG_MAGIC
+
+
+# Constants
+SD_LOG_MAGIC = b"PPWS"
+SD_LOG_VERSION = 1
+BLOCK_SIZE = 512
+SESSION_START = 1
+
+# Superblock: magic, version, flags, generation, first data block, head block, then a CRC32 of those fields
+_SUPERBLOCK = struct.Struct("<4sHHIII")
+_CHECKSUM = struct.Struct("<I")
+# Data block header: payload length, flags
+_BLOCK_HEADER = struct.Struct("<HH")
+
+
+# Functions
+def read_superblock(image, start_block=0):
+	"""
+	Find the newest valid superblock of an SD card log
+
+	:param image: open binary file of the card image
+	:param start_block: block of the card the log starts at, as int
+
+	:return: (generation, first data block, head block) tuple, None if neither superblock is valid
+	"""
+	best = None
+	for slot in (0, 1):
+		image.seek((start_block + slot) * BLOCK_SIZE)
+		block = image.read(BLOCK_SIZE)
+		if len(block) < _SUPERBLOCK.size + _CHECKSUM.size:
+			continue
+		magic, version, flags, generation, data_block, head = _SUPERBLOCK.unpack_from(block, 0)
+		checksum = _CHECKSUM.unpack_from(block, _SUPERBLOCK.size)[0]
+		if magic == SD_LOG_MAGIC and version == SD_LOG_VERSION and \
+				checksum == zlib.crc32(block[:_SUPERBLOCK.size]) and (best is None or generation > best[0]):
+			best = (generation, data_block, head)
+
+	return best
+
+
+def read_sd_log(image_file, start_block=0):
+	"""
+	Read the sessions of an SD card log, only the blocks committed by the newest superblock are read
+
+	:param image_file: path to the card image, as string
+	:param start_block: block of the card the log starts at, as int
+
+	:return: list of bytes, the data logged in each session in order
+	"""
+	with open(image_file, "rb") as image:
+		superblock = read_superblock(image, start_block)
+		if superblock is None:
+			raise ValueError("No SD card log found in {0}".format(image_file))
+		generation, data_block, head = superblock
+
+		image.seek(data_block * BLOCK_SIZE)
+		data = image.read((head - data_block) * BLOCK_SIZE)
+
+	sessions = []
+	for offset in range(0, len(data) - BLOCK_SIZE + 1, BLOCK_SIZE):
+		used, flags = _BLOCK_HEADER.unpack_from(data, offset)
+		if flags & SESSION_START or not sessions:
+			sessions.append(bytearray())
+		sessions[-1] += data[offset + _BLOCK_HEADER.size:offset + _BLOCK_HEADER.size + used]
+
+	return [bytes(session) for session in sessions]
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Extract the PPW2 access data logged to an SD card from a card image")
+	parser.add_argument("image", help="image of the SD card")
+	parser.add_argument("prefix", help="prefix of the data files to write, e.g. access_data")
+	parser.add_argument("--start-block", type=int, default=0, help="block of the card the log starts at")
+	args = parser.parse_args(argv)
+
+	for number, session in enumerate(read_sd_log(args.image, args.start_block), 1):
+		data_file = "{0}.session-{1}{2}".format(args.prefix, number,
+		                                        ".ppwb" if session.startswith(RECORD_LOG_MAGIC) else ".csv")
+		with open(data_file, "wb") as file:
+			file.write(session)
+		print("Session {0}: {1} bytes written to {2}".format(number, len(session), data_file))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
@@ -0,0 +1,194 @@
+# File: sessionize.py
+# Description: Gap based sessionization for PPW2 access logs, rebuilds access periods from the staff column of each
+#              data reading and the gaps between timestamps, so logs with lost ACCESS-STARTED/ACCESS-STOPPED markers
+#              (e.g. after the rig rebooted mid-session) are recovered without attaching readings to the wrong period
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+from array import array
+from DesktopApp import (AccessPeriod, AccessPeriods, DataReading, timestamp_to_epoch, marker_to_epoch,
+                        epoch_to_marker, open_data_file, RIG_ID_MARKER)
+
+
+# Constants
+DEFAULT_MAX_GAP = 30  # Seconds between readings after which a new session is started (the rig logs every 1-2 seconds)
+_NO_MARKER = -1
+
+
+# Functions
+def recover_access_periods(data_files, max_gap=DEFAULT_MAX_GAP):
+	"""
+	Rebuild the access periods of one or more damaged access logs by sessionization
+
+	:param data_files: path to an access log, or list of paths, as strings
+	:param max_gap: largest gap in seconds allowed between two readings of the same session, as int
+
+	:return: (AccessPeriods class instance, number of sessions rebuilt without both markers) tuple
+	"""
+	if isinstance(data_files, str):
+		data_files = [data_files]
+
+	log = SessionLog()
+	for data_file in data_files:
+		log.read(data_file)
+
+	access_periods = AccessPeriods()
+	recovered = 0
+	for access_period, marked in log.sessions(max_gap):
+		access_periods.add_access_period(access_period)
+		recovered += not marked
+
+	return access_periods, recovered
+
+
+# Classes
+class SessionLog:
+	"""
+	Class to hold the data readings of an access log as columns, together with any markers found, ready to be split
+	into sessions, reading the log is a single pass that never builds per reading objects
+	"""
+	def __init__(self):
+		"""
+		Initialiser - instance variables:
+			epochs: array of reading timestamps in seconds since the epoch
+			temps: array of temperatures
+			humidities: array of humidities
+			staff: array of staff indexes, positions in staff_ids
+			staff_ids: list of staff ids
+			timestamps: list of the original timestamp strings
+			started: dictionary of {row: start epoch} for rows that directly follow an ACCESS-STARTED marker
+			stopped: dictionary of {row: (stop epoch, period length)} for rows directly followed by an ACCESS-STOPPED
+			         marker
+			lines_skipped: number of malformed lines, as int
+		"""
+		self.epochs = array("q")
+		self.temps = array("d")
+		self.humidities = array("d")
+		self.staff = array("I")
+		self.staff_ids = []
+		self.timestamps = []
+		self.started = {}
+		self.stopped = {}
+		self.lines_skipped = 0
+
+	def __len__(self):
+		return len(self.epochs)
+
+	def read(self, data_file):
+		"""
+		Append the data readings and markers of an access log file (.csv or .csv.gz) to the columns
+
+		:param data_file: path to the access log, as string
+
+		:return: nothing
+		"""
+		staff_indexes = {staff: index for index, staff in enumerate(self.staff_ids)}
+		pending_start = _NO_MARKER
+		# Row of the first reading after the last marker, an ACCESS-STOPPED marker only belongs to the row before it if
+		# a reading has been read since the last marker (an empty period must not overwrite an earlier period's stop)
+		marker_row = len(self.epochs)
+		marker_staff = "None"
+		with open_data_file(data_file) as file:
+			for line in file:
+				entries = [entry.strip() for entry in line.split(",")]
+				try:
+					if entries[0] == "ACCESS-STARTED":
+						pending_start = marker_to_epoch(entries[1], entries[2])
+						marker_staff = entries[3] if len(entries) > 3 and entries[3] else "None"
+						marker_row = len(self.epochs)
+					elif entries[0] == "ACCESS-STOPPED":
+						if len(self.epochs) > marker_row:
+							self.stopped[len(self.epochs) - 1] = (marker_to_epoch(entries[1], entries[2]),
+							                                      int(entries[3]))
+						pending_start = _NO_MARKER
+						marker_row = len(self.epochs)
+					elif entries[0] == RIG_ID_MARKER:
+						continue
+					elif entries[0]:
+						epoch = timestamp_to_epoch(entries[0])
+						temp_data = float(entries[1])
+						humidity_data = float(entries[2])
+						staff = entries[3] if len(entries) > 3 and entries[3] else marker_staff
+						if staff not in staff_indexes:
+							staff_indexes[staff] = len(self.staff_ids)
+							self.staff_ids.append(staff)
+
+						if pending_start != _NO_MARKER:
+							self.started[len(self.epochs)] = pending_start
+							pending_start = _NO_MARKER
+						self.epochs.append(epoch)
+						self.temps.append(temp_data)
+						self.humidities.append(humidity_data)
+						self.staff.append(staff_indexes[staff])
+						self.timestamps.append(entries[0])
+				except (IndexError, ValueError):
+					self.lines_skipped += 1
+
+	def boundaries(self, max_gap=DEFAULT_MAX_GAP):
+		"""
+		Find the first row of every session in one pass over the columns, a session starts wherever the staff id
+		changes, time goes backwards (the rig clock was reset), the gap to the previous reading exceeds max_gap, or an
+		ACCESS-STARTED/ACCESS-STOPPED marker separates two readings
+
+		:param max_gap: largest gap in seconds allowed between two readings of the same session, as int
+
+		:return: list of first rows, as ints (empty if there are no readings)
+		"""
+		epochs, staff, started, stopped = self.epochs, self.staff, self.started, self.stopped
+		if not epochs:
+			return []
+
+		return [0] + [row for row in range(1, len(epochs))
+		              if staff[row] != staff[row - 1] or not 0 <= epochs[row] - epochs[row - 1] <= max_gap
+		              or row in started or row - 1 in stopped]
+
+	def sessions(self, max_gap=DEFAULT_MAX_GAP):
+		"""
+		Rebuild access periods from the sessions found, a session keeps its marker start and stop times when its
+		markers survived, otherwise it runs from its first to its last reading
+
+		:param max_gap: largest gap in seconds allowed between two readings of the same session, as int
+
+		:return: list of (AccessPeriod, True if both markers were present) tuples, in log order
+		"""
+		firsts = self.boundaries(max_gap)
+		results = []
+		for first, end in zip(firsts, firsts[1:] + [len(self.epochs)]):
+			last = end - 1
+			start_epoch = self.started.get(first, self.epochs[first])
+			stop_epoch, period_length = self.stopped.get(last, (self.epochs[last], None))
+			if period_length is None:
+				period_length = stop_epoch - start_epoch
+
+			access_period = AccessPeriod(*epoch_to_marker(start_epoch), self.staff_ids[self.staff[first]])
+			for row in range(first, end):
+				access_period.add_data_reading(DataReading(self.timestamps[row], self.temps[row], self.humidities[row]))
+			access_period.stop_date, access_period.stop_time = epoch_to_marker(stop_epoch)
+			access_period.period_length = period_length
+			results.append((access_period, first in self.started and last in self.stopped))
+
+		return results
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Rebuild PPW2 access periods from damaged access logs")
+	parser.add_argument("data_files", nargs="+", help="access logs to read (.csv or .csv.gz)")
+	parser.add_argument("--max-gap", type=int, default=DEFAULT_MAX_GAP,
+	                    help="seconds between readings after which a new access period starts")
+	args = parser.parse_args(argv)
+
+	access_periods, recovered = recover_access_periods(args.data_files, args.max_gap)
+	access_periods.print_access_periods()
+	print("Rebuilt {0} access periods ({1} without both markers)".format(len(access_periods), recovered))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
@@ -0,0 +1,260 @@
+# File: shared_dataset.py
+# Description: Shared memory columnar dataset for PPW2 access data, the readings of an AccessPeriods instance are
+#              published once into multiprocessing.shared_memory blocks and a pool of report workers attaches to them
+#              without copying, so per-staff and per-day reports scale across cores without duplicating the dataset
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import multiprocessing
+from array import array
+from multiprocessing import shared_memory
+from DesktopApp import AccessPeriods, RollupBucket, PERCENTILES, epoch_to_marker
+
+
+# Constants
+SECONDS_PER_DAY = 86400
+COLUMNS = (("epochs", "q"), ("temps", "d"), ("humidities", "d"), ("staff", "I"))
+REPORT_KEYS = ("staff", "day")
+
+# Dataset attached by each report worker process, see _attach_worker()
+_worker_dataset = None
+
+
+# Functions
+def _attach_block(name):
+	"""
+	Attach to an existing shared memory block without handing its lifetime to this process, only the publishing
+	process unlinks the blocks
+	"""
+	try:
+		return shared_memory.SharedMemory(name=name, track=False)
+	except TypeError:
+		# Python versions before 3.13 always track attached blocks, this is harmless here as pool workers share the
+		# publishing process's resource tracker, which already holds the block
+		return shared_memory.SharedMemory(name=name)
+
+
+def _attach_worker(descriptor):
+	"""
+	Report worker pool initialiser, attach the shared dataset once per worker process
+	"""
+	global _worker_dataset
+	_worker_dataset = SharedDataset.attach(descriptor)
+
+
+def _report_chunk(task):
+	"""
+	Report worker task, roll up one contiguous range of rows into partial RollupBucket aggregates
+
+	:param task: (report key, first row, last row) tuple, report key is "staff" or "day"
+
+	:return: dictionary of {staff id or day start epoch: RollupBucket}
+	"""
+	report_key, first, last = task
+	dataset = _worker_dataset
+	epochs, temps, humidities, staff = dataset.epochs, dataset.temps, dataset.humidities, dataset.staff
+
+	partials = {}
+	for row in range(first, last):
+		if report_key == "staff":
+			key = dataset.staff_ids[staff[row]]
+			start, width = 0, 0
+		else:
+			key = start = epochs[row] - epochs[row] % SECONDS_PER_DAY
+			width = SECONDS_PER_DAY
+		bucket = partials.get(key)
+		if bucket is None:
+			bucket = partials[key] = RollupBucket(start, width)
+		bucket.add(temps[row], humidities[row])
+
+	return partials
+
+
+# Classes
+class SharedDataset:
+	"""
+	Class to hold the columnar readings of an access periods dataset in shared memory, one block per column, the
+	descriptor (block names, row count and staff ids) is all a worker needs to attach to the same memory with
+	zero-copy memoryview columns
+	"""
+	def __init__(self, descriptor, blocks, owner):
+		"""
+		Initialiser - instance variables:
+			__descriptor: dictionary of block names, row count and staff ids, property with read-only access
+			__blocks: dictionary of {column name: SharedMemory}, property with no access
+			__owner: True if this process published (and so must unlink) the blocks, property with no access
+			epochs, temps, humidities, staff: memoryview columns onto the shared blocks
+			staff_ids: list of staff ids, the staff column holds positions in this list
+
+		:param descriptor: dataset descriptor dictionary
+		:param blocks: dictionary of {column name: SharedMemory}
+		:param owner: True if this process published the blocks
+		"""
+		self.__descriptor = descriptor
+		self.__blocks = blocks
+		self.__owner = owner
+		self.staff_ids = descriptor["staff_ids"]
+		rows = descriptor["rows"]
+		views = []
+		try:
+			for name, type_code in COLUMNS:
+				views.append(blocks[name].buf.cast(type_code))
+				views.append(views[-1][:rows])
+				setattr(self, name, views[-1])
+		except Exception:
+			# Release the views made so far, the blocks cannot be closed while they are still exported
+			for view in reversed(views):
+				view.release()
+			raise
+
+	@property
+	def descriptor(self):
+		return self.__descriptor
+
+	@property
+	def rows(self):
+		return self.__descriptor["rows"]
+
+	@classmethod
+	def publish(cls, access_periods):
+		"""
+		Copy the data readings of an AccessPeriods class instance into new shared memory blocks
+
+		:param access_periods: AccessPeriods class instance
+
+		:return: SharedDataset instance owning the blocks (call unlink() when the dataset is no longer needed)
+		"""
+		staff_ids = []
+		staff_indexes = {}
+		columns = {name: array(type_code) for name, type_code in COLUMNS}
+		for access_period in access_periods:
+			if access_period.staff not in staff_indexes:
+				staff_indexes[access_period.staff] = len(staff_ids)
+				staff_ids.append(access_period.staff)
+			staff_index = staff_indexes[access_period.staff]
+			for data_reading in access_period.data_readings:
+				columns["epochs"].append(data_reading.epoch)
+				columns["temps"].append(data_reading.temp_data)
+				columns["humidities"].append(data_reading.humidity_data)
+				columns["staff"].append(staff_index)
+
+		rows = len(columns["epochs"])
+		blocks = {}
+		descriptor = {"rows": rows, "staff_ids": staff_ids, "blocks": {}}
+		try:
+			for name, type_code in COLUMNS:
+				data = columns[name].tobytes()
+				# Zero sized shared memory blocks are not allowed, so always allocate at least one item so the block can
+				# still be cast to the column's type
+				block = shared_memory.SharedMemory(create=True, size=max(len(data), array(type_code).itemsize))
+				blocks[name] = block
+				block.buf[:len(data)] = data
+				descriptor["blocks"][name] = block.name
+
+			return cls(descriptor, blocks, True)
+		except Exception:
+			for block in blocks.values():
+				block.close()
+				block.unlink()
+			raise
+
+	@classmethod
+	def attach(cls, descriptor):
+		"""
+		Attach to a dataset published by another process
+
+		:param descriptor: descriptor property of the published SharedDataset
+
+		:return: SharedDataset instance (call close() when finished with it)
+		"""
+		blocks = {name: _attach_block(block_name) for name, block_name in descriptor["blocks"].items()}
+
+		return cls(descriptor, blocks, False)
+
+	def close(self):
+		"""
+		Release this process's views of the shared blocks, the blocks themselves remain until unlinked
+
+		:return: nothing
+		"""
+		for name, type_code in COLUMNS:
+			getattr(self, name).release()
+			setattr(self, name, None)
+		for block in self.__blocks.values():
+			block.close()
+
+	def unlink(self):
+		"""
+		Release and free the shared blocks, only the publishing process may do this
+
+		:return: nothing
+		"""
+		self.close()
+		if self.__owner:
+			for block in self.__blocks.values():
+				block.unlink()
+
+	def generate_report(self, report_key, processes=None, chunk_rows=65536):
+		"""
+		Generate a per-staff or per-day report with a pool of worker processes, each worker attaches to the shared
+		blocks once and rolls up contiguous ranges of rows, the partial results are then merged
+
+		:param report_key: "staff" or "day"
+		:param processes: number of worker processes, None for one per core
+		:param chunk_rows: number of rows in each worker task, as int
+
+		:return: dictionary of {staff id or day start epoch: RollupBucket}
+		"""
+		if report_key not in REPORT_KEYS:
+			raise ValueError("Unknown report key: {0}".format(report_key))
+
+		tasks = [(report_key, first, min(first + chunk_rows, self.rows)) for first in range(0, self.rows, chunk_rows)]
+		report = {}
+		with multiprocessing.Pool(processes, initializer=_attach_worker, initargs=(self.descriptor,)) as pool:
+			for partials in pool.imap_unordered(_report_chunk, tasks):
+				for key, bucket in partials.items():
+					if key in report:
+						report[key].merge(bucket)
+					else:
+						report[key] = bucket
+
+		return report
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Generate PPW2 access data reports with a pool of worker processes")
+	parser.add_argument("data_files", nargs="+", help="access data files to load")
+	parser.add_argument("--by", choices=REPORT_KEYS, default="staff", help="report per staff member or per day")
+	parser.add_argument("--processes", type=int, default=None, help="number of worker processes")
+	args = parser.parse_args(argv)
+
+	access_periods = AccessPeriods()
+	for data_file in args.data_files:
+		for access_period in AccessPeriods(data_file):
+			access_periods.add_access_period(access_period)
+
+	dataset = SharedDataset.publish(access_periods)
+	try:
+		report = dataset.generate_report(args.by, args.processes)
+	finally:
+		dataset.unlink()
+
+	print("Report by {0} over {1} readings".format(args.by, dataset.rows))
+	print("===========================================================")
+	for key in sorted(report):
+		bucket = report[key]
+		label = key if args.by == "staff" else epoch_to_marker(key)[0]
+		print("{0}: {1} readings, temp max {2}c p50/p95/p99 {3}, humidity ave {4:.2f}%".format(
+			label, bucket.count, bucket.temp_max, bucket.temp_sketch.quantiles(PERCENTILES), bucket.humidity_average))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
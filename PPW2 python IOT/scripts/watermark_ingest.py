@@ -0,0 +1,369 @@
+# File: watermark_ingest.py
+# Description: Out-of-order tolerant ingestion of PPW2 readings from several rigs, readings are buffered by event time
+#              and only released once a watermark has passed them, the watermark finalises access periods and rollup
+#              buckets, and readings arriving behind the watermark are sent down a correction path that updates the
+#              already finalised aggregates in place instead of recomputing them
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import heapq
+import itertools
+from DesktopApp import (AccessPeriod, AccessPeriods, DataReading, RollupBucket, timestamp_to_epoch,
+                        epoch_to_timestamp, epoch_to_marker, open_data_file, RIG_ID_MARKER)
+
+
+# Constants
+DEFAULT_ALLOWED_LATENESS = 10  # Seconds the watermark trails the slowest active rig
+DEFAULT_MAX_GAP = 30  # Seconds between readings of a rig and staff member after which a new access period starts
+DEFAULT_BUCKET_SECONDS = 60
+DEFAULT_IDLE_TIMEOUT = 300  # Seconds behind the newest rig after which a silent rig no longer holds the watermark back
+DEFAULT_CORRECTION_HORIZON = 3600  # Seconds behind the watermark that finalised aggregates are kept for corrections
+
+
+# Functions
+def replay_data_files(ingestor, data_files, rig_ids=None):
+	"""
+	Feed the data readings of several rig logs to an ingestor interleaved line by line, as they would arrive from rigs
+	publishing at the same time
+
+	:param ingestor: WatermarkIngestor class instance
+	:param data_files: list of access data file paths, as strings
+	:param rig_ids: optional list of rig ids, one per data file, by default the id from each file's RIG-ID line is used
+	                (or the file path when the file has none)
+
+	:return: nothing
+	"""
+	files = [open_data_file(data_file) for data_file in data_files]
+	file_rig_ids = list(rig_ids or data_files)
+	try:
+		for lines in itertools.zip_longest(*files):
+			for number, line in enumerate(lines):
+				entries = [entry.strip() for entry in (line or "").split(",")]
+				if entries[0] == RIG_ID_MARKER and not rig_ids and len(entries) > 1:
+					file_rig_ids[number] = entries[1]
+					continue
+				if not entries[0] or entries[0].startswith("ACCESS-"):
+					continue
+				rig_id = file_rig_ids[number]
+				try:
+					ingestor.add(rig_id, timestamp_to_epoch(entries[0]), float(entries[1]), float(entries[2]),
+					             entries[3] if len(entries) > 3 and entries[3] else "None")
+				except (IndexError, ValueError):
+					continue
+	finally:
+		for file in files:
+			file.close()
+
+
+# Classes
+class OpenPeriod:
+	"""
+	Class to hold an access period that is still being built from the released readings of one rig and staff member
+	"""
+	def __init__(self, rig_id, staff, epoch):
+		"""
+		Initialiser - instance variables:
+			rig_id: rig the readings came from, as string
+			access_period: AccessPeriod class instance being built
+			last_epoch: timestamp of the newest reading released into the period, as int
+
+		:param rig_id: rig the readings came from, as string
+		:param staff: staff id, as string
+		:param epoch: timestamp of the first reading, as int
+		"""
+		self.rig_id = rig_id
+		self.access_period = AccessPeriod(*epoch_to_marker(epoch), staff)
+		self.last_epoch = epoch
+
+	def finalise(self):
+		"""
+		Stop the access period at its last reading
+
+		:return: the finished AccessPeriod class instance
+		"""
+		self.access_period.stop_date, self.access_period.stop_time = epoch_to_marker(self.last_epoch)
+		self.access_period.period_length = self.last_epoch - self.access_period.start_epoch
+
+		return self.access_period
+
+
+class WatermarkIngestor:
+	"""
+	Class to ingest readings that arrive late and out of order from several rigs, readings wait in an event time buffer
+	until the watermark (the newest event time of the slowest active rig, less the allowed lateness) passes them and
+	are then released in event time order, so access periods and rollup buckets are built exactly as if the readings had
+	arrived in order, a reading that arrives behind the watermark is applied as a correction to the finalised access
+	period (inserted in time order) and rollup bucket it belongs to (both hold order independent running aggregates),
+	a late reading between access periods only updates its rollup bucket, and a reading older than the correction
+	horizon is counted as dropped
+	"""
+	def __init__(self, access_periods=None, bucket_seconds=DEFAULT_BUCKET_SECONDS,
+	             allowed_lateness=DEFAULT_ALLOWED_LATENESS, max_gap=DEFAULT_MAX_GAP, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+	             correction_horizon=DEFAULT_CORRECTION_HORIZON):
+		"""
+		Initialiser - instance variables:
+			__access_periods: AccessPeriods class instance finalised access periods are added to, property with
+			                  read-only access
+			__bucket_seconds: width of the rollup buckets in seconds, property with no access
+			__allowed_lateness: seconds the watermark trails the slowest active rig, property with no access
+			__max_gap: seconds between readings after which a new access period starts, property with no access
+			__idle_timeout: seconds behind the newest rig after which a rig is treated as idle, property with no access
+			__correction_horizon: seconds finalised aggregates are kept for corrections, property with no access
+			__watermark: event time up to which everything has been finalised, property with read-only access
+			__rig_high: dictionary of {rig id: newest event time seen}, property with no access
+			__buffer: heap of (epoch, sequence, rig id, staff, temperature, humidity) readings not yet released,
+			          property with no access
+			__sequence: counter keeping the heap stable for equal event times, property with no access
+			__open_periods: dictionary of {(rig id, staff): OpenPeriod}, property with no access
+			__open_buckets: dictionary of {bucket start: RollupBucket}, property with no access
+			__finalised_periods: list of (stop epoch, rig id, AccessPeriod) kept for corrections, property with no
+			                     access
+			__finalised_buckets: dictionary of {bucket start: RollupBucket} kept for corrections, property with no
+			                     access
+			__bucket_listeners: list of callables called with each finalised RollupBucket, property with no access
+			__correction_listeners: list of callables called with each correction, property with no access
+			stats: dictionary of counters (received, released, late, corrected, bucket_only, dropped)
+
+		:param access_periods: optional AccessPeriods class instance to add finalised access periods to
+		:param bucket_seconds: width of the rollup buckets in seconds, as int
+		:param allowed_lateness: seconds the watermark trails the slowest active rig, as int
+		:param max_gap: seconds between readings of a rig and staff member after which a new access period starts
+		:param idle_timeout: seconds behind the newest rig after which a silent rig no longer holds the watermark back
+		:param correction_horizon: seconds behind the watermark that finalised aggregates can still be corrected
+		"""
+		self.__access_periods = access_periods if access_periods is not None else AccessPeriods()
+		self.__bucket_seconds = bucket_seconds
+		self.__allowed_lateness = allowed_lateness
+		self.__max_gap = max_gap
+		self.__idle_timeout = idle_timeout
+		self.__correction_horizon = correction_horizon
+		self.__watermark = None
+		self.__rig_high = {}
+		self.__buffer = []
+		self.__sequence = itertools.count()
+		self.__open_periods = {}
+		self.__open_buckets = {}
+		self.__finalised_periods = []
+		self.__finalised_buckets = {}
+		self.__bucket_listeners = []
+		self.__correction_listeners = []
+		self.stats = {"received": 0, "released": 0, "late": 0, "corrected": 0, "bucket_only": 0, "dropped": 0}
+
+	@property
+	def access_periods(self):
+		return self.__access_periods
+
+	@property
+	def watermark(self):
+		return self.__watermark
+
+	def add_bucket_listener(self, listener):
+		"""
+		Register a callable to be called with every rollup bucket once the watermark has passed its end
+
+		:param listener: callable taking a RollupBucket class instance
+
+		:return: nothing
+		"""
+		self.__bucket_listeners.append(listener)
+
+	def add_correction_listener(self, listener):
+		"""
+		Register a callable to be called for every late reading applied to already finalised aggregates
+
+		:param listener: callable taking the corrected RollupBucket and the corrected AccessPeriod (or None when no
+		                 finalised access period covers the reading)
+
+		:return: nothing
+		"""
+		self.__correction_listeners.append(listener)
+
+	def add(self, rig_id, epoch, temp_data, humidity_data, staff="None"):
+		"""
+		Ingest a single reading in arrival order
+
+		:param rig_id: rig the reading came from, as string
+		:param epoch: event time of the reading in seconds since the epoch, as int
+		:param temp_data: temperature, as float
+		:param humidity_data: humidity, as float
+		:param staff: staff id the rig recorded with the reading, as string
+
+		:return: nothing
+		"""
+		self.stats["received"] += 1
+		if self.__watermark is not None and epoch <= self.__watermark:
+			self.__correct(rig_id, epoch, temp_data, humidity_data, staff)
+			return
+
+		heapq.heappush(self.__buffer, (epoch, next(self.__sequence), rig_id, staff, temp_data, humidity_data))
+		if epoch > self.__rig_high.get(rig_id, epoch - 1):
+			self.__rig_high[rig_id] = epoch
+			self.advance(self.__compute_watermark())
+
+	def __compute_watermark(self):
+		"""
+		The newest event time of the slowest rig that is still active, less the allowed lateness
+		"""
+		newest = max(self.__rig_high.values())
+		active = [high for high in self.__rig_high.values() if newest - high <= self.__idle_timeout]
+
+		return min(active) - self.__allowed_lateness
+
+	def advance(self, watermark):
+		"""
+		Move the watermark forward, releasing every buffered reading at or before it and finalising the access periods
+		and rollup buckets that can no longer receive in-order readings, the watermark never moves backwards
+
+		:param watermark: new watermark in seconds since the epoch, as int
+
+		:return: nothing
+		"""
+		if self.__watermark is not None and watermark <= self.__watermark:
+			return
+		self.__watermark = watermark
+
+		buffer = self.__buffer
+		while buffer and buffer[0][0] <= watermark:
+			epoch, sequence, rig_id, staff, temp_data, humidity_data = heapq.heappop(buffer)
+			self.__release(rig_id, epoch, temp_data, humidity_data, staff)
+
+		for key, open_period in list(self.__open_periods.items()):
+			if watermark - open_period.last_epoch > self.__max_gap:
+				self.__finalise_period(key)
+
+		for start in sorted(self.__open_buckets):
+			if start + self.__bucket_seconds - 1 > watermark:
+				break
+			bucket = self.__finalised_buckets[start] = self.__open_buckets.pop(start)
+			for listener in self.__bucket_listeners:
+				listener(bucket)
+
+		self.__expire(watermark - self.__correction_horizon)
+
+	def flush(self):
+		"""
+		Release everything still buffered and finalise all open access periods and rollup buckets (e.g. at the end of
+		a replay)
+
+		:return: nothing
+		"""
+		if self.__buffer or self.__open_periods or self.__open_buckets:
+			newest = max(high for high in self.__rig_high.values())
+			self.advance(newest + self.__max_gap + self.__bucket_seconds + 1)
+
+	def __release(self, rig_id, epoch, temp_data, humidity_data, staff):
+		"""
+		Apply a reading released by the watermark, readings are released in event time order
+		"""
+		self.stats["released"] += 1
+		key = (rig_id, staff)
+		open_period = self.__open_periods.get(key)
+		if open_period is not None and epoch - open_period.last_epoch > self.__max_gap:
+			self.__finalise_period(key)
+			open_period = None
+		if open_period is None:
+			open_period = self.__open_periods[key] = OpenPeriod(rig_id, staff, epoch)
+		open_period.access_period.add_data_reading(DataReading(epoch_to_timestamp(epoch), temp_data, humidity_data))
+		open_period.last_epoch = epoch
+
+		start = epoch - epoch % self.__bucket_seconds
+		bucket = self.__open_buckets.get(start)
+		if bucket is None:
+			bucket = self.__open_buckets[start] = RollupBucket(start, self.__bucket_seconds)
+		bucket.add(temp_data, humidity_data)
+
+	def __finalise_period(self, key):
+		open_period = self.__open_periods.pop(key)
+		access_period = open_period.finalise()
+		self.__finalised_periods.append((access_period.stop_epoch, open_period.rig_id, access_period))
+		self.__access_periods.add_access_period(access_period)
+
+	def __correct(self, rig_id, epoch, temp_data, humidity_data, staff):
+		"""
+		Apply a reading that arrived behind the watermark to the finalised aggregates it belongs to
+		"""
+		self.stats["late"] += 1
+		start = epoch - epoch % self.__bucket_seconds
+		bucket = self.__finalised_buckets.get(start) or self.__open_buckets.get(start)
+		if bucket is None:
+			if start + self.__bucket_seconds - 1 > self.__watermark - self.__correction_horizon:
+				# The bucket never received an in-order reading, open it as a finalised bucket of its own
+				bucket = self.__finalised_buckets[start] = RollupBucket(start, self.__bucket_seconds)
+			else:
+				self.stats["dropped"] += 1
+				return
+		bucket.add(temp_data, humidity_data)
+
+		# Late readings are inserted in time order, a finalised access period is updated through the AccessPeriods
+		# instance so its update listeners (caches and indexes) see the change
+		corrected_period = None
+		data_reading = DataReading(epoch_to_timestamp(epoch), temp_data, humidity_data)
+		open_period = self.__open_periods.get((rig_id, staff))
+		if open_period is not None and open_period.access_period.start_epoch <= epoch:
+			corrected_period = open_period.access_period
+			corrected_period.add_data_reading(data_reading)
+			open_period.last_epoch = max(open_period.last_epoch, epoch)
+		else:
+			for stop_epoch, period_rig_id, access_period in reversed(self.__finalised_periods):
+				if period_rig_id == rig_id and access_period.staff == staff and \
+						access_period.start_epoch <= epoch <= stop_epoch:
+					corrected_period = access_period
+					self.__access_periods.add_data_reading(corrected_period, data_reading)
+					break
+
+		if corrected_period is not None:
+			self.stats["corrected"] += 1
+		else:
+			# The reading falls between access periods, only its rollup bucket is updated
+			self.stats["bucket_only"] += 1
+		for listener in self.__correction_listeners:
+			listener(bucket, corrected_period)
+
+	def __expire(self, horizon):
+		"""
+		Forget finalised aggregates that ended before the correction horizon
+		"""
+		for start in [start for start in self.__finalised_buckets if start + self.__bucket_seconds - 1 < horizon]:
+			del self.__finalised_buckets[start]
+		self.__finalised_periods = [entry for entry in self.__finalised_periods if entry[0] >= horizon]
+
+	def buckets(self):
+		"""
+		All rollup buckets still held, finalised and open
+
+		:return: dictionary of {bucket start: RollupBucket}
+		"""
+		buckets = dict(self.__finalised_buckets)
+		buckets.update(self.__open_buckets)
+
+		return buckets
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Ingest interleaved PPW2 rig logs with event time watermarks")
+	parser.add_argument("data_files", nargs="+", help="access data files, one per rig")
+	parser.add_argument("--lateness", type=int, default=DEFAULT_ALLOWED_LATENESS,
+	                    help="seconds the watermark trails the slowest active rig")
+	parser.add_argument("--bucket", type=int, default=DEFAULT_BUCKET_SECONDS, help="rollup bucket width in seconds")
+	args = parser.parse_args(argv)
+
+	ingestor = WatermarkIngestor(bucket_seconds=args.bucket, allowed_lateness=args.lateness)
+	replay_data_files(ingestor, args.data_files)
+	ingestor.flush()
+
+	print("Ingested {received} readings ({late} late, {corrected} corrected, {bucket_only} bucket only, {dropped} "
+	      "dropped)".format(**ingestor.stats))
+	print("{0} access periods finalised, {1} rollup buckets held".format(len(ingestor.access_periods),
+	                                                                     len(ingestor.buckets())))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()
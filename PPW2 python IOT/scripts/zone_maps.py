@@ -0,0 +1,346 @@
+# File: zone_maps.py
+# Description: Per-file zone maps for archived PPW2 access data, a small sidecar file beside each archive holds the
+#              time, temperature and humidity ranges of the archive and a Bloom filter of its staff ids, so a query
+#              planner can skip every archive that cannot hold a match without opening it
+# Author: Arben Durmishllari, University of Sunderland
+# Date: May 2019
+
+# Imports
+import argparse
+import hashlib
+import os
+import struct
+from DesktopApp import AccessPeriods, timestamp_to_epoch
+
+
+# Constants
+ZONE_MAGIC = b"PPWZ"
+ZONE_VERSION = 1
+ZONE_SUFFIX = ".zone"
+DEFAULT_BLOOM_BITS = 1024  # Roughly 1% false positives for 100 staff ids with 7 hashes
+DEFAULT_BLOOM_HASHES = 7
+
+# Zone map sidecar layout (all little-endian):
+#   header:  magic, version, flags, Bloom filter bits, Bloom filter hashes, archive size, archive modified time (ns)
+#   ranges:  period count, row count, first epoch, last epoch, temp min, temp max, humidity min, humidity max
+#   bloom:   Bloom filter bits / 8 bytes
+_ZONE_HEADER = struct.Struct("<4sHHIIqq")
+_ZONE_RANGES = struct.Struct("<IIqqdddd")
+
+
+# Functions
+def zone_map_file(data_file):
+	"""
+	Path of the zone map sidecar of an archive
+
+	:param data_file: path to the archive, as string
+
+	:return: path to the sidecar, as string
+	"""
+	return data_file + ZONE_SUFFIX
+
+
+def build_zone_map(data_file, access_periods=None):
+	"""
+	Build and write the zone map sidecar of an archive (any file AccessPeriods can read)
+
+	:param data_file: path to the archive, as string
+	:param access_periods: the archive's AccessPeriods class instance if already loaded, otherwise it is read
+
+	:return: ZoneMap instance written
+	"""
+	zone_map = ZoneMap.from_access_periods(access_periods if access_periods is not None else AccessPeriods(data_file))
+	zone_map.write(data_file)
+
+	return zone_map
+
+
+def load_zone_map(data_file):
+	"""
+	Load the zone map sidecar of an archive, a missing sidecar or one written for a different version of the archive
+	(the archive's size or modified time have changed) is ignored
+
+	:param data_file: path to the archive, as string
+
+	:return: ZoneMap instance, or None if there is no up to date sidecar
+	"""
+	try:
+		with open(zone_map_file(data_file), "rb") as file:
+			zone_map = ZoneMap.from_bytes(file.read())
+		status = os.stat(data_file)
+	except (OSError, ValueError, struct.error):
+		return None
+	if (zone_map.archive_size, zone_map.archive_mtime) != (status.st_size, status.st_mtime_ns):
+		return None
+
+	return zone_map
+
+
+def plan_scan(data_files, start=None, stop=None, staff=None, temp_range=None, humidity_range=None):
+	"""
+	Choose which archives a query has to scan, archives whose zone map rules out a match are skipped and archives
+	without an up to date zone map are always scanned
+
+	:param data_files: list of archive paths, as strings
+	:param start: start of the time window in seconds since the epoch, None for no lower bound
+	:param stop: end of the time window in seconds since the epoch, None for no upper bound
+	:param staff: staff id the query is for, None for any
+	:param temp_range: (low, high) temperatures the query is for (either may be None), None for any
+	:param humidity_range: (low, high) humidities the query is for (either may be None), None for any
+
+	:return: (list of archive paths to scan, list of archive paths skipped) tuple
+	"""
+	scan, skipped = [], []
+	for data_file in data_files:
+		zone_map = load_zone_map(data_file)
+		if zone_map is None or zone_map.may_match(start, stop, staff, temp_range, humidity_range):
+			scan.append(data_file)
+		else:
+			skipped.append(data_file)
+
+	return scan, skipped
+
+
+def _overlaps(low, high, query_range):
+	"""
+	Check whether the value range [low, high] overlaps a (low, high) query range where either end may be None
+	"""
+	if query_range is None:
+		return True
+	if low is None:
+		return False
+	query_low, query_high = query_range
+
+	return (query_low is None or high >= query_low) and (query_high is None or low <= query_high)
+
+
+# Classes
+class BloomFilter:
+	"""
+	Class to hold a Bloom filter of strings, membership tests may return false positives but never false negatives,
+	the bit positions come from one blake2b digest per item using double hashing
+	"""
+	def __init__(self, bits=DEFAULT_BLOOM_BITS, hashes=DEFAULT_BLOOM_HASHES, data=None):
+		"""
+		Initialiser - instance variables:
+			__bits: number of bits in the filter, property with read-only access
+			__hashes: number of bit positions set per item, property with read-only access
+			__data: filter bits, property with no access
+
+		:param bits: number of bits in the filter, as int (a multiple of 8)
+		:param hashes: number of bit positions set per item, as int
+		:param data: optional filter bits to load, as bytes
+		"""
+		if bits <= 0 or bits % 8:
+			raise ValueError("Bloom filter bits must be a positive multiple of 8")
+		self.__bits = bits
+		self.__hashes = hashes
+		self.__data = bytearray(data) if data is not None else bytearray(bits // 8)
+		if len(self.__data) != bits // 8:
+			raise ValueError("Bloom filter data does not match its size")
+
+	@property
+	def bits(self):
+		return self.__bits
+
+	@property
+	def hashes(self):
+		return self.__hashes
+
+	def __positions(self, item):
+		digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+		first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+		return [(first + i * second) % self.__bits for i in range(self.__hashes)]
+
+	def add(self, item):
+		"""
+		Add a string to the filter
+
+		:param item: string to add
+
+		:return: nothing
+		"""
+		for position in self.__positions(item):
+			self.__data[position >> 3] |= 1 << (position & 7)
+
+	def __contains__(self, item):
+		return all(self.__data[position >> 3] & (1 << (position & 7)) for position in self.__positions(item))
+
+	def to_bytes(self):
+		return bytes(self.__data)
+
+
+class ZoneMap:
+	"""
+	Class to hold the zone map of one archive: its period and row counts, the time range its access periods cover,
+	its temperature and humidity ranges and a Bloom filter of its staff ids
+	"""
+	def __init__(self, bloom=None):
+		"""
+		Initialiser - instance variables:
+			periods: number of access periods, as int
+			rows: number of data readings, as int
+			first_epoch: earliest access period start, in seconds since the epoch, None if empty
+			last_epoch: latest access period stop, in seconds since the epoch, None if empty
+			temp_min, temp_max: temperature range, as floats, None if there are no readings
+			humidity_min, humidity_max: humidity range, as floats, None if there are no readings
+			staff: BloomFilter of staff ids
+			archive_size: size in bytes of the archive this zone map describes, as int
+			archive_mtime: modified time in nanoseconds of the archive this zone map describes, as int
+
+		:param bloom: optional BloomFilter class instance, an empty default sized one is used if None
+		"""
+		self.periods = 0
+		self.rows = 0
+		self.first_epoch = None
+		self.last_epoch = None
+		self.temp_min = None
+		self.temp_max = None
+		self.humidity_min = None
+		self.humidity_max = None
+		self.staff = bloom if bloom is not None else BloomFilter()
+		self.archive_size = 0
+		self.archive_mtime = 0
+
+	@classmethod
+	def from_access_periods(cls, access_periods):
+		"""
+		Build the zone map of a set of access periods
+
+		:param access_periods: AccessPeriods class instance, or iterable of AccessPeriod instances
+
+		:return: ZoneMap instance
+		"""
+		zone_map = cls()
+		for access_period in access_periods:
+			zone_map.periods += 1
+			zone_map.staff.add(access_period.staff)
+			start, stop = access_period.start_epoch, access_period.stop_epoch
+			zone_map.first_epoch = start if zone_map.first_epoch is None else min(zone_map.first_epoch, start)
+			zone_map.last_epoch = stop if zone_map.last_epoch is None else max(zone_map.last_epoch, stop)
+			for data_reading in access_period.data_readings:
+				temp_data, humidity_data = data_reading.temp_data, data_reading.humidity_data
+				if not zone_map.rows:
+					zone_map.temp_min = zone_map.temp_max = temp_data
+					zone_map.humidity_min = zone_map.humidity_max = humidity_data
+				else:
+					zone_map.temp_min = min(zone_map.temp_min, temp_data)
+					zone_map.temp_max = max(zone_map.temp_max, temp_data)
+					zone_map.humidity_min = min(zone_map.humidity_min, humidity_data)
+					zone_map.humidity_max = max(zone_map.humidity_max, humidity_data)
+				zone_map.rows += 1
+				# A reading logged after its period's stop marker still belongs to the file's time range
+				zone_map.last_epoch = max(zone_map.last_epoch, data_reading.epoch)
+
+		return zone_map
+
+	@classmethod
+	def from_bytes(cls, data):
+		"""
+		Load a zone map from the sidecar layout
+
+		:param data: sidecar file contents, as bytes
+
+		:return: ZoneMap instance
+		"""
+		magic, version, flags, bits, hashes, archive_size, archive_mtime = _ZONE_HEADER.unpack_from(data, 0)
+		if magic != ZONE_MAGIC or version != ZONE_VERSION:
+			raise ValueError("Not a zone map")
+		offset = _ZONE_HEADER.size + _ZONE_RANGES.size
+		zone_map = cls(BloomFilter(bits, hashes, data[offset:offset + bits // 8]))
+		zone_map.archive_size, zone_map.archive_mtime = archive_size, archive_mtime
+		(zone_map.periods, zone_map.rows, first_epoch, last_epoch, temp_min, temp_max, humidity_min,
+		 humidity_max) = _ZONE_RANGES.unpack_from(data, _ZONE_HEADER.size)
+		if zone_map.periods:
+			zone_map.first_epoch, zone_map.last_epoch = first_epoch, last_epoch
+		if zone_map.rows:
+			zone_map.temp_min, zone_map.temp_max = temp_min, temp_max
+			zone_map.humidity_min, zone_map.humidity_max = humidity_min, humidity_max
+
+		return zone_map
+
+	def to_bytes(self):
+		"""
+		Serialise this zone map into the sidecar layout
+
+		:return: sidecar file contents, as bytes
+		"""
+		return (_ZONE_HEADER.pack(ZONE_MAGIC, ZONE_VERSION, 0, self.staff.bits, self.staff.hashes, self.archive_size,
+		                          self.archive_mtime) +
+		        _ZONE_RANGES.pack(self.periods, self.rows, self.first_epoch or 0, self.last_epoch or 0,
+		                          self.temp_min or 0.0, self.temp_max or 0.0, self.humidity_min or 0.0,
+		                          self.humidity_max or 0.0) +
+		        self.staff.to_bytes())
+
+	def write(self, data_file):
+		"""
+		Write this zone map as the sidecar of an archive, recording the archive's current size and modified time so
+		the sidecar is ignored if the archive is later rewritten without it
+
+		:param data_file: path to the archive, as string
+
+		:return: nothing
+		"""
+		status = os.stat(data_file)
+		self.archive_size, self.archive_mtime = status.st_size, status.st_mtime_ns
+		temp_file = zone_map_file(data_file) + ".tmp"
+		with open(temp_file, "wb") as file:
+			file.write(self.to_bytes())
+		os.replace(temp_file, zone_map_file(data_file))
+
+	def may_match(self, start=None, stop=None, staff=None, temp_range=None, humidity_range=None):
+		"""
+		Check whether the archive may hold data matching a query, False means it certainly does not
+
+		:param start: start of the time window in seconds since the epoch, None for no lower bound
+		:param stop: end of the time window in seconds since the epoch, None for no upper bound
+		:param staff: staff id the query is for, None for any
+		:param temp_range: (low, high) temperatures the query is for (either may be None), None for any
+		:param humidity_range: (low, high) humidities the query is for (either may be None), None for any
+
+		:return: True if the archive has to be scanned, False if it can be skipped
+		"""
+		if not self.periods:
+			return False
+		if not _overlaps(self.first_epoch, self.last_epoch, (start, stop)):
+			return False
+		if staff is not None and staff not in self.staff:
+			return False
+
+		return _overlaps(self.temp_min, self.temp_max, temp_range) and \
+			_overlaps(self.humidity_min, self.humidity_max, humidity_range)
+
+
+# Program entrance function
+def main(argv=None):
+	"""
+	Main function
+	"""
+	parser = argparse.ArgumentParser(description="Build zone map sidecars for PPW2 archives or plan a scan with them")
+	parser.add_argument("command", choices=("build", "plan"), help="build sidecars, or list the archives to scan")
+	parser.add_argument("data_files", nargs="+", help="archive files")
+	parser.add_argument("--staff", help="staff id to plan for")
+	parser.add_argument("--start", help="start of the time window (rig timestamp, e.g. 2019-5-17|12:00:00)")
+	parser.add_argument("--stop", help="end of the time window (rig timestamp)")
+	parser.add_argument("--temp-above", type=float, help="only archives that may hold a temperature above this")
+	args = parser.parse_args(argv)
+
+	if args.command == "build":
+		for data_file in args.data_files:
+			zone_map = build_zone_map(data_file)
+			print("[{0}] {1} periods, {2} rows".format(data_file, zone_map.periods, zone_map.rows))
+	else:
+		start = timestamp_to_epoch(args.start) if args.start else None
+		stop = timestamp_to_epoch(args.stop) if args.stop else None
+		temp_range = (args.temp_above, None) if args.temp_above is not None else None
+		scan, skipped = plan_scan(args.data_files, start, stop, args.staff, temp_range)
+		for data_file in scan:
+			print(data_file)
+		print("{0} archive(s) to scan, {1} skipped".format(len(scan), len(skipped)))
+
+
+# Invoke main() program entrance
+if __name__ == "__main__":
+	# execute only if run as a script
+	main()